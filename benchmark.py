@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import tempfile
+import tracemalloc
+import numpy
+from markov import MarkovChain, GenomeInOutWindow, TrackPyramid
+from utils import CpGInModel, CpGOutModel, FileHandler
+from profiling import Profiler
+
+'''
+Benchmark suite of the software: times the training of a MarkovChain, the scoring of a query with scoreQuery, the genome scanning of
+GenomeInOutWindow.evaluate, the peak calling of GenomeInOutWindow.callPeaks and the round trips through FileHandler, both with the binary
+score tracks and with the old text format, on uniform synthetic genomes drawn with numpy from a fixed seed, so that the runs are
+reproducible. Each genome size is benchmarked in a separate process. The memory reported for each stage is the peak allocated by one
+extra run of the stage traced by tracemalloc, to which numpy reports its arrays, above what was allocated before it, so that it belongs
+to the stage alone rather than to the genome or to the stages run before. Since tracemalloc only sees the allocations of Python and numpy,
+the peak resident memory of the process (ru_maxrss), which also counts memory maps and the interpreter itself, is reported as well after
+the timed runs of each stage: it never decreases along the stages of a size, but each size starts from a fresh process. The startup time of query mode, from launching the interpreter
+to the printed log ratio of a short query scored with the pre-computed models (python cli.py query -F), is measured as well over fresh
+processes and checked against a target of 200 ms, since the core only imports numpy and leaves matplotlib and pandas to the plots and
+DataFrame views that need them. Results are printed as a table and saved as JSON, so that the performance of two commits can be compared.
+
+The flags that can be declared are:
+
+--sizes <int,int,...>: genome sizes to benchmark (default 10000,100000,1000000,10000000,50000000);
+--windows <int,int,...>: window sizes used when scanning (default 200,566);
+--seed <int>: seed of the synthetic genomes (default 0);
+--repeat <int>: number of repetitions of each measurement, of which the fastest is kept (default 3);
+--text-limit <int>: largest genome size for which the text format round trip is timed, being much slower (default 1000000);
+--startup-target <float>: startup time of query mode, in milliseconds, above which the startup measurement is reported as failed (default 200);
+--output <str>: path of the JSON file the results are saved in (default benchmark.json);
+--compare <str>: path of the JSON results of a previous run, printing the ratio of the new timings to the old ones.
+'''
+
+def timed(function, repeat: int) -> tuple:
+    '''Runs "function" "repeat" times, returning its last result and the fastest time.'''
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best == None else min(best, elapsed)
+    return result, best
+
+def stagePeak(function) -> float:
+    '''Peak memory, in megabytes, allocated by one run of "function" above the memory already allocated when it starts, as traced by tracemalloc.'''
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]/(1 << 20)
+    finally:
+        tracemalloc.stop()
+
+def syntheticGenome(size: int, seed: int) -> str:
+    '''Uniform random genome of length "size", drawn as bytes by numpy so that building it costs no more memory than the genome itself.'''
+    codes = numpy.random.default_rng(seed).integers(0, 4, size, dtype=numpy.uint8)
+    return numpy.frombuffer(b'ACGT', dtype=numpy.uint8)[codes].tobytes().decode('ascii')
+
+def benchmarkSize(size: int, windows: list, seed: int, repeat: int, textlimit: int) -> list:
+    '''Runs every stage of the benchmark on a synthetic genome of length "size", returning one result row per stage.'''
+    results = []
+    def measure(stage, function, bases, window = None):
+        result, seconds = timed(function, repeat)
+        rss = Profiler.peakRss()  # before the traced run, whose bookkeeping would be counted
+        results.append({'size': size, 'stage': stage, 'window': window, 'seconds': seconds, 'bases_per_s': bases/seconds if seconds > 0 else None,
+                        'stage_peak_mb': round(stagePeak(function), 1), 'peak_rss_mb': round(rss, 1)})
+        return result
+    genome = syntheticGenome(size, seed)
+    insidemod = MarkovChain(model = CpGInModel)
+    outsidemod = MarkovChain(model = CpGOutModel)
+    measure('train', lambda: MarkovChain(s = genome), size)
+    measure('scoreQuery', lambda: insidemod.scoreQuery(genome), size)
+    directory = tempfile.mkdtemp()
+    for wsize in windows:
+        if wsize > size:
+            continue
+        data, wsize = measure('evaluate', lambda: GenomeInOutWindow.evaluate(genome, insidemod, outsidemod, wsize, False), size, wsize)
+        peaks = measure('callPeaks', lambda: GenomeInOutWindow.callPeaks(data, wsize, 20), len(data), wsize)
+        trackfile = os.path.join(directory, 'scan.trk')
+        def trackRoundTrip():
+            FileHandler.writeTrack(trackfile, data, wsize, 20, peaks)
+            return float(numpy.sum(FileHandler.trackFromFile(trackfile)[0]))
+        measure('trackRoundTrip', trackRoundTrip, len(data), wsize)
+        os.remove(trackfile)
+        os.remove(trackfile+TrackPyramid.suffix)
+        if size <= textlimit:
+            textfile = os.path.join(directory, 'scan.txt')
+            def textRoundTrip():
+                FileHandler.writeEvaluation(textfile, data, wsize, 20, peaks)
+                return len(FileHandler.evaluationFromFile(textfile)[0])
+            measure('textRoundTrip', textRoundTrip, len(data), wsize)
+            os.remove(textfile)
+    os.rmdir(directory)
+    return results
+
+def startupTime(repeat: int) -> float:
+    '''Fastest wall time, over "repeat" fresh interpreters, of a query scored by cli.py with the pre-computed models.'''
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py'), 'query', '-F', '-M', 'ACGTACGTCGCGATCG']
+    def run():
+        subprocess.run(command, capture_output=True, check=True)
+    return timed(run, repeat)[1]
+
+def gitCommit() -> str:
+    '''Hash of the current commit, if the software is run from a git repository.'''
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def rowKey(row: dict) -> tuple:
+    return row['size'], row['stage'], row['window']
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    sizes = [10000, 100000, 1000000, 10000000, 50000000]
+    windows = [200, 566]
+    seed = 0
+    repeat = 3
+    textlimit = 1000000
+    output = 'benchmark.json'
+    compare = None
+    single = None
+    target = 200
+
+    for i in range(len(args)):
+        if args[i] == '--sizes':
+            sizes = [int(j) for j in args[i+1].split(',')]
+        elif args[i] == '--windows':
+            windows = [int(j) for j in args[i+1].split(',')]
+        elif args[i] == '--seed':
+            seed = int(args[i+1])
+        elif args[i] == '--repeat':
+            repeat = int(args[i+1])
+        elif args[i] == '--text-limit':
+            textlimit = int(args[i+1])
+        elif args[i] == '--output':
+            output = args[i+1]
+        elif args[i] == '--compare':
+            compare = args[i+1]
+        elif args[i] == '--startup-target':
+            target = float(args[i+1])
+        elif args[i] == '--single':
+            single = int(args[i+1])
+
+    if single != None:
+        print(json.dumps(benchmarkSize(single, windows, seed, repeat, textlimit)))
+        sys.exit()
+
+    results = []
+    print(f'{"size":>10} {"stage":>15} {"window":>6} {"seconds":>10} {"bases/s":>12} {"stage peak MB":>14} {"peak RSS MB":>12}')
+    for size in sizes:
+        command = [sys.executable, os.path.abspath(__file__), '--single', str(size), '--windows', ','.join([str(w) for w in windows]),
+                   '--seed', str(seed), '--repeat', str(repeat), '--text-limit', str(textlimit)]
+        rows = json.loads(subprocess.run(command, capture_output=True, text=True, check=True).stdout)
+        for row in rows:
+            print(f'{row["size"]:>10} {row["stage"]:>15} {str(row["window"] or ""):>6} {row["seconds"]:>10.4f} {row["bases_per_s"] or 0:>12.3g} {row["stage_peak_mb"]:>14} {row["peak_rss_mb"]:>12}')
+        results.extend(rows)
+
+    seconds = startupTime(max(repeat, 5))
+    results.append({'size': None, 'stage': 'startup', 'window': None, 'seconds': seconds, 'bases_per_s': None, 'stage_peak_mb': None, 'peak_rss_mb': None})
+    print(f'Startup time of query mode: {seconds*1000:.1f} ms, target {target:g} ms: {"met" if seconds*1000 <= target else "MISSED"}')
+
+    report = {'commit': gitCommit(), 'python': platform.python_version(), 'numpy': numpy.__version__, 'platform': platform.platform(),
+              'cpus': os.cpu_count(), 'seed': seed, 'repeat': repeat, 'startup_target_ms': target, 'results': results}
+    file = open(output, 'w')
+    json.dump(report, file, indent=1)
+    file.close()
+    print(f'Results saved in {output}')
+
+    if compare != None:
+        file = open(compare, 'r')
+        previous = {rowKey(row): row for row in json.load(file)['results']}
+        file.close()
+        print(f'Timings relative to {compare} (above 1 is slower):')
+        for row in results:
+            if rowKey(row) in previous and previous[rowKey(row)]['seconds'] > 0:
+                print(f'{str(row["size"] or ""):>10} {row["stage"]:>15} {str(row["window"] or ""):>6} {row["seconds"]/previous[rowKey(row)]["seconds"]:>8.2f}x')
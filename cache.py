@@ -0,0 +1,97 @@
+import os
+import struct
+import hashlib
+import numpy
+from markov import MarkovChain
+from utils import StandardModel
+from profiling import profiler
+
+class ModelCache:
+    '''Persistent cache of trained MarkovChain models, so that repeated runs do not need to retrain them from the same sequence files.
+    Each entry is a small binary file holding the order, the pseudo-count, the average source length and the unrounded transition
+    matrix, named after a SHA-256 hash of the training file content and of the training parameters: editing the training data or
+    changing the parameters automatically misses the old entries. Entries are evicted, least recently used first, as soon as the
+    cache exceeds "maxEntries" entries or "maxBytes" bytes on disk.'''
+    magic = b'CPGMODEL'
+    header = struct.Struct('<8sIdQ')
+    version = 1
+
+    def __init__(self, directory: str = '.model_cache', maxEntries: int = 32, maxBytes: int = 64 << 20) -> None:
+        self.directory = directory
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+
+    def key(self, path: str, order: int = 1, pseudocount: float = None) -> str:
+        '''Returns the cache key of the model trained on the file "path" with the given parameters, the pseudo-count defaulting as in MarkovChain.'''
+        if pseudocount == None:
+            pseudocount = MarkovChain.defaultPseudocount(order)
+        digest = hashlib.sha256(f'{ModelCache.version};{order};{float(pseudocount)!r};'.encode())
+        file = open(path, 'rb')
+        block = file.read(1 << 20)
+        while block:
+            digest.update(block)
+            block = file.read(1 << 20)
+        file.close()
+        return digest.hexdigest()
+
+    def load(self, path: str, order: int = 1, pseudocount: float = None) -> MarkovChain:
+        '''Returns the model trained on the file "path", reading it from the cache if present and otherwise training and storing it.'''
+        if pseudocount == None:
+            pseudocount = MarkovChain.defaultPseudocount(order)
+        with profiler.stage('model cache'):
+            key = self.key(path, order, pseudocount)
+            chain = self.get(key)
+        profiler.count('cache hits' if chain != None else 'cache misses')
+        if chain == None:
+            chain = MarkovChain(path=path, order=order, pseudocount=pseudocount)
+            self.put(key, chain)
+        return chain
+
+    def get(self, key: str) -> MarkovChain:
+        '''Returns the model stored under "key", or None if missing or unreadable; a hit marks the entry as recently used.'''
+        filename = os.path.join(self.directory, key+'.model')
+        try:
+            file = open(filename, 'rb')
+            magic, order, pseudocount, avl = ModelCache.header.unpack(file.read(ModelCache.header.size))
+            matrix = numpy.fromfile(file, dtype='<f8')
+            file.close()
+        except (OSError, struct.error):
+            return None
+        if magic != ModelCache.magic or len(matrix) != 4**(order+1):
+            return None
+        os.utime(filename)
+        model = StandardModel(matrix.reshape(4**order, 4), avl, order)
+        model.pseudocount = pseudocount
+        return MarkovChain(model=model)
+
+    def put(self, key: str, chain: MarkovChain) -> None:
+        '''Stores the model "chain" under "key", then enforces the size bounds of the cache.'''
+        os.makedirs(self.directory, exist_ok=True)
+        filename = os.path.join(self.directory, key+'.model')
+        file = open(filename+'.tmp', 'wb')
+        file.write(ModelCache.header.pack(ModelCache.magic, chain.order, chain.pseudocount, chain.average_source_length))
+        numpy.ascontiguousarray(chain.matrix, dtype='<f8').tofile(file)
+        file.close()
+        os.replace(filename+'.tmp', filename)
+        self.evict()
+
+    def evict(self) -> None:
+        '''Removes the least recently used entries until the cache respects both "maxEntries" and "maxBytes".'''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.model'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        total = sum([size for mtime, size, name in entries])
+        while len(entries) > 0 and (len(entries) > self.maxEntries or total > self.maxBytes):
+            mtime, size, name = entries.pop(0)
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+    def clear(self) -> None:
+        '''Removes every entry of the cache.'''
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith('.model'):
+                    os.remove(os.path.join(self.directory, name))
@@ -0,0 +1,279 @@
+import argparse
+
+'''
+Entry point of the software with one subcommand per operation, run as "python cli.py <subcommand> [flags]"; "python cli.py <subcommand> -h"
+lists the flags of each of them. Only argparse is imported before the subcommand is known: the scoring, training and scanning core depends
+on numpy alone and is imported by the handler of the subcommand, matplotlib only when a plot is requested and pandas only when the
+DataFrame view of a model (MarkovChain.model, CpGInModel.model) is accessed, so that a single query with the pre-computed models
+(python cli.py query -F <str>) starts in well under the target of 200 ms checked by benchmark.py (see its --startup-target flag). The subcommands are:
+
+query [<str>]: evaluates the query string, or a random row of the file declared with -f, or a random sequence of length -l with -r;
+batch <str>: evaluates all the sequences of a file (one per row, or the records of a FASTA file), printing index, length and log ratio;
+scan : scans the first record of the file declared with -f (streamed in chunks), a random fragment of it (-f -r) or a random genome (-r),
+       with the window sizes of -w (a comma separated list scans all of them at once), --strands to scan both strands (with one window size), -k for peak calling
+       in the plot of -P, --region to restrict its initial view, -S for the stringency, -j for worker processes and --save to write the tracks;
+segment <str> <str>: segments the records of a FASTA file (first path) into CpG islands by a hidden Markov model, writing the islands in
+       a BED file (second path), with --posterior for posterior instead of Viterbi decoding;
+read <str>: plots a scan saved in a file, either a binary score track or a text file from previous versions, within --region if given;
+convert <str> <str>: converts a scan saved in the old text format (first path) into a binary score track (second path);
+rescore <str> <str> <str>: updates a score track (first path) of the genome declared with -f after the variants of a VCF file (second path),
+       saving the new scan and its peaks in a binary score track (third path);
+serve : runs the resident scoring service of server.py.
+
+The flags shared by all the subcommands are -F (pre-computed models), -o (order of the models trained at runtime), --no-cache, -M (mute
+logging) and --profile [<str>], with the same meaning as in test.py, whose flag based interface is kept unchanged and translated into these subcommands.
+'''
+
+def loadModels(args) -> tuple:
+    '''Inside and outside MarkovChain models requested by the shared flags.'''
+    from markov import MarkovChain
+    if args.fast:
+        from utils import CpGInModel, CpGOutModel
+        if args.order != 1:
+            raise ValueError('FlagError: the pre-computed models are of order 1, train the models at runtime to change the order')
+        return MarkovChain(model = CpGInModel), MarkovChain(model = CpGOutModel)
+    if args.cache:
+        from cache import ModelCache
+        return ModelCache().load('CpG.txt', args.order), ModelCache().load('outside.txt', args.order)
+    return MarkovChain(path = 'CpG.txt', order = args.order), MarkovChain(path = 'outside.txt', order = args.order)
+
+def reportProfile(args) -> None:
+    '''Prints the profiling report once, before any plot is shown.'''
+    from profiling import profiler
+    if profiler.enabled:
+        profiler.disable()
+        print(profiler.report())
+        if args.profile:
+            profiler.dump(args.profile)
+            print(f'cProfile statistics saved in {args.profile}')
+
+def firstRecord(path: str) -> str:
+    from fasta import FastaReader
+    first = FastaReader.records(path)[0]
+    return ''.join([chunk for name, start, chunk in FastaReader.chunks(path) if name == first]).upper()
+
+def query(args) -> None:
+    from markov import logRatioEvaluate
+    from utils import Generator
+    if args.file != None:
+        sequence = Generator.randomSequenceFromFile(args.file)
+    elif args.sequence != None:
+        sequence = args.sequence
+    elif args.random:
+        sequence = Generator.randomSequence(args.length)
+    else:
+        raise ValueError('ArgumentError: no query sequence provided')
+    insidemod, outsidemod = loadModels(args)
+    if args.logging:
+        print(f'Evaluating query sequence: "{sequence}"')
+    insidescore = insidemod.scoreQuery(sequence, args.log)
+    outsidescore = outsidemod.scoreQuery(sequence, args.log)
+    print(f'Inside score:', insidescore)
+    print(f'Outside score:', outsidescore)
+    print(f'Final log ratio evaluation: {logRatioEvaluate(insidescore, outsidescore, args.log)}')
+
+def batch(args) -> None:
+    from markov import logRatioStream
+    from utils import Generator
+    insidemod, outsidemod = loadModels(args)
+    lengths = []
+    def sequences():
+        for sequence in Generator.sequencesFromFile(args.path):
+            lengths.append(len(sequence))
+            yield sequence
+    index = 0
+    for ratios in logRatioStream(sequences(), insidemod, outsidemod):
+        for j in range(len(ratios)):
+            print(f'{index+j}\t{lengths[j]}\t{round(ratios[j], 2)}')
+        index += len(ratios)
+        del lengths[:len(ratios)]
+
+def scan(args) -> None:
+    from markov import GenomeInOutWindow
+    from utils import Generator, FileHandler
+    if args.file != None and args.random:
+        genome = Generator.randomGenomeFromFile(args.file, args.length)
+    elif args.file != None:
+        genome = None
+    elif args.random:
+        genome = Generator.randomGenome(args.length)
+    else:
+        raise ValueError('FlagError: scan mode declared, either random generation of filepath must be declared as well')
+    insidemod, outsidemod = loadModels(args)
+    workers = args.workers or None  # 0 asks for one worker per core, which the parallel scans take as None
+    wsizes = [int(w) for w in args.window.split(',')] if args.window != None else [None]
+    if len(wsizes) > 1 and args.strands:
+        raise ValueError('FlagError: both strands are scanned with a single window size, declare only one with -w')
+    if args.logging:
+        print(f'Parameters set: filepath: {args.file}; random: {args.random}; length: {args.length}; fast: {args.fast}; plot: {args.plot}; peak call: {args.peaks}; stringency: {args.stringency}; window sizes: {[w or insidemod.average_source_length for w in wsizes]}')
+    tracks = {}
+    if len(wsizes) > 1:
+        if genome == None and not args.plot:
+            peaks, combined, nscores = GenomeInOutWindow.evaluateStreamMulti(args.file, insidemod, outsidemod, wsizes, args.stringency, args.save, args.logging)
+        else:
+            tracks, wsizes = GenomeInOutWindow.evaluateMulti(genome if genome != None else firstRecord(args.file), insidemod, outsidemod, wsizes, args.logging)
+            peaks, combined = GenomeInOutWindow.callPeaksMulti(tracks, args.stringency)
+            if args.save != None:
+                for wsize in wsizes:
+                    FileHandler.writeTrack(GenomeInOutWindow.multiTrackName(args.save, wsize), tracks[wsize], wsize, args.stringency, peaks[wsize])
+        for wsize, (call, scores) in peaks.items():
+            print(f'Window size {wsize}, potential start sites identified [position, score]: {[[call[i], scores[i]] for i in range(len(call))]}')
+        print(f'Combined start sites [position, score, window size, supporting window sizes]: {combined}')
+    elif args.strands:
+        if genome == None and not args.plot:
+            (call, scores, strand), wsize, nscores = GenomeInOutWindow.evaluateStreamStrands(args.file, insidemod, outsidemod, wsizes[0], args.stringency, args.save, args.logging)
+        else:
+            if genome == None:
+                forward, reverse, data, wsize = GenomeInOutWindow.evaluateFileStrands(args.file, insidemod, outsidemod, wsizes[0], args.logging)
+            else:
+                forward, reverse, data, wsize = GenomeInOutWindow.evaluateStrands(genome, insidemod, outsidemod, wsizes[0], args.logging)
+            call, scores, strand = GenomeInOutWindow.callPeaksStrands(forward, reverse, wsize, args.stringency)
+            if args.save != None:
+                FileHandler.writeTrack(args.save, data, wsize, args.stringency, GenomeInOutWindow.callPeaks(data, wsize, args.stringency))
+            tracks[wsize] = data
+        peaks = {wsize: (call, scores)}
+        print(f'Potential start sites identified [position, score, strand]: {[[call[i], scores[i], strand[i]] for i in range(len(call))]}')
+    else:
+        if genome == None and workers == 1 and not args.plot:
+            (call, scores), wsize, nscores = GenomeInOutWindow.evaluateStream(args.file, insidemod, outsidemod, wsizes[0], args.stringency, args.save, args.logging)
+        else:
+            if genome == None:
+                data, wsize = GenomeInOutWindow.evaluateFile(args.file, insidemod, outsidemod, wsizes[0], args.logging, workers=workers)
+            elif workers != 1:
+                data, wsize = GenomeInOutWindow.evaluateParallel(genome, insidemod, outsidemod, wsizes[0], args.logging, workers)
+            else:
+                data, wsize = GenomeInOutWindow.evaluate(genome, insidemod, outsidemod, wsizes[0], args.logging)
+            call, scores = GenomeInOutWindow.callPeaks(data, wsize, args.stringency)
+            if args.save != None:
+                FileHandler.writeTrack(args.save, data, wsize, args.stringency, (call, scores))
+            tracks[wsize] = data
+        peaks = {wsize: (call, scores)}
+        print(f'Potential start sites identified [position, score]: {[[call[i], scores[i]] for i in range(len(call))]}')
+    reportProfile(args)
+    if args.plot:
+        for wsize, data in tracks.items():
+            GenomeInOutWindow.quickPlot(data, wsize, args.stringency, peaks[wsize][0] if args.peaks else [], args.region)
+
+def segment(args) -> None:
+    from utils import FileHandler
+    from hmm import IslandHMM
+    insidemod, outsidemod = loadModels(args)
+    islands = FileHandler.writeBed(args.bed, IslandHMM(insidemod, outsidemod).segmentFile(args.fasta, posterior = args.posterior))
+    print(f'{islands} islands written in {args.bed}')
+
+def read(args) -> None:
+    from markov import GenomeInOutWindow
+    from utils import FileHandler
+    scores, l, wsize, stringency, *peaks = FileHandler.loadEvaluation(args.track)
+    reportProfile(args)
+    GenomeInOutWindow.quickPlot(scores, wsize, stringency, peaks, args.region)
+
+def convert(args) -> None:
+    from utils import FileHandler
+    FileHandler.convertEvaluation(args.text, args.track)
+
+def rescore(args) -> None:
+    from markov import GenomeInOutWindow
+    from utils import FileHandler
+    scores, l, wsize, stringency, *peaks = FileHandler.loadEvaluation(args.track)
+    reference = firstRecord(args.file)
+    insidemod, outsidemod = loadModels(args)
+    scores, (call, peakscores) = GenomeInOutWindow.rescore(scores, reference, FileHandler.variantsFromFile(args.vcf), insidemod, outsidemod, wsize, stringency, peaks)
+    FileHandler.writeTrack(args.out, scores, wsize, stringency, (call, peakscores))
+    print(f'Potential start sites identified [position, score]: {[[call[i], peakscores[i]] for i in range(len(call))]}')
+
+def serve(args) -> None:
+    import asyncio
+    import multiprocessing
+    from server import ScoringService
+    insidemod, outsidemod = loadModels(args)
+    print(f'Serving on {args.host}:{args.port}', flush=True)
+    try:
+        asyncio.run(ScoringService(insidemod, outsidemod, args.workers or multiprocessing.cpu_count(), args.max_batch, args.batch_delay/1000, args.inline, args.max_request).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+def region(value: str) -> tuple:
+    return tuple([int(j) for j in value.split(':')])
+
+def parser() -> argparse.ArgumentParser:
+    '''Parser of the command line, with one subparser per subcommand.'''
+    shared = argparse.ArgumentParser(add_help=False)
+    shared.add_argument('-F', '--fast', action='store_true', help='use the pre-computed models for CpG islands instead of the ones trained at runtime')
+    shared.add_argument('-o', '--order', type=int, default=1, help='order of the Markov chains trained at runtime (default 1, orders above 1 add a pseudo-count of 1)')
+    shared.add_argument('--no-cache', dest='cache', action='store_false', help='always train the models at runtime, ignoring and not updating the model cache')
+    shared.add_argument('-M', '--mute', dest='logging', action='store_false', help='turn off unnecessary logging')
+    shared.add_argument('--profile', nargs='?', const='', default=None, metavar='PATH', help='print the time spent in each stage, saving a cProfile run in PATH if given')
+    main = argparse.ArgumentParser(prog='cli.py', description='Scoring, scanning and segmentation of genomes with inside/outside Markov models of CpG islands.')
+    commands = main.add_subparsers(dest='command', required=True, metavar='<subcommand>')
+
+    command = commands.add_parser('query', parents=[shared], help='evaluate a query sequence')
+    command.add_argument('sequence', nargs='?', help='query string')
+    command.add_argument('-f', '--file', help='evaluate a random row of this file instead')
+    command.add_argument('-r', '--random', action='store_true', help='evaluate a random sequence instead')
+    command.add_argument('-l', '--length', type=int, default=1000, help='length of the random sequence (default 1000)')
+    command.add_argument('--no-log', dest='log', action='store_false', help='multiply the probabilities instead of summing their logarithms')
+    command.set_defaults(handler=query)
+
+    command = commands.add_parser('batch', parents=[shared], help='evaluate all the sequences of a file')
+    command.add_argument('path', help='file with one sequence per row, or FASTA file')
+    command.set_defaults(handler=batch)
+
+    command = commands.add_parser('scan', parents=[shared], help='scan a genome with sliding windows')
+    command.add_argument('-f', '--file', help='FASTA file of the genome, whose first record is scanned')
+    command.add_argument('-r', '--random', action='store_true', help='scan a random genome, or a random fragment of the file')
+    command.add_argument('-l', '--length', type=int, default=1000, help='length of the random genome or fragment (default 1000)')
+    command.add_argument('-w', '--window', help='window size, or comma separated list of window sizes (default the average island length)')
+    command.add_argument('-S', '--stringency', type=int, default=20, help='stringency of the peak calling (default 20)')
+    command.add_argument('--strands', action='store_true', help='scan both strands at once, with a single window size')
+    command.add_argument('-P', '--plot', action='store_true', help='plot the scores')
+    command.add_argument('-k', '--peaks', action='store_true', help='show the peaks in the plot')
+    command.add_argument('--region', type=region, metavar='START:END', help='initial view of the plot')
+    command.add_argument('-j', '--workers', type=int, default=1, help='number of worker processes (default 1, 0 for one per core)')
+    command.add_argument('--save', metavar='PATH', help='write the scores and peaks in a binary score track')
+    command.set_defaults(handler=scan)
+
+    command = commands.add_parser('segment', parents=[shared], help='segment a genome into CpG islands by a hidden Markov model')
+    command.add_argument('fasta', help='FASTA file of the genome')
+    command.add_argument('bed', help='BED file the islands are written in')
+    command.add_argument('--posterior', action='store_true', help='use posterior instead of Viterbi decoding')
+    command.set_defaults(handler=segment)
+
+    command = commands.add_parser('read', parents=[shared], help='plot a saved scan')
+    command.add_argument('track', help='binary score track or text file of a previous scan')
+    command.add_argument('--region', type=region, metavar='START:END', help='initial view of the plot')
+    command.set_defaults(handler=read)
+
+    command = commands.add_parser('convert', parents=[shared], help='convert a text scan into a binary score track')
+    command.add_argument('text', help='scan in the old text format')
+    command.add_argument('track', help='binary score track to write')
+    command.set_defaults(handler=convert)
+
+    command = commands.add_parser('rescore', parents=[shared], help='update a saved scan after the variants of a VCF file')
+    command.add_argument('track', help='score track of the reference genome')
+    command.add_argument('vcf', help='VCF file of the variants')
+    command.add_argument('out', help='score track to write')
+    command.add_argument('-f', '--file', required=True, help='FASTA file of the reference genome')
+    command.set_defaults(handler=rescore)
+
+    command = commands.add_parser('serve', parents=[shared], help='run the resident scoring service')
+    command.add_argument('--host', default='127.0.0.1', help='address to listen on (default 127.0.0.1)')
+    command.add_argument('--port', type=int, default=8765, help='port to listen on (default 8765)')
+    command.add_argument('-j', '--workers', type=int, default=1, help='number of worker processes for the large scans (default 1, 0 for one per core)')
+    command.add_argument('--max-batch', type=int, default=1024, help='largest number of sequences scored in one batch (default 1024)')
+    command.add_argument('--batch-delay', type=float, default=2, help='longest wait for a batch, in milliseconds (default 2)')
+    command.add_argument('--inline', type=int, default=100000, help='longest sequence scanned without the worker processes (default 100000)')
+    command.add_argument('--max-request', type=int, default=1 << 26, help='longest request line, in bytes (default 64 MiB)')
+    command.set_defaults(handler=serve)
+    return main
+
+def main(argv: list = None) -> None:
+    args = parser().parse_args(argv)
+    if args.profile != None:
+        from profiling import profiler
+        profiler.enable(cprofile = args.profile != '')
+    args.handler(args)
+    reportProfile(args)
+
+if __name__ == '__main__':
+    main()
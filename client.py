@@ -0,0 +1,120 @@
+import sys
+import json
+import socket
+
+'''
+Client of the scoring service of server.py. ScoringClient keeps one connection open and sends the requests of the service protocol,
+either one at a time or, with scoreMany, all together before reading the responses, so that they are scored in the same batches.
+From the command line, the flags that can be declared are:
+
+--host <str>: address of the service (default 127.0.0.1);
+--port <int>: port of the service (default 8765);
+-q <str>: prints the log ratio of the query string;
+-b <str>: prints the index, length and log ratio of every row of a file, all sent at once;
+-s <str>: scans the genome string and prints the peaks found;
+-w <int>: set the window size of the scan (default the one of the service);
+-S <int>: set the stringency of the peak calling (default 20);
+--stats : prints the statistics of the service.
+'''
+
+class ScoringClient:
+    '''Blocking client of the scoring service listening on "host" and "port".'''
+    def __init__(self, host: str = '127.0.0.1', port: int = 8765) -> None:
+        self.socket = socket.create_connection((host, port))
+        self.file = self.socket.makefile('rwb')
+        self.next = 0
+
+    def request(self, request: dict) -> dict:
+        '''Sends a single request and returns its response, raising the errors reported by the service as ValueError.'''
+        return self.requestMany([request])[0]
+
+    def requestMany(self, requests: list) -> list:
+        '''Sends all the requests before reading their responses, which are returned in the order of the requests.'''
+        ids = []
+        for request in requests:
+            ids.append(self.next)
+            self.file.write(json.dumps(dict(request, id=self.next)).encode()+b'\n')
+            self.next += 1
+        self.file.flush()
+        responses = {}
+        while len(responses) < len(ids):
+            line = self.file.readline()
+            if len(line) == 0:
+                raise ConnectionError('ConnectionError: the service closed the connection')
+            response = json.loads(line)
+            if 'id' not in response:
+                raise ValueError(response.get('error', 'RequestError: response without id'))
+            responses[response.pop('id')] = response
+        for response in responses.values():
+            if 'error' in response:
+                raise ValueError(response['error'])
+        return [responses[i] for i in ids]
+
+    def score(self, sequence: str) -> float:
+        '''Log ratio of the sequence on the inside and outside models of the service.'''
+        return self.request({'op': 'score', 'sequence': sequence})['ratio']
+
+    def scoreMany(self, sequences: list) -> list:
+        '''Log ratios of all the sequences, sent together so that the service scores them in batches.'''
+        return [response['ratio'] for response in self.requestMany([{'op': 'score', 'sequence': sequence} for sequence in sequences])]
+
+    def scan(self, genome: str, wsize: int = None, stringency: int = 20, scores: bool = False) -> dict:
+        '''Scans the genome, returning the window size, the peaks and their heights, and the scores if "scores" is set.'''
+        return self.request({'op': 'scan', 'sequence': genome, 'wsize': wsize, 'stringency': stringency, 'scores': scores})
+
+    def callPeaks(self, scores: list, wsize: int, stringency: int = 20) -> tuple:
+        '''Same result as GenomeInOutWindow.callPeaks, computed by the service.'''
+        response = self.request({'op': 'peaks', 'scores': list(scores), 'wsize': wsize, 'stringency': stringency})
+        return response['peaks'], response['heights']
+
+    def stats(self) -> dict:
+        return self.request({'op': 'stats'})
+
+    def close(self) -> None:
+        self.file.close()
+        self.socket.close()
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    host = '127.0.0.1'
+    port = 8765
+    query = None
+    batchpath = None
+    genome = None
+    wsize = None
+    stringency = 20
+    stats = False
+
+    for i in range(len(args)):
+        if args[i] == '--host':
+            host = args[i+1]
+        elif args[i] == '--port':
+            port = int(args[i+1])
+        elif args[i] == '-q':
+            query = args[i+1]
+        elif args[i] == '-b':
+            batchpath = args[i+1]
+        elif args[i] == '-s':
+            genome = args[i+1]
+        elif args[i] == '-w':
+            wsize = int(args[i+1])
+        elif args[i] == '-S':
+            stringency = int(args[i+1])
+        elif args[i] == '--stats':
+            stats = True
+
+    client = ScoringClient(host, port)
+    if query != None:
+        print(f'Final log ratio evaluation: {client.score(query)}')
+    if batchpath != None:
+        file = open(batchpath, 'r')
+        sequences = [line.strip() for line in file if len(line.strip()) > 0]
+        file.close()
+        for j, ratio in enumerate(client.scoreMany(sequences)):
+            print(f'{j}\t{len(sequences[j])}\t{ratio}')
+    if genome != None:
+        response = client.scan(genome, wsize, stringency)
+        print(f'Potential start sites identified [position, score]: {[[response["peaks"][i], response["heights"][i]] for i in range(len(response["peaks"]))]}')
+    if stats:
+        print(client.stats())
+    client.close()
@@ -1,70 +1,90 @@
-import random
 from matplotlib import pyplot
+from fasta import PackedGenome, FastaIndex
+
+def readAnnotation(af):
+    # parses the annotation once, as lists of tab separated fields with integer start and end, to be shared by the functions below
+    annot = open(af, 'r')
+    rows = []
+    for line in annot:
+        line = line.rstrip('\n').split('\t')
+        if len(line) >= 3:
+            line[1] = int(line[1])
+            line[2] = int(line[2])
+            rows.append(line)
+    annot.close()
+    return rows
+
+def _annotation(af):
+    return af if isinstance(af, list) else readAnnotation(af)
+
+def _recordOf(index, chrom):
+    # annotations of single sequence files may name the chromosome differently from the FASTA header
+    return chrom if chrom in index.records or len(index.names) != 1 else index.names[0]
+
+def _intervals(index, af):
+    # annotated intervals of the records present in the FASTA file, in annotation order; the chromosomes missing from it are skipped with a warning
+    intervals = [(_recordOf(index, row[0]), row[1], row[2]) for row in _annotation(af)]
+    missing = sorted(set([interval[0] for interval in intervals if interval[0] not in index.records]))
+    if len(missing) > 0:
+        print(f'Warning: chromosomes {", ".join(missing)} not found in {index.path}, their annotations are skipped')
+    return [interval for interval in intervals if interval[0] in index.records]
 
 def seqExtraction(annotationfile, sequencefile, newname):
-    af = open(annotationfile, 'r')
-    sf = open(sequencefile, 'r')
+    # the sequences are written in annotation order
+    index = FastaIndex(sequencefile)
+    intervals = _intervals(index, annotationfile)
     nf = open(newname, 'w')
-    sequence = ''.join(i.strip('\n').upper() for i in sf.readlines()[1:])
-    for line in af.readlines():
-        start = int(line.split('\t')[1])
-        end = int(line.split('\t')[2])
-        line_to_write = sequence[start:end]+'\n'
-        nf.write(line_to_write)
-    af.close()
-    sf.close()
+    for interval, sequence in index.fetchMany(intervals):
+        nf.write(sequence.upper()+'\n')
     nf.close()
 
 #seqExtraction('chr22_annot.txt', 'chr22.fa', 'CpG.txt')
 
+def buildTrainingSets(annotationfile, fasta, insidefile, outsidefile):
+    # builds the inside and outside training sets of all the chromosomes of a genome in one streaming pass over the annotated intervals:
+    # each island is read by seeking through the FASTA index and paired with a random island-sized fragment free of unassigned bases
+    index = FastaIndex(fasta)
+    intervals = _intervals(index, annotationfile)
+    inside = open(insidefile, 'w')
+    outside = open(outsidefile, 'w')
+    for interval, sequence in index.fetchMany(intervals):
+        if len(sequence) == 0:
+            continue
+        inside.write(sequence.upper()+'\n')
+        outside.write(index.randomFragment(len(sequence))[2]+'\n')
+    inside.close()
+    outside.close()
+
+#buildTrainingSets('annot.txt', 'hg19.fa', 'CpG.txt', 'outside.txt')
+
 def correctLocations(af, nf):
-    annot = open(af, 'r')
+    rows = _annotation(af)
     newf = open(nf, 'a')
-    lines = annot.readlines()
-    ref = int(lines[0].split('\t')[1])
-    for i in lines:
-        line = i.split('\t')
-        line[1] = str(int(line[1]) - ref)
-        line[2] = str(int(line[2]) - ref)
-        newf.write('\t'.join(line))
-    annot.close()
+    ref = rows[0][1]
+    for row in rows:
+        line = [str(i) for i in row]
+        line[1] = str(row[1] - ref)
+        line[2] = str(row[2] - ref)
+        newf.write('\t'.join(line)+'\n')
     newf.close()
 
 #correctLocations('chr22_annot.txt', 'chr22_annot_corrected.txt')
 
 def generateRandomSequences(fasta, cpgfile, nf):
-    sf = open(fasta, 'r')
+    genome = PackedGenome.load(fasta)
     cpgislnds = open(cpgfile, 'r')
     outside = open(nf, 'a')
-
-    sequence = ''.join(i.strip('\n').upper() for i in sf.readlines()[1:])
-    gsize = len(sequence)
     for line in cpgislnds.readlines():
         line = line.strip('\n')
-        lsize = len(line)
-        rsp = random.randint(0, gsize-1-lsize)
-        if 'N' not in sequence[rsp:rsp+lsize]:
-            outside.write(sequence[rsp:rsp+lsize])
-            outside.write('\n')
-        else:
-            while 'N' in sequence[rsp:rsp+lsize]:
-                rsp = random.randint(0, gsize-1-lsize)
-                if 'N' not in sequence[rsp:rsp+lsize]:
-                    outside.write(sequence[rsp:rsp+lsize])
-                    outside.write('\n')
-    sf.close()
+        outside.write(genome.randomFragment(len(line)))
+        outside.write('\n')
     cpgislnds.close()
     outside.close()
 
 #generateRandomSequences('chr22.fa', 'CpG.txt', 'outside.txt')
 
 def plot_annotated_cpg(af):
-    annot = open(af, 'r')
-    sites = []
-    for line in annot.readlines():
-        line = line[:-1].split('\t')
-        sites.append(line[1])
-    annot.close()
+    sites = [row[1] for row in _annotation(af)]
     pyplot.plot()
     for i in sites:
         pyplot.axvline(i, color = 'red', linewidth = 0.4)
@@ -0,0 +1,383 @@
+import os
+import time
+import random
+import numpy
+from profiling import profiler
+
+class FastaReader:
+    '''Streaming access to FASTA files, which avoids loading whole chromosomes or genomes as a single string. Files with
+    several records are supported, as well as plain sequence files without any header, read as a single unnamed record.'''
+    @staticmethod
+    def chunks(path: str, chunksize: int = 1 << 22, overlap: int = 0):
+        '''Generator yielding the sequence content of the file "path" in chunks, as tuples (record name, start position of the chunk
+        in the record, chunk string). Every chunk holds "chunksize" new bases followed by the first "overlap" bases of the next chunk,
+        so that with an overlap of wsize-1 each window of length wsize lies entirely in exactly one chunk. Chunks never span two records,
+        and the case of the bases is preserved.'''
+        source = FastaReader._chunks(path, chunksize, overlap)
+        return FastaReader._profiled(source) if profiler.enabled else source
+
+    @staticmethod
+    def _profiled(source):
+        '''Passes on the chunks of "source", reporting the time spent reading them and the number of bases read to the profiler.'''
+        reached = 0
+        while True:
+            clock = time.perf_counter()
+            chunk = next(source, None)
+            profiler.addTime('read FASTA', time.perf_counter()-clock)
+            if chunk == None:
+                return
+            name, start, sequence = chunk
+            profiler.count('bases read', start+len(sequence)-(reached if start > 0 else 0))
+            reached = start+len(sequence)
+            yield chunk
+
+    @staticmethod
+    def _chunks(path: str, chunksize: int, overlap: int):
+        if chunksize < 1 or overlap < 0:
+            raise ValueError('ArgumentError: chunk size must be positive and overlap non-negative')
+        name = ''
+        buffer = []
+        buffered = 0
+        start = 0
+        file = open(path, 'r')
+        for line in file:
+            if line.startswith('>'):
+                if buffered > overlap or (start == 0 and buffered > 0):
+                    yield name, start, ''.join(buffer)
+                name = line[1:].split(maxsplit=1)[0] if len(line) > 2 else ''
+                buffer = []
+                buffered = 0
+                start = 0
+                continue
+            line = line.rstrip('\r\n')
+            buffer.append(line)
+            buffered += len(line)
+            if buffered >= chunksize+overlap:
+                data = ''.join(buffer)
+                while len(data) >= chunksize+overlap:
+                    yield name, start, data[:chunksize+overlap]
+                    data = data[chunksize:]
+                    start += chunksize
+                buffer = [data]
+                buffered = len(data)
+        file.close()
+        if buffered > overlap or (start == 0 and buffered > 0):
+            yield name, start, ''.join(buffer)
+
+    @staticmethod
+    def records(path: str) -> list:
+        '''Returns the names of the records of the file "path", in order of appearance.'''
+        names = []
+        file = open(path, 'r')
+        for line in file:
+            if line.startswith('>'):
+                names.append(line[1:].split(maxsplit=1)[0] if len(line) > 2 else '')
+        file.close()
+        return names if len(names) > 0 else ['']
+
+
+class PackedGenome:
+    '''Compact in-memory representation of the sequence content of a FASTA file, holding 2 bits per base (four bases per byte) instead of
+    the byte per base of a string. The bases which are not A, C, G or T are recorded as a sorted index of unassigned runs, and lowercase
+    bases as a sorted index of soft-masked runs, so that any slice can be rebuilt exactly. The records are laid out one after the other in
+    a single global coordinate system, their starts being kept in "starts". The representation is built once from the FASTA file and saved
+    next to it, from where load retrieves it on the following runs.'''
+    suffix = '.packed.npz'
+    letters = numpy.frombuffer(b'ACGT', dtype=numpy.uint8)
+
+    def __init__(self, names: list, starts: numpy.ndarray, packed: numpy.ndarray, nRuns: tuple, maskRuns: tuple) -> None:
+        self.names = list(names)
+        self.starts = numpy.asarray(starts, dtype=numpy.int64)
+        self.length = int(self.starts[-1]) if len(self.starts) > 0 else 0
+        self.packed = packed
+        self.nStarts, self.nEnds = nRuns
+        self.maskStarts, self.maskEnds = maskRuns
+        self.fragments = {}
+        breaks = numpy.unique(numpy.concatenate((self.nStarts, self.nEnds, self.starts)))
+        inside = numpy.ones(max(len(breaks)-1, 0), dtype=bool)
+        segmentStarts, segmentEnds = breaks[:-1], breaks[1:]
+        if len(self.nStarts) > 0:
+            run = numpy.searchsorted(self.nStarts, segmentStarts, 'right') - 1
+            inside = (run < 0) | (self.nEnds[numpy.maximum(run, 0)] <= segmentStarts)
+        self.segmentStarts, self.segmentEnds = segmentStarts[inside], segmentEnds[inside]
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, key: slice) -> str:
+        start, end, step = key.indices(self.length)
+        return self.fetch(start, end)
+
+    @staticmethod
+    def _runs(mask: numpy.ndarray, offset: int) -> tuple:
+        '''Returns the start and end positions, shifted by "offset", of the runs of True values of the boolean array "mask".'''
+        steps = numpy.diff(mask.view(numpy.int8), prepend=numpy.int8(0), append=numpy.int8(0))
+        return numpy.flatnonzero(steps == 1)+offset, numpy.flatnonzero(steps == -1)+offset
+
+    @staticmethod
+    def _merge(starts: list, ends: list) -> tuple:
+        '''Concatenates the runs found in consecutive chunks, joining the ones which continue across a chunk boundary.'''
+        starts = numpy.concatenate(starts) if len(starts) > 0 else numpy.zeros(0, dtype=numpy.int64)
+        ends = numpy.concatenate(ends) if len(ends) > 0 else numpy.zeros(0, dtype=numpy.int64)
+        joined = starts[1:] == ends[:-1]
+        return numpy.delete(starts, numpy.flatnonzero(joined)+1).astype(numpy.int64), numpy.delete(ends, numpy.flatnonzero(joined)).astype(numpy.int64)
+
+    @staticmethod
+    def fromFasta(path: str, chunksize: int = 1 << 22) -> 'PackedGenome':
+        '''Builds the packed representation of the FASTA file "path", streaming it in chunks of "chunksize" bases.'''
+        from utils import Encoder
+        names, starts = [], []
+        packed, nStarts, nEnds, maskStarts, maskEnds = [], [], [], [], []
+        carry = numpy.zeros(0, dtype=numpy.uint8)
+        position = 0
+        for name, start, chunk in FastaReader.chunks(path, chunksize):
+            if start == 0:
+                names.append(name)
+                starts.append(position)
+            raw = numpy.frombuffer(chunk.encode('ascii', 'replace'), dtype=numpy.uint8)
+            codes = Encoder.table[raw]
+            for runs, mask in ((nStarts, nEnds), codes > 3), ((maskStarts, maskEnds), (raw >= 97) & (raw <= 122)):
+                found = PackedGenome._runs(mask, position)
+                runs[0].append(found[0])
+                runs[1].append(found[1])
+            codes = numpy.concatenate((carry, codes & 3))
+            full = len(codes) - len(codes) % 4
+            quads = codes[:full].reshape(-1, 4)
+            packed.append((quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3])
+            carry = codes[full:]
+            position += len(chunk)
+        if len(carry) > 0:
+            quad = numpy.zeros(4, dtype=numpy.uint8)
+            quad[:len(carry)] = carry
+            packed.append(numpy.array([(quad[0] << 6) | (quad[1] << 4) | (quad[2] << 2) | quad[3]], dtype=numpy.uint8))
+        starts.append(position)
+        packed = numpy.concatenate(packed) if len(packed) > 0 else numpy.zeros(0, dtype=numpy.uint8)
+        return PackedGenome(names, numpy.array(starts), packed, PackedGenome._merge(nStarts, nEnds), PackedGenome._merge(maskStarts, maskEnds))
+
+    def save(self, path: str) -> None:
+        '''Writes the packed genome to the file "path".'''
+        file = open(path, 'wb')
+        numpy.savez(file, names=numpy.array(self.names, dtype=str), starts=self.starts, packed=self.packed,
+                    nStarts=self.nStarts, nEnds=self.nEnds, maskStarts=self.maskStarts, maskEnds=self.maskEnds)
+        file.close()
+
+    @staticmethod
+    def load(path: str) -> 'PackedGenome':
+        '''Returns the packed genome of the FASTA file "path", reading it from the file saved next to it if this is up to date, and
+        otherwise building it from the FASTA file and saving it for the next time.'''
+        packedpath = path+PackedGenome.suffix
+        with profiler.stage('load packed genome'):
+            if os.path.exists(packedpath) and os.path.getmtime(packedpath) >= os.path.getmtime(path):
+                data = numpy.load(packedpath)
+                return PackedGenome(data['names'].tolist(), data['starts'], data['packed'], (data['nStarts'], data['nEnds']), (data['maskStarts'], data['maskEnds']))
+            genome = PackedGenome.fromFasta(path)
+            genome.save(packedpath)
+            return genome
+
+    def record(self, name: str) -> tuple:
+        '''Returns the global start and end positions of the record "name".'''
+        i = self.names.index(name)
+        return int(self.starts[i]), int(self.starts[i+1])
+
+    def fetchCodes(self, start: int, end: int) -> numpy.ndarray:
+        '''Returns the bases from the global position "start" to "end" as the codes of utils.Encoder, unassigned bases being coded as 4.'''
+        start, end = max(start, 0), min(end, self.length)
+        if end <= start:
+            return numpy.zeros(0, dtype=numpy.uint8)
+        shifts = numpy.array([6, 4, 2, 0], dtype=numpy.uint8)
+        codes = ((self.packed[start//4:(end+3)//4, None] >> shifts) & 3).ravel()[start%4:start%4+end-start]
+        for i in range(numpy.searchsorted(self.nEnds, start, 'right'), numpy.searchsorted(self.nStarts, end, 'left')):
+            codes[max(self.nStarts[i]-start, 0):self.nEnds[i]-start] = 4
+        return codes
+
+    def fetch(self, start: int, end: int, record: str = None, soft: bool = False) -> str:
+        '''Returns the sequence from "start" to "end", positions being relative to the record "record" if provided and global otherwise.
+        Unassigned bases are returned as N, and soft-masked bases in lowercase if "soft" is set.'''
+        if record != None:
+            offset, recordEnd = self.record(record)
+            start, end = offset+start, min(offset+end, recordEnd)
+        start, end = max(start, 0), min(end, self.length)
+        codes = self.fetchCodes(start, end)
+        letters = numpy.append(PackedGenome.letters, numpy.uint8(ord('N')))[codes]
+        if soft:
+            for i in range(numpy.searchsorted(self.maskEnds, start, 'right'), numpy.searchsorted(self.maskStarts, end, 'left')):
+                part = letters[max(self.maskStarts[i]-start, 0):self.maskEnds[i]-start]
+                part |= 32
+        return letters.tobytes().decode('ascii')
+
+    def sample(self, l: int) -> int:
+        '''Draws, uniformly among all the fragments of length "l" free of unassigned bases and lying in a single record, the global start
+        of one of them (see sampleSegments).'''
+        return sampleSegments(self.segmentStarts, self.segmentEnds, self.fragments, l)
+
+    def randomFragment(self, l: int) -> str:
+        '''Returns a random fragment of length "l" free of unassigned bases, drawn as in sample.'''
+        start = self.sample(l)
+        return self.fetch(start, start+l)
+
+
+def sampleSegments(starts: numpy.ndarray, ends: numpy.ndarray, fragments: dict, l: int) -> int:
+    '''Draws, uniformly among all the fragments of length "l" lying within one of the segments from "starts" to "ends", the start of one of them.
+    The cumulative count of the fragments of each length is computed once and kept in "fragments", after which each draw is a binary search.'''
+    if l not in fragments:
+        fragments[l] = numpy.cumsum(numpy.maximum(ends - starts - l + 1, 0))
+    cumulative = fragments[l]
+    if len(cumulative) == 0 or cumulative[-1] == 0:
+        raise ValueError('GenomeLengthError: no fragment of the requested length free of unassigned bases')
+    r = random.randrange(int(cumulative[-1]))
+    i = int(numpy.searchsorted(cumulative, r, 'right'))
+    return int(starts[i]) + r - (int(cumulative[i-1]) if i > 0 else 0)
+
+
+class FastaIndex:
+    '''Random access to the records of a FASTA file through an index in the .fai format of samtools faidx, storing for each record its name,
+    length, the byte offset of its first base and the number of bases and bytes per line. The index is built in one pass, saved next to the
+    FASTA file and reused while up to date, after which any interval is read by seeking straight to it, without loading the records.
+    Records are required to have lines of the same length, except for the last one, as for samtools. The stretches free of unassigned bases,
+    from which the random fragments are drawn, are indexed in the same way in the file "path".gaps.npz on the first draw.'''
+    suffix = '.gaps.npz'
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        indexpath = path+'.fai'
+        if not os.path.exists(indexpath) or os.path.getmtime(indexpath) < os.path.getmtime(path):
+            FastaIndex.build(path)
+        self.records = {}
+        self.names = []
+        file = open(indexpath, 'r')
+        for line in file:
+            name, length, offset, linebases, linewidth = line.rstrip('\n').split('\t')[:5]
+            self.records[name] = (int(length), int(offset), int(linebases), int(linewidth))
+            self.names.append(name)
+        file.close()
+        self.starts = numpy.cumsum([0]+[self.records[name][0] for name in self.names])
+        self.segmentStarts = self.segmentEnds = None
+        self.fragments = {}
+
+    @staticmethod
+    def build(path: str) -> None:
+        '''Writes the index of the FASTA file "path" in the file "path".fai.'''
+        entries = []
+        file = open(path, 'rb')
+        offset = 0
+        current = None
+        for line in file:
+            if line.startswith(b'>'):
+                if current != None:
+                    entries.append(current)
+                current = [line[1:].split(maxsplit=1)[0].decode() if len(line.strip()) > 1 else '', 0, offset+len(line), 0, 0, False]
+            elif current != None:
+                bases = len(line.rstrip(b'\r\n'))
+                if current[5] or (current[3] > 0 and bases > current[3]):
+                    file.close()
+                    raise ValueError(f'FormatError: record {current[0]} of {path} has lines of different lengths')
+                if current[3] == 0:
+                    current[3], current[4] = bases, len(line)
+                elif bases < current[3]:
+                    current[5] = True
+                current[1] += bases
+            offset += len(line)
+        file.close()
+        if current != None:
+            entries.append(current)
+        index = open(path+'.fai', 'w')
+        for name, length, start, linebases, linewidth, last in entries:
+            index.write(f'{name}\t{length}\t{start}\t{linebases}\t{linewidth}\n')
+        index.close()
+
+    def _offset(self, name: str, position: int) -> int:
+        '''Byte offset in the file of the base at "position" of the record "name".'''
+        length, offset, linebases, linewidth = self.records[name]
+        return offset + (position // linebases)*linewidth + position % linebases if linebases > 0 else offset
+
+    def _read(self, file, name: str, start: int, end: int) -> str:
+        '''Reads the bases from "start" to "end" of the record "name" from the open binary file "file".'''
+        length = self.records[name][0]
+        start, end = max(start, 0), min(end, length)
+        if end <= start:
+            return ''
+        first = self._offset(name, start)
+        file.seek(first)
+        return file.read(self._offset(name, end-1)+1-first).translate(None, b'\r\n').decode('ascii')
+
+    def fetch(self, name: str, start: int, end: int) -> str:
+        '''Returns the bases from "start" to "end" (0-based, end excluded) of the record "name".'''
+        file = open(self.path, 'rb')
+        sequence = self._read(file, name, start, end)
+        file.close()
+        return sequence
+
+    def fetchMany(self, intervals, buffer: int = 1 << 26):
+        '''Generator fetching a batch of intervals, given as tuples whose first three fields are the record name, the start and the end,
+        such as the rows of a BED or annotation file. The intervals are read sorted by record, in file order, and by start, through a single
+        open file, so that the reads proceed forwards through the file, but they are yielded in the order given, each together with its sequence:
+        the sequences read ahead of their turn are held until then, which costs nothing for intervals already in coordinate order. At most
+        "buffer" bases are held: beyond them, the intervals due next are read straight away, seeking back in the file, until the held ones fit again.'''
+        intervals = list(intervals)
+        missing = sorted(set([interval[0] for interval in intervals if interval[0] not in self.records]))
+        if len(missing) > 0:
+            raise ValueError(f'RecordError: records {", ".join(missing)} not found in {self.path}')
+        order = {name: i for i, name in enumerate(self.names)}
+        pending = {}
+        held = 0
+        following = 0
+        file = open(self.path, 'rb')
+        for i in sorted(range(len(intervals)), key=lambda i: (order[intervals[i][0]], intervals[i][1], intervals[i][2])):
+            if i < following:
+                continue  # already read out of order to keep the held sequences within the buffer
+            pending[i] = self._read(file, intervals[i][0], intervals[i][1], intervals[i][2])
+            held += len(pending[i])
+            while following in pending or (held > buffer and following < len(intervals)):
+                if following in pending:
+                    sequence = pending.pop(following)
+                    held -= len(sequence)
+                else:
+                    sequence = self._read(file, intervals[following][0], intervals[following][1], intervals[following][2])
+                yield intervals[following], sequence
+                following += 1
+        file.close()
+
+    def _segments(self) -> tuple:
+        '''Global start and end positions of the stretches free of unassigned bases, the records being laid out one after the other in file order
+        as in PackedGenome, so that no stretch crosses two records. They are found in one streaming pass over the file and saved next to it.'''
+        if self.segmentStarts is None:
+            segmentpath = self.path+FastaIndex.suffix
+            if os.path.exists(segmentpath) and os.path.getmtime(segmentpath) >= os.path.getmtime(self.path):
+                data = numpy.load(segmentpath)
+                self.segmentStarts, self.segmentEnds = data['starts'], data['ends']
+            else:
+                from utils import Encoder
+                segmentStarts, segmentEnds = [], []
+                starts, ends = [], []
+                record = -1
+                for name, start, chunk in FastaReader.chunks(self.path):
+                    if start == 0:
+                        # runs are only joined across the chunks of the same record
+                        segmentStarts.append(starts)
+                        segmentEnds.append(ends)
+                        starts, ends = [], []
+                        record = self.names.index(name, record+1)  # records without bases yield no chunk
+                    valid = Encoder.table[numpy.frombuffer(chunk.encode('ascii', 'replace'), dtype=numpy.uint8)] < 4
+                    found = PackedGenome._runs(valid, int(self.starts[record])+start)
+                    starts.append(found[0])
+                    ends.append(found[1])
+                segmentStarts.append(starts)
+                segmentEnds.append(ends)
+                merged = [PackedGenome._merge(starts, ends) for starts, ends in zip(segmentStarts, segmentEnds)]
+                self.segmentStarts = numpy.concatenate([starts for starts, ends in merged])
+                self.segmentEnds = numpy.concatenate([ends for starts, ends in merged])
+                file = open(segmentpath, 'wb')
+                numpy.savez(file, starts=self.segmentStarts, ends=self.segmentEnds)
+                file.close()
+        return self.segmentStarts, self.segmentEnds
+
+    def randomFragment(self, l: int) -> tuple:
+        '''Draws a random fragment of length "l" free of unassigned bases, uniformly among all the ones lying in a single record, as
+        PackedGenome.sample does, returning the record name, the start and the fragment.'''
+        start = sampleSegments(*self._segments(), self.fragments, l)
+        record = int(numpy.searchsorted(self.starts, start, 'right')) - 1
+        start -= int(self.starts[record])
+        file = open(self.path, 'rb')
+        fragment = self._read(file, self.names[record], start, start+l).upper()
+        file.close()
+        return self.names[record], start, fragment
@@ -0,0 +1,231 @@
+import numpy
+from markov import MarkovChain, GenomeInOutWindow
+from utils import Encoder
+from fasta import FastaReader, PackedGenome
+from profiling import profiler
+
+class IslandHMM:
+    '''Two-state hidden Markov model of CpG islands, segmenting a genome into inside and outside stretches without any window size.
+    The emissions of each state are the transition probabilities of the inside and outside MarkovChain models, so that only their log-odds
+    (see GenomeInOutWindow.logOddsTable) enter the decoding, unassigned nucleotides being neutral as in the scans, as well as the transitions impossible
+    on both models; a transition impossible on one model only has an infinite log-odds, which forces the base into the state of the other model. An island is left after
+    "islandLength" bases on average (by default the average source length of the inside model) and entered after "spacing" bases of outside sequence.
+    Both Viterbi and posterior decoding are written as recurrences on the difference of the log scores of the two states, whose steps compose
+    into maps of the same form, so that they are solved by the blocked scans below with numpy operations over blocks instead of a loop per base.'''
+    def __init__(self, inmod: MarkovChain, outmod: MarkovChain, islandLength: int = None, spacing: int = 100000) -> None:
+        if islandLength == None:
+            islandLength = inmod.average_source_length
+        if islandLength < 2 or spacing < 2:
+            raise ValueError('ArgumentError: the expected island length and spacing must be at least 2')
+        self.table = GenomeInOutWindow.logOddsTable(inmod, outmod)
+        self.order = inmod.order
+        self.islandLength = islandLength
+        self.spacing = spacing
+        p, q = 1/islandLength, 1/spacing
+        self.stay, self.enter, self.leave, self.away = numpy.log(1-p), numpy.log(q), numpy.log(p), numpy.log(1-q)
+        self.prior = numpy.log(q) - numpy.log(p)  # log ratio of the stationary probabilities of the two states, used at the first base
+
+    def emissions(self, codes: numpy.ndarray, start: int = 0) -> numpy.ndarray:
+        '''Returns the log-odds of the emission of each base of "codes", which are the encoded bases of a record starting at position "start" minus
+        the order of the models (or at 0), so that each base but the first k of the record comes with its context.'''
+        scores = GenomeInOutWindow.transitionScores(codes, self.table)
+        scores[numpy.isnan(scores)] = 0.0
+        if start == 0:
+            scores = numpy.concatenate((numpy.zeros(min(self.order, len(codes))), scores))
+        return scores
+
+    def viterbiChunks(self, chunks):
+        '''Viterbi decoding of a stream of (record name, start position, sequence) chunks overlapping by the order of the models, such as the ones
+        of FastaReader.chunks, yielding the islands of the most probable path as (record name, start, end) intervals, end excluded, as soon as
+        they are closed. The difference of the Viterbi scores of the two states is carried between chunks; since by the clamp of the recurrence
+        every base whose difference is large (small) enough lies inside (outside) the path whatever follows, the traceback needs no stored pointers.'''
+        lower, upper = self.enter - self.stay, self.away - self.leave
+        record = None
+        for name, start, chunk in chunks:
+            if start == 0:
+                if record != None:
+                    yield from self._closeRecord(record)
+                record = {'name': name, 'score': None, 'position': -1, 'state': None, 'island': None, 'end': 0}
+            with profiler.stage('hmm decoding'):
+                scores = self.emissions(Encoder.encode(chunk), start)
+                first = record['end']
+                if record['score'] == None:
+                    initial = self.prior + scores[:1]
+                    difference = numpy.concatenate((initial, _clampScan(scores[1:]+self.stay-self.away, scores[1:]+self.enter-self.away,
+                                                                          scores[1:]+self.stay-self.leave, initial[0]))) if len(scores) > 0 else scores
+                else:
+                    difference = _clampScan(scores+self.stay-self.away, scores+self.enter-self.away, scores+self.stay-self.leave, record['score'])
+            profiler.count('bases decoded', len(scores))
+            if len(difference) == 0:
+                continue
+            record['score'] = float(difference[-1])
+            record['end'] = first + len(difference)
+            forced = numpy.flatnonzero((difference >= upper) | (difference < lower))
+            yield from self._switch(record, first+forced, difference[forced] >= upper)
+        if record != None:
+            yield from self._closeRecord(record)
+
+    def _closeRecord(self, record: dict):
+        # the last base of the record is in the state with the best final score, which decides the path after the last forced base
+        if record['end'] > 0:
+            yield from self._switch(record, numpy.array([record['end']-1]), numpy.array([record['score'] >= 0]))
+            if record['state']:
+                yield record['name'], record['island'], record['end']
+
+    def _switch(self, record: dict, positions: numpy.ndarray, states: numpy.ndarray):
+        # every base takes the state of the next base whose state is forced, so the path switches right after a forced base followed by a different one
+        if len(positions) == 0:
+            return
+        if record['state'] == None:
+            record['state'] = bool(states[0])
+            record['island'] = 0 if record['state'] else None
+        positions = numpy.concatenate(([record['position']], positions))
+        states = numpy.concatenate(([record['state']], states))
+        for m in numpy.flatnonzero(states[1:] != states[:-1]):
+            if states[m+1]:
+                record['island'] = int(positions[m]) + 1
+            else:
+                yield record['name'], record['island'], int(positions[m]) + 1
+        record['position'] = int(positions[-1])
+        record['state'] = bool(states[-1])
+
+    def viterbi(self, sequence: str, name: str = '') -> list:
+        '''Viterbi islands of a single sequence, as a list of (name, start, end) intervals.'''
+        return list(self.viterbiChunks([(name, 0, sequence)]))
+
+    def posteriorChunks(self, fetch, length: int, chunksize: int = 1 << 22):
+        '''Posterior decoding of a record of "length" bases whose encoded bases are returned by fetch(start, end), yielding from the last chunk of
+        "chunksize" bases to the first a tuple (start position, log-odds of the posterior probability of being inside an island for each base).
+        The forward pass only keeps the forward log ratio at the chunk boundaries, from which each chunk is recomputed during the backward pass,
+        so that memory stays bounded by the chunk size whatever the length of the record.'''
+        k = self.order
+        bounds = list(range(0, length, chunksize)) + [length]
+        def scoresOf(a, b):
+            return self.emissions(fetch(max(a-k, 0), b), a)
+        # the matrices of both recurrences are divided by the emission when it is positive, which keeps them finite when it is infinite
+        def forward(scores, previous, last = False):
+            gain, loss = numpy.minimum(scores, 0), -numpy.maximum(scores, 0)
+            return _mobiusScan(gain+self.stay, gain+self.enter, loss+self.leave, loss+self.away, previous, last)
+        def backward(scores, following):
+            gain, loss = numpy.minimum(scores, 0), -numpy.maximum(scores, 0)
+            return _mobiusScan(gain+self.stay, loss+self.leave, gain+self.enter, loss+self.away, following)
+        checkpoints = []
+        previous = self.prior  # the stationary ratio is a fixed point of the transitions, so the first step yields the prior plus the first emission
+        with profiler.stage('hmm decoding'):
+            for a, b in zip(bounds[:-1], bounds[1:]):
+                checkpoints.append(previous)
+                previous = float(forward(scoresOf(a, b), previous, True)[-1])
+        following = None
+        for c in range(len(bounds)-2, -1, -1):
+            a, b = bounds[c], bounds[c+1]
+            with profiler.stage('hmm decoding'):
+                scores = scoresOf(a, min(b+1, length))  # one more base for the backward step entering the chunk from the next one
+                last = 0.0 if b == length else float(backward(scores[-1:], following)[0])
+                betas = numpy.concatenate((backward(scores[1:b-a][::-1], last)[::-1], [last]))
+                odds = forward(scores[:b-a], checkpoints[c]) + betas
+                following = float(betas[0])
+            profiler.count('bases decoded', b-a)
+            yield a, odds
+
+    def posterior(self, sequence: str) -> numpy.ndarray:
+        '''Posterior probability of each base of "sequence" of lying inside an island.'''
+        codes = Encoder.encode(sequence)
+        odds = numpy.concatenate([odds for start, odds in self.posteriorChunks(lambda a, b: codes[a:b], len(codes))][::-1]) if len(codes) > 0 else numpy.zeros(0)
+        return 1/(1+numpy.exp(-odds))
+
+    def posteriorIslands(self, name: str, fetch, length: int, threshold: float = 0.5, chunksize: int = 1 << 22) -> list:
+        '''Islands of a record by posterior decoding (see posteriorChunks), as the (record name, start, end) intervals of the bases whose posterior
+        probability of lying inside an island exceeds "threshold".'''
+        cutoff = numpy.log(threshold) - numpy.log(1-threshold)
+        islands = []
+        for start, odds in self.posteriorChunks(fetch, length, chunksize):
+            inside = numpy.concatenate(([False], odds > cutoff, [False]))
+            edges = numpy.flatnonzero(inside[1:] != inside[:-1]) + start
+            for a, b in zip(edges[-2::-2], edges[::-1][::2]):
+                if len(islands) > 0 and islands[-1][1] == b:
+                    islands[-1][1] = int(a)
+                else:
+                    islands.append([name, int(a), int(b)])
+        return [tuple(island) for island in islands[::-1]]
+
+    def segmentFile(self, path: str, records: list = None, posterior: bool = False, threshold: float = 0.5, chunksize: int = 1 << 22):
+        '''Segments all the records of the FASTA file "path" (or only the ones named in "records"), yielding the islands as (record name, start, end)
+        intervals in file order, to be written for example by FileHandler.writeBed. Viterbi decoding streams the file in chunks of "chunksize" bases;
+        posterior decoding reads each record twice, forward and backward, from the packed genome of the file (see PackedGenome), built on the first use.'''
+        if chunksize <= self.order:
+            raise ValueError('ArgumentError: the chunk size must exceed the order of the models')
+        if not posterior:
+            yield from self.viterbiChunks((name, start, chunk) for name, start, chunk in FastaReader.chunks(path, chunksize, self.order) if records == None or name in records)
+            return
+        genome = PackedGenome.load(path)
+        for name in genome.names:
+            if records == None or name in records:
+                start, end = genome.record(name)
+                yield from self.posteriorIslands(name, lambda a, b: genome.fetchCodes(start+a, start+b), end-start, threshold, chunksize)
+
+
+def _blockedScan(steps: tuple, identity: tuple, compose, apply, initial: float, last: bool = False) -> numpy.ndarray:
+    '''Solves the recurrence x[i+1] = apply(steps[i], x[i]) from x[0] = "initial", returning x[1], x[2], ..., where "steps" is a tuple of arrays holding
+    the parameters of the step maps, "identity" the parameters of the identity map and compose(first, second) the parameters of the map applying
+    "first" and then "second". The steps are laid out as a grid of about sqrt(n) blocks of sqrt(n) steps: the maps of all the blocks are composed
+    together column by column, the value entering each block is then propagated from block to block, and finally all the blocks are advanced
+    together from their entering values, so that the work is linear while every loop runs only about sqrt(n) times over numpy arrays.
+    If "last" is set, only the final value is computed and returned, which skips the last stage.'''
+    n = len(steps[0])
+    if n == 0:
+        return numpy.zeros(0)
+    size = max(int(numpy.sqrt(n)), 1)
+    blocks = -(-n//size)
+    # the grid is stored transposed, so that the steps of the same column of all the blocks are contiguous
+    grid = [numpy.concatenate((step, numpy.full(blocks*size-n, value))).reshape(blocks, size).T.copy() for step, value in zip(steps, identity)]
+    maps = tuple([numpy.full(blocks, value) for value in identity])
+    for j in range(size):
+        maps = compose(maps, tuple([column[j] for column in grid]))
+    entering = numpy.empty(blocks)
+    x = initial
+    for b in range(blocks):
+        entering[b] = x
+        x = apply(tuple([value[b] for value in maps]), x)
+    if last:
+        return numpy.array([x])
+    values = numpy.empty((size, blocks))
+    x = entering
+    for j in range(size):
+        x = apply(tuple([column[j] for column in grid]), x)
+        values[j] = x
+    return values.T.ravel()[:n]
+
+def _clampCompose(first: tuple, second: tuple) -> tuple:
+    shift, low, high = first
+    return shift+second[0], numpy.clip(low+second[0], second[1], second[2]), numpy.clip(high+second[0], second[1], second[2])
+
+def _clampApply(step: tuple, x):
+    return numpy.minimum(numpy.maximum(x+step[0], step[1]), step[2])
+
+def _clampScan(shift: numpy.ndarray, low: numpy.ndarray, high: numpy.ndarray, initial: float) -> numpy.ndarray:
+    '''Blocked scan of the maps x -> min(max(x+shift, low), high), closed under composition, which make up the Viterbi recurrence.
+    The steps of an infinite emission have an infinite shift and equal bounds, so they are the constant maps to their bounds, whose shift is
+    set to 0 to keep the infinite bounds from being added to infinite shifts of the opposite sign in the compositions.'''
+    shift = numpy.where(numpy.isinf(shift), 0.0, shift)
+    return _blockedScan((shift, low, high), (0.0, -numpy.inf, numpy.inf), _clampCompose, _clampApply, initial)
+
+def _mobiusCompose(first: tuple, second: tuple) -> tuple:
+    a, b, c, d = first
+    e, f, g, h = second
+    a, b, c, d = e*a+f*c, e*b+f*d, g*a+h*c, g*b+h*d
+    scale = numpy.maximum(numpy.maximum(a, b), numpy.maximum(c, d))  # the map does not change when the matrix is scaled, which avoids overflows
+    return a/scale, b/scale, c/scale, d/scale
+
+def _mobiusApply(step: tuple, x):
+    # an infinite ratio, after an emission impossible outside, is mapped to the limit of the map, a/c unless both vanish
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        limit = numpy.where((step[0] > 0) | (step[2] > 0), step[0]/step[2], step[1]/step[3])
+        return numpy.where(numpy.isinf(x), limit, (step[0]*x+step[1])/(step[2]*x+step[3]))
+
+def _mobiusScan(a: numpy.ndarray, b: numpy.ndarray, c: numpy.ndarray, d: numpy.ndarray, initial: float, last: bool = False) -> numpy.ndarray:
+    '''Blocked scan of the maps x -> log(e^(a+x) + e^b) - log(e^(c+x) + e^d), the log ratios of the linear maps of matrix [[e^a, e^b], [e^c, e^d]],
+    which make up the forward and backward recurrences. The maps are composed as the products of the matrices and applied to the ratios
+    themselves rather than to their logarithms, which stay within a few tens in both recurrences since every step mixes the two states.'''
+    ratios = _blockedScan((numpy.exp(a), numpy.exp(b), numpy.exp(c), numpy.exp(d)), (1.0, 0.0, 0.0, 1.0), _mobiusCompose, _mobiusApply, numpy.exp(initial), last)
+    with numpy.errstate(divide='ignore'):
+        return numpy.log(ratios)
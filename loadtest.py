@@ -0,0 +1,103 @@
+import sys
+import json
+import time
+import random
+import asyncio
+import numpy
+
+'''
+Load test of the scoring service of server.py, which has to be running: a number of concurrent connections each send their requests one
+after the other, waiting for every response before the next request, and the latency of each request is measured from the client side.
+The requests are score requests of random sequences, with a scan of a random genome every so often; at the end, the throughput and the
+latency percentiles of each kind of request are printed, together with the statistics of the batches formed by the service.
+
+The flags that can be declared are:
+
+--host <str>: address of the service (default 127.0.0.1);
+--port <int>: port of the service (default 8765);
+--connections <int>: number of concurrent connections (default 32);
+--requests <int>: number of requests sent by each connection (default 200);
+--length <int>: length of the sequences of the score requests (default 1000);
+--scan-every <int>: one request out of this many is a scan instead of a score request, 0 for none (default 0);
+--scan-length <int>: length of the genomes of the scan requests (default 100000);
+--seed <int>: seed of the random sequences (default 0).
+'''
+
+async def connection(host: str, port: int, requests: list, latencies: dict) -> None:
+    reader, writer = await asyncio.open_connection(host, port, limit=1 << 30)
+    for request in requests:
+        start = time.perf_counter()
+        writer.write(json.dumps(request).encode()+b'\n')
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        if 'error' in response:
+            raise ValueError(response['error'])
+        latencies[request['op']].append(time.perf_counter()-start)
+    writer.close()
+    await writer.wait_closed()
+
+async def stats(host: str, port: int) -> dict:
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b'{"op": "stats"}\n')
+    response = json.loads(await reader.readline())
+    writer.close()
+    await writer.wait_closed()
+    return response
+
+async def main(host: str, port: int, connections: int, requests: int, length: int, scanEvery: int, scanLength: int) -> None:
+    workload = []
+    for c in range(connections):
+        workload.append([])
+        for r in range(requests):
+            if scanEvery > 0 and (c*requests+r) % scanEvery == scanEvery-1:
+                workload[-1].append({'op': 'scan', 'sequence': ''.join(random.choices('ACGT', k=scanLength))})
+            else:
+                workload[-1].append({'op': 'score', 'sequence': ''.join(random.choices('ACGT', k=length))})
+    latencies = {'score': [], 'scan': []}
+    before = await stats(host, port)
+    start = time.perf_counter()
+    await asyncio.gather(*[connection(host, port, requests, latencies) for requests in workload])
+    elapsed = time.perf_counter()-start
+    after = await stats(host, port)
+    total = sum([len(values) for values in latencies.values()])
+    print(f'{total} requests on {connections} connections in {elapsed:.3f} s: {total/elapsed:.1f} requests/s')
+    print(f'{"request":>8} {"count":>7} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} {"p99.9 ms":>9} {"max ms":>8}')
+    for op, values in latencies.items():
+        if len(values) > 0:
+            p50, p90, p99, p999 = numpy.percentile(values, [50, 90, 99, 99.9])*1000
+            print(f'{op:>8} {len(values):>7} {p50:>8.2f} {p90:>8.2f} {p99:>8.2f} {p999:>9.2f} {max(values)*1000:>8.2f}')
+    batches = after['batches']-before['batches']
+    if batches > 0:
+        print(f'{batches} score batches, {(after["batched"]-before["batched"])/batches:.1f} sequences per batch on average')
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    host = '127.0.0.1'
+    port = 8765
+    connections = 32
+    requests = 200
+    length = 1000
+    scanEvery = 0
+    scanLength = 100000
+    seed = 0
+
+    for i in range(len(args)):
+        if args[i] == '--host':
+            host = args[i+1]
+        elif args[i] == '--port':
+            port = int(args[i+1])
+        elif args[i] == '--connections':
+            connections = int(args[i+1])
+        elif args[i] == '--requests':
+            requests = int(args[i+1])
+        elif args[i] == '--length':
+            length = int(args[i+1])
+        elif args[i] == '--scan-every':
+            scanEvery = int(args[i+1])
+        elif args[i] == '--scan-length':
+            scanLength = int(args[i+1])
+        elif args[i] == '--seed':
+            seed = int(args[i+1])
+
+    random.seed(seed)
+    asyncio.run(main(host, port, connections, requests, length, scanEvery, scanLength))
@@ -1,63 +1,108 @@
-import pandas as pd
 import numpy
-from utils import Constants, Model, StandardModel, NoModel
-from matplotlib import pyplot as plt
+import os
+import struct
+from utils import Constants, Encoder, Model, StandardModel, NoModel, TrackWriter
+from fasta import FastaReader
+from profiling import profiler
 
 class MarkovChain(Model):
-    '''The class MarkovModel implements a markov chain of order 1, in a structurate object. It can generate
+    '''The class MarkovModel implements a markov chain of order k (1 by default), in a structurate object. It can generate
     the model from sequences in a file, provided as argument path, or from a single sequence provided as the 
     argument s, or a model compliant with the standards of the Model class in utils.py can be provided, from which
-    the data about the model can be quickly retrieved. Providing a model as argument will override other arguments parsed.'''
-    def __init__(self, s: str = None, path: str = None, model: StandardModel = NoModel) -> None:
+    the data about the model can be quickly retrieved. Providing a model as argument will override other arguments parsed.
+    The transition probabilities are stored unrounded in the 4^k x 4 numpy array "matrix", whose rows are indexed by the rolling 2-bit
+    code of the preceding k-mer and whose columns by the next nucleotide, both in the order of Constants.nucleotides; the DataFrame view
+    "model" is only built on demand. A pseudo-count can be added to every transition count, which avoids null probabilities for rare contexts;
+    by default it is 0 for chains of order 1 and 1 for higher orders, whose 4^k contexts are often missing from the training data (see defaultPseudocount).'''
+    def __init__(self, s: str = None, path: str = None, model: StandardModel = NoModel, order: int = 1, pseudocount: float = None) -> None:
         if not model.isModel:
+            if order < 1:
+                raise ValueError('ArgumentError: the order of the chain must be at least 1')
+            if pseudocount == None:
+                pseudocount = MarkovChain.defaultPseudocount(order)
             if s == None and path == None:
                 raise ValueError('ArgumentError: no input string or filepath provided')
             elif path == None:
-                s = s.upper()
-                self.source = s
-                self.average_source_length = len(self.source)
+                codes = Encoder.encode(s)
+                self.average_source_length = len(s)
             elif s == None:
-                self.source = []
-                totrows = 0
-                filez = open(path, 'r')
-                for line in filez:
-                    line = line[:-1].upper()
-                    self.source.append(line)
-                    totrows += 1
-                filez.close()
-                self.source = ''.join(self.source)
-                self.average_source_length = round(len(self.source)/totrows)
+                with profiler.stage('read training set'):
+                    filez = open(path, 'rb')
+                    raw = filez.read()
+                    filez.close()
+                    totrows = raw.count(b'\n') + (0 if raw.endswith(b'\n') else 1)
+                    codes = Encoder.table[numpy.frombuffer(raw.translate(None, b'\r\n'), dtype=numpy.uint8)]
+                self.average_source_length = round(len(codes)/totrows)
             else:
                 raise ValueError('ArgumentError: both input string and filepath provided, only 1 required')
-            counter = {}
-            mod = pd.DataFrame([[0 for i in range(4)] for j in range(4)], columns=Constants.nucleotides, index=Constants.nucleotides)
-            for nucl in range(1, len(self.source)):
-                if self.source[nucl-1] in Constants.nucleotides and self.source[nucl] in Constants.nucleotides:
-                    mod.loc[self.source[nucl-1], self.source[nucl]] += 1
-                    counter[self.source[nucl]] = counter.get(self.source[nucl], 0) + 1
-            for i in Constants.nucleotides:
-                for j in mod.index:
-                    mod.loc[j, i] = round(mod.loc[j,i]/counter[j], 2)
-            self.model = mod
+            self.order = order
+            self.pseudocount = pseudocount
+            with profiler.stage('train'):
+                counts = MarkovChain.countTransitions(codes, order) + pseudocount
+                totals = counts.sum(axis=1, keepdims=True)
+                self.matrix = numpy.divide(counts, totals, out=numpy.zeros(counts.shape), where=totals > 0)
+            profiler.count('training bases', len(codes))
         else:
-            self.model = model.model
+            self.order = getattr(model, 'order', 1)
+            self.pseudocount = getattr(model, 'pseudocount', 0)
+            if getattr(model, 'matrix', None) is not None:
+                self.matrix = numpy.array(model.matrix, dtype=float)
+            elif hasattr(model.model, 'loc'):  # a DataFrame, recognised without importing pandas
+                self.matrix = model.model.loc[Constants.kmers(self.order), Constants.nucleotides].to_numpy(dtype=float)
+            else:
+                self.matrix = numpy.array(model.model, dtype=float)
+            if self.matrix.shape != (4**self.order, 4):
+                raise ValueError(f'ModelError: a model of order {self.order} requires a {4**self.order}x4 transition matrix')
             self.average_source_length = model.average_source_length
+
+    @staticmethod
+    def defaultPseudocount(order: int) -> float:
+        '''Pseudo-count used when none is provided: 0 for order 1, as the chains of order 1 of the software have always been trained, and 1 for
+        higher orders, where a context never seen in training would otherwise get a row of null probabilities and any window holding it an infinite score.'''
+        return 0 if order == 1 else 1
+
+    @property
+    def matrix(self) -> numpy.ndarray:
+        return self._matrix
+
+    @matrix.setter
+    def matrix(self, matrix: numpy.ndarray) -> None:
+        # assigning a new matrix invalidates the DataFrame view built from the old one
+        self._matrix = matrix
+        self._frame = None
+
+    @property
+    def model(self) -> 'pd.DataFrame':
+        '''DataFrame view of the transition probabilities, indexed by the preceding k-mer and with the next nucleotide on the columns.
+        Built on the first access, which is the only place where pandas is imported, and returned again by the following ones, as FrameView
+        does for the pre-computed models, until a new matrix is assigned.'''
+        if self._frame is None:
+            import pandas as pd
+            self._frame = pd.DataFrame(self._matrix, columns=Constants.nucleotides, index=Constants.kmers(self.order))
+        return self._frame
+
+    @staticmethod
+    def countTransitions(codes: numpy.ndarray, order: int = 1, block: int = 1 << 24) -> numpy.ndarray:
+        '''Counts the transitions from each k-mer to the next nucleotide of an encoded sequence in a single bincount pass over the
+        (k+1)-mer codes, returning a 4^k x 4 integer array. Transitions involving unassigned nucleotides are discarded; the sequence is
+        processed in blocks of "block" transitions so that the temporary arrays stay small even on very large training sets.'''
+        counts = numpy.zeros(4**(order+1), dtype=numpy.int64)
+        for b in range(0, max(len(codes)-order, 0), block):
+            kmers, valid = Encoder.kmerCodes(codes[b:b+block+order], order+1)
+            counts += numpy.bincount(kmers[valid], minlength=4**(order+1))
+        return counts.reshape(4**order, 4)
     
     def scoreQuery(self, q: str, log: bool = True) -> float:
         '''Outputs the score of a query sequence q, evaluated on the model represented by the class instance.
         By parsing bool = True one makes the method switch to calculating such score by sum of logarithms,
-        instead of by product of probabilities from the model.'''
-        q = q.upper()
+        instead of by product of probabilities from the model. The first k nucleotides are scored as equiprobable,
+        and transitions involving unassigned nucleotides are skipped.'''
+        kmers, valid = Encoder.kmerCodes(Encoder.encode(q), self.order+1)
+        probabilities = self.matrix.ravel()[kmers[valid]]
         if not log:
-            score = 0.25
-            for i in range(1, len(q)):
-                score *= self.model[q[i]][q[i-1]]
-            return score
+            return 0.25**self.order*numpy.prod(probabilities)
         else:
-            score = numpy.log(0.25)
-            for i in range(1, len(q)):
-                score += numpy.log(self.model[q[i]][q[i-1]])
-            return score
+            return self.order*numpy.log(0.25) + numpy.sum(numpy.log(probabilities))
 
 class GenomeInOutWindow:
         '''Class designed to extend the evaluation of query sequences to larger sequences, which can be assumed to represent genomes.
@@ -68,16 +113,173 @@ class GenomeInOutWindow:
             '''Receives as input the reference genome to scan as a string, the inside model and the outside model, biologically significant, both required to be
             an instance of the MarkovModel class for compatibility, the size of the sliding window, which can affect the scores produced and a boolean "log", which
             will turn off unnecessary logging if set to False.
-            The method returns to the user a tuple containing as first element a list with the score corresponding to the window, of length "wsize",
+            The method returns to the user a tuple containing as first element a numpy array with the score corresponding to the window, of length "wsize",
             starting from each legal position of the genome, and the window size itself, since if not parsed, it needs to be set before proceding.
+            The genome is encoded once and each window score is obtained as the difference of two cumulative sums of the transition log-odds,
+            so the scan runs in linear time regardless of the window size; the results match the ones of evaluateReference.
             Mind that in case the window size was greater than the genome size, the method would automatically raise an error and notify the user.'''
+            if wsize == None:
+                wsize = inmod.average_source_length
+            if wsize > len(genome):
+                raise ValueError('GenomeLengthError: window size exceeds genome length')
+            with profiler.stage('scan'):
+                data = GenomeInOutWindow.windowScores(Encoder.encode(genome), GenomeInOutWindow.logOddsTable(inmod, outmod), wsize)
+                data = numpy.round(numpy.round(data, 2), 1)  # same two-step rounding as logRatioEvaluate followed by round(..., 1)
+            profiler.count('windows scored', len(data))
+            if log:
+                GenomeInOutWindow._logPositives(data, wsize)
+            return data, wsize
+
+        @staticmethod
+        def scanChunks(chunks, inmod: MarkovChain, outmod: MarkovChain, wsize: int = None, log: bool = True):
+            '''Streaming counterpart of evaluate: consumes an iterable of (record name, start position, sequence) chunks, such as the ones produced
+            by FastaReader.chunks with an overlap of wsize-1, and yields for each of them a tuple (record name, start position, scores), where the
+            scores are the ones of the windows starting in the chunk. Concatenating the scores of the chunks of a record gives the same track as
+            scanning the whole record string with evaluate, while only one chunk at a time is kept in memory. Chunks shorter than the window are skipped.'''
+            if wsize == None:
+                wsize = inmod.average_source_length
+            table = GenomeInOutWindow.logOddsTable(inmod, outmod)
+            for name, start, chunk in chunks:
+                if len(chunk) < wsize:
+                    continue
+                with profiler.stage('scan'):
+                    data = numpy.round(numpy.round(GenomeInOutWindow.windowScores(Encoder.encode(chunk), table, wsize), 2), 1)
+                profiler.count('windows scored', len(data))
+                if log:
+                    GenomeInOutWindow._logPositives(data, wsize, start)
+                yield name, start, data
+
+        @staticmethod
+        def evaluateFile(path: str, inmod: MarkovChain, outmod: MarkovChain, wsize: int = None, log: bool = True, record: str = None, chunksize: int = 1 << 22, workers: int = 1) -> tuple:
+            '''Scans a record of the FASTA file "path" (the first one, unless the name "record" is provided) by streaming it in chunks of "chunksize"
+            bases through scanChunks, so that the sequence is never loaded as a whole. Returns the same tuple as evaluate on the record string.
+            With more than one worker the record is scanned by evaluateRecordsParallel instead, which holds its encoding in shared memory.'''
+            if wsize == None:
+                wsize = inmod.average_source_length
+            if workers != 1:
+                tracks, wsize = GenomeInOutWindow.evaluateRecordsParallel(path, inmod, outmod, wsize, log, None if record == None else [record], workers, first=record == None)
+                if len(tracks) == 0:
+                    raise ValueError('GenomeLengthError: record not found or window size exceeds its length')
+                return tracks[0][1], wsize
+            pieces = [data for name, start, data in GenomeInOutWindow.scanChunks(GenomeInOutWindow._recordChunks(path, record, chunksize, wsize-1), inmod, outmod, wsize, log)]
+            if len(pieces) == 0:
+                raise ValueError('GenomeLengthError: record not found or window size exceeds its length')
+            return numpy.concatenate(pieces), wsize
+
+        @staticmethod
+        def evaluateParallel(genome: str, inmod: MarkovChain, outmod: MarkovChain, wsize: int = None, log: bool = True, workers: int = None, chunksize: int = 1 << 20) -> tuple:
+            '''Multi-core version of evaluate, returning the same tuple. The genome (a string or an array already encoded by Encoder) is encoded once in
+            shared memory and split into overlapping chunks of "chunksize" windows, scored by a pool of "workers" processes (by default one per core)
+            which write their scores straight into a shared output buffer, so that neither the genome nor the scores are pickled between processes.'''
+            if wsize == None:
+                wsize = inmod.average_source_length
+            if wsize > len(genome):
+                raise ValueError('GenomeLengthError: window size exceeds genome length')
+            codes = Encoder.encode(genome) if isinstance(genome, str) else genome
+            with profiler.stage('parallel scan'):
+                tracks = GenomeInOutWindow._scanShared([('', 0, codes)], len(codes), GenomeInOutWindow.logOddsTable(inmod, outmod), wsize, workers, chunksize)
+            profiler.count('windows scored', len(tracks[0][1]))
+            data = tracks[0][1]
+            if log:
+                GenomeInOutWindow._logPositives(data, wsize)
+            return data, wsize
+
+        @staticmethod
+        def evaluateRecordsParallel(path: str, inmod: MarkovChain, outmod: MarkovChain, wsize: int = None, log: bool = True, records: list = None, workers: int = None, chunksize: int = 1 << 20, first: bool = False) -> tuple:
+            '''Scans all the records of the FASTA file "path" (or only the ones named in "records", or only the first one if "first" is set) on a pool of
+            "workers" processes, as evaluateParallel does for a single genome. The file is streamed straight into the shared buffer, so that no
+            string copy of the genome is ever built. Returns a tuple containing the list of (record name, scores) pairs, in file order, and the window
+            size; records shorter than the window are left out.'''
+            if wsize == None:
+                wsize = inmod.average_source_length
+            selected = ((name, start, Encoder.encode(chunk)) for name, start, chunk in GenomeInOutWindow._recordChunks(path, records, 1 << 22, 0, first))
+            with profiler.stage('parallel scan'):
+                tracks = GenomeInOutWindow._scanShared(selected, os.path.getsize(path), GenomeInOutWindow.logOddsTable(inmod, outmod), wsize, workers, chunksize)
+            tracks = [(name, data) for name, data in tracks if len(data) > 0]
+            profiler.count('windows scored', sum([len(data) for name, data in tracks]))
+            if log:
+                for name, data in tracks:
+                    GenomeInOutWindow._logPositives(data, wsize)
+            return tracks, wsize
+
+        @staticmethod
+        def _scanShared(pieces, capacity: int, table: numpy.ndarray, wsize: int, workers: int = None, chunksize: int = 1 << 20) -> list:
+            '''Core of the parallel scanning modes. "pieces" is an iterable of (record name, start, encoded array) tuples, the pieces of each record
+            being contiguous and non overlapping, whose total length must not exceed "capacity". The pieces are copied in a shared memory buffer, the
+            windows of each record are split into tasks of "chunksize" windows and the scores, stitched in order by construction, are returned
+            as a list of (record name, scores) pairs.'''
+            # imported here, as in the workers, to keep them out of the startup of the serial modes
+            import multiprocessing
+            from multiprocessing import shared_memory
+            if workers == None:
+                workers = os.cpu_count() or 1
+            codesMemory = shared_memory.SharedMemory(create=True, size=max(capacity, 1))
+            scoresMemory = None
+            try:
+                codes = numpy.ndarray((capacity,), dtype=numpy.uint8, buffer=codesMemory.buf)
+                layout = []
+                filled = 0
+                for name, start, piece in pieces:
+                    if len(layout) == 0 or layout[-1][0] != name or start == 0:
+                        layout.append([name, filled, 0])
+                    codes[filled:filled+len(piece)] = piece
+                    filled += len(piece)
+                    layout[-1][2] += len(piece)
+                del codes
+                tasks = []
+                nscores = 0
+                for name, offset, length in layout:
+                    windows = max(length-wsize+1, 0)
+                    for a in range(0, windows, chunksize):
+                        tasks.append((offset+a, nscores+a, min(chunksize, windows-a)))
+                    nscores += windows
+                scoresMemory = shared_memory.SharedMemory(create=True, size=max(nscores, 1)*8)
+                initargs = (codesMemory.name, capacity, scoresMemory.name, nscores, table, wsize)
+                if workers == 1 or len(tasks) < 2:
+                    _attachScanBuffers(*initargs)
+                    for task in tasks:
+                        _scanTask(task)
+                    _scanBuffers.clear()
+                else:
+                    methods = multiprocessing.get_all_start_methods()
+                    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+                    with context.Pool(min(workers, len(tasks)), initializer=_attachScanBuffers, initargs=initargs) as pool:
+                        for done in pool.imap_unordered(_scanTask, tasks):
+                            pass
+                scores = numpy.ndarray((nscores,), dtype=numpy.float64, buffer=scoresMemory.buf).copy()
+            finally:
+                codesMemory.close()
+                codesMemory.unlink()
+                if scoresMemory != None:
+                    scoresMemory.close()
+                    scoresMemory.unlink()
+            tracks = []
+            position = 0
+            for name, offset, length in layout:
+                windows = max(length-wsize+1, 0)
+                tracks.append((name, scores[position:position+windows]))
+                position += windows
+            return tracks
+
+        @staticmethod
+        def _logPositives(data: numpy.ndarray, wsize: int, start: int = 0) -> None:
+            '''Prints the windows with a positive score, as done by evaluate when logging is enabled.'''
+            for s in numpy.flatnonzero(data > 0):
+                print(f'Genome position: {start+s} : {start+s+wsize}')
+                print(f'Window score: {data[s]}')
+                print('-'*40)
+
+        @staticmethod
+        def evaluateReference(genome: str, inmod: MarkovChain, outmod: MarkovChain, wsize: int = None, log: bool = True) -> tuple:
+            '''Reference implementation of evaluate, which slices every window and scores it from scratch on both models through MarkovChain.scoreQuery.
+            Quadratic in the window size and therefore only meant for checking the equivalence of faster scanning engines on small genomes.'''
             if wsize == None:
                 wsize = inmod.average_source_length
             data = []
             if wsize > len(genome):
                 raise ValueError('GenomeLengthError: window size exceeds genome length')
             for s in range(0, len(genome)-wsize+1):
-                score = round(logRatioEvaluate(inmod.scoreQuery(genome[s:s+wsize], True), outmod.scoreQuery(genome[s:s+wsize], True), False), 1)
+                score = round(logRatioEvaluate(inmod.scoreQuery(genome[s:s+wsize], True), outmod.scoreQuery(genome[s:s+wsize], True), True), 1)
                 if log:
                     if score > 0:
                         print(f'Genome position: {s} : {s+wsize}')
@@ -85,40 +287,109 @@ class GenomeInOutWindow:
                         print('-'*40)
                 data.append(score)
             return data, wsize
+
+        @staticmethod
+        def logOddsTable(inmod: MarkovChain, outmod: MarkovChain) -> numpy.ndarray:
+            '''Precomputes the log-odds, inside minus outside, of every transition as a 4^k x 4 array laid out as the matrix of the models,
+            which are required to have the same order k.'''
+            if inmod.order != outmod.order:
+                raise ValueError('ModelError: inside and outside models must have the same order')
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                return numpy.log(inmod.matrix) - numpy.log(outmod.matrix)
+
+        @staticmethod
+        def transitionScores(codes: numpy.ndarray, table: numpy.ndarray) -> numpy.ndarray:
+            '''Looks up the log-odds of the transition ending at each position k, k+1, ... of the encoded sequence "codes", given the "table"
+            produced by logOddsTable. Transitions involving an unassigned nucleotide are given a neutral score of 0.'''
+            kmers, valid = Encoder.kmerCodes(codes, (len(table).bit_length()+1)//2)
+            return numpy.where(valid, table.ravel()[kmers], 0.0)
+
+        @staticmethod
+        def windowScores(codes: numpy.ndarray, table: numpy.ndarray, wsize: int) -> numpy.ndarray:
+            '''Computes the unrounded log ratio of every window of length "wsize" of the encoded sequence "codes", given the transition log-odds
+            "table" produced by logOddsTable. The transition scores are accumulated once, so that each window is the difference of two prefix sums.'''
+            order = (len(table).bit_length()-1)//2
+            if wsize <= order:
+                raise ValueError('ArgumentError: window size must exceed the order of the models')
+            prefix = GenomeInOutWindow.prefixSums(GenomeInOutWindow.transitionScores(codes, table))
+            return GenomeInOutWindow.rangeSums(prefix, slice(0, max(len(prefix[0])-wsize+order, 0)), slice(wsize-order, None))
+
+        @staticmethod
+        def prefixSums(transitions: numpy.ndarray) -> tuple:
+            '''Prefix sums of the transition log-odds "transitions", as a tuple (sums of the finite log-odds, counts of the transitions impossible on the
+            inside model, counts of the ones impossible on the outside model), each array starting from 0 and one longer than "transitions".
+            A transition of probability 0 in a model has an infinite log-odds (nan if impossible on both), which would turn every later sum into nan:
+            it is counted apart instead, so that it only affects the ranges containing it (see rangeSums). The counts are None when all log-odds are finite.'''
+            finite = numpy.isfinite(transitions)
+            if finite.all():
+                return numpy.concatenate(([0.0], numpy.cumsum(transitions))), None, None
+            sums = numpy.concatenate(([0.0], numpy.cumsum(numpy.where(finite, transitions, 0.0))))
+            nan = numpy.isnan(transitions)
+            inside = numpy.concatenate(([0], numpy.cumsum(numpy.isneginf(transitions) | nan)))
+            outside = numpy.concatenate(([0], numpy.cumsum(numpy.isposinf(transitions) | nan)))
+            return sums, inside, outside
+
+        @staticmethod
+        def rangeSums(prefix: tuple, lower, upper) -> numpy.ndarray:
+            '''Sums of the transition log-odds from the indexes "lower" to "upper" (slices or index arrays of the same length) of the prefix sums of
+            prefixSums. As when the two models score a sequence separately, a range is -inf if it holds a transition impossible on the inside model,
+            +inf if it holds one impossible on the outside model and nan if it holds both.'''
+            sums, inside, outside = prefix
+            ranges = sums[upper] - sums[lower]
+            if inside is not None:
+                impossibleInside = inside[upper] > inside[lower]
+                impossibleOutside = outside[upper] > outside[lower]
+                ranges[impossibleInside] = -numpy.inf
+                ranges[impossibleOutside] = numpy.inf
+                ranges[impossibleInside & impossibleOutside] = numpy.nan
+            return ranges
         
         @staticmethod
-        def quickPlot(dataArray: list|tuple, ws: int, stringency: int = 20, peaks = None) -> None:
+        def quickPlot(dataArray: list|tuple, ws: int, stringency: int = 20, peaks = None, region: tuple = None) -> None:
             '''Useful when the user is simply in need of plotting data already known. Takes an array of scores,
             the window size of the genome scanning, the stringency of the peak calling and the location of the peaks.
-            Devised to quicjly plot the informations from a file written by FileHandler.writeEvaluation'''
-            plt.plot([i for i in range(len(dataArray))], dataArray, linewidth = 1)
-            plt.xlabel('Genome starting position')
-            plt.ylabel('CpG island probability')
-            plt.title(f'Genome scanning, width: {ws}, peak sharpness: {round(numpy.log(ws)*stringency)}'+'\n'+f'peak calling threshold: {round(numpy.log2(ws), 1)}')
-            plt.axhline(0, 0, color = 'black', linewidth = 2)
-            for i in peaks:
-                plt.axvline(i, color = 'red', linewidth = 0.5)
-            plt.axhline(numpy.log2(ws), color = 'green', linewidth=0.8)
-            plt.yticks(list(plt.yticks()[0]) + [numpy.log2(ws)])
-            plt.grid(True)
-            plt.show()
+            Devised to quicjly plot the informations from a file written by FileHandler.writeTrack, whose memory-mapped scores are
+            only read through a TrackPyramid; "region" optionally restricts the initial view to a (start, end) range of positions.'''
+            GenomeInOutWindow._plotTrack(dataArray, ws, stringency, [] if peaks == None else peaks, region)
         
         @staticmethod
-        def plotScore(dataArray: list|tuple, ws: int, stringency: int = 20, peaks: bool = False) -> None:
+        def plotScore(dataArray: list|tuple, ws: int, stringency: int = 20, peaks: bool = False, region: tuple = None) -> None:
             '''The method is used for plotting the data one produced with genome scanning. The parameters include "dataArray", the list of scores
-            for each position of the genome, "ws", the window size, employed in peak calling, and the stringency, again in peak calling.'''
-            plt.plot([i for i in range(len(dataArray))], dataArray, linewidth = 1)
-            plt.xlabel('Genome starting position')
-            plt.ylabel('CpG island probability')
-            plt.title(f'Genome scanning, width: {ws}, peak sharpness: {round(numpy.log(ws)*stringency)}'+'\n'+f'peak calling threshold: {round(numpy.log2(ws), 1)}')
-            plt.axhline(0, 0, color = 'black', linewidth = 2)
-            if peaks:
-                putativeStartSites = GenomeInOutWindow.callPeaks(dataArray, ws, stringency)[0]
-                for j in putativeStartSites:
-                    plt.axvline(j, color = 'red', linewidth=0.5)
-            plt.axhline(numpy.log2(ws), color = 'green', linewidth=0.8)
-            plt.yticks(list(plt.yticks()[0]) + [numpy.log2(ws)])
-            plt.grid(True)
+            for each position of the genome, "ws", the window size, employed in peak calling, and the stringency, again in peak calling.
+            As in quickPlot, "region" optionally restricts the initial view to a (start, end) range of positions.'''
+            GenomeInOutWindow._plotTrack(dataArray, ws, stringency, GenomeInOutWindow.callPeaks(dataArray, ws, stringency)[0] if peaks else [], region)
+
+        @staticmethod
+        def _plotTrack(dataArray: list|tuple, ws: int, stringency: int, peaks: list, region: tuple = None) -> None:
+            '''Common plotting routine of quickPlot and plotScore. The scores are drawn from the min/max envelopes of a TrackPyramid at about one
+            bin per pixel, and redrawn at the resolution appropriate to the new range whenever the view is zoomed or panned; peaks are drawn exactly.'''
+            from matplotlib import pyplot as plt
+            pyramid = TrackPyramid.fromTrack(dataArray)
+            if region == None:
+                region = (0, pyramid.length)
+            fig, ax = plt.subplots()
+            drawn = []
+            def draw(start, end):
+                for artist in drawn:
+                    artist.remove()
+                drawn.clear()
+                x, lower, upper = pyramid.envelope(int(start), int(numpy.ceil(end))+1, max(int(ax.bbox.width), 1))
+                if lower is upper:
+                    drawn.extend(ax.plot(x, lower, linewidth = 1, color = 'C0'))
+                else:
+                    drawn.append(ax.fill_between(x, lower, upper, step = 'post', linewidth = 1, color = 'C0'))
+            draw(*region)
+            ax.set_xlim(region)
+            ax.set_xlabel('Genome starting position')
+            ax.set_ylabel('CpG island probability')
+            ax.set_title(f'Genome scanning, width: {ws}, peak sharpness: {round(numpy.log(ws)*stringency)}'+'\n'+f'peak calling threshold: {round(numpy.log2(ws), 1)}')
+            ax.axhline(0, 0, color = 'black', linewidth = 2)
+            if len(peaks) > 0:
+                ax.vlines(peaks, 0, 1, transform = ax.get_xaxis_transform(), color = 'red', linewidth = 0.5)
+            ax.axhline(numpy.log2(ws), color = 'green', linewidth=0.8)
+            ax.set_yticks(list(ax.get_yticks()) + [numpy.log2(ws)])
+            ax.grid(True)
+            ax.callbacks.connect('xlim_changed', lambda axes: draw(*axes.get_xlim()))
             plt.show()
         
         @staticmethod
@@ -127,30 +398,656 @@ class GenomeInOutWindow:
             the operation, which are used to compute a probability threshold for peaks and height. Returns a tuple containing the list of the possible
             start sites of the considered genomic feature identified and the list of their scores. Fine tuning of the stringency
             value is recommended.'''
-            lastMax = 0
-            lastMin = 0
-            putativeStartSites = []
-            potentialMax = 0
-            potentialMin = 0
-            for i in range(len(dataArray)):
-                if dataArray[i] > dataArray[potentialMax]:
-                    potentialMax = i
-                    if dataArray[i] - dataArray[potentialMin] >= numpy.log(ws)*stringency:
-                        lastMin, potentialMin = potentialMin, i
-                if dataArray[i] < dataArray[potentialMin]:
-                    potentialMin = i
-                    if dataArray[i] - dataArray[potentialMax] <= -numpy.log(ws)*stringency and dataArray[potentialMax] >= numpy.log2(ws):
-                        lastMax, potentialMax = potentialMax, i
-                        if lastMax not in putativeStartSites:
-                            putativeStartSites.append(lastMax)
-            #if dataArray[potentialMax] - dataArray[lastMin] >= numpy.log(ws)*stringency/2 and dataArray[potentialMax] >= numpy.log2(ws):
-            #    putativeStartSites.append(potentialMax)
-            return putativeStartSites, [round(dataArray[i], 1) for i in putativeStartSites]
+            peaks = PeakCaller(ws, stringency).feed(dataArray)
+            return [i for i, score in peaks], [score for i, score in peaks]
 
+        @staticmethod
+        def evaluateStream(path: str, inmod: MarkovChain, outmod: MarkovChain, wsize: int = None, stringency: int = 20, savename: str = None, log: bool = True, record: str = None, chunksize: int = 1 << 22) -> tuple:
+            '''Scans a record of the FASTA file "path" (the first one, unless the name "record" is provided) as a single pipeline: every chunk
+            scored by scanChunks is passed on to a PeakCaller and, if "savename" is provided, appended to a binary score track, so that the
+            score track is never materialised in memory. Returns a tuple containing the result of callPeaks, the window size and the number of scores.'''
+            if wsize == None:
+                wsize = inmod.average_source_length
+            caller = PeakCaller(wsize, stringency)
+            writer = None if savename == None else TrackWriter(savename, wsize, stringency)
+            peaks = []
+            nscores = 0
+            for name, start, data in GenomeInOutWindow.scanChunks(GenomeInOutWindow._recordChunks(path, record, chunksize, wsize-1), inmod, outmod, wsize, log):
+                peaks.extend(caller.feed(data))
+                nscores += len(data)
+                if writer != None:
+                    writer.write(data)
+            if nscores == 0:
+                if writer != None:
+                    writer.discard()
+                raise ValueError('GenomeLengthError: record not found or window size exceeds its length')
+            if writer != None:
+                writer.close([i for i, score in peaks])
+            return ([i for i, score in peaks], [score for i, score in peaks]), wsize, nscores
+
+        @staticmethod
+        def windowScoresMulti(codes: numpy.ndarray, table: numpy.ndarray, wsizes: list) -> dict:
+            '''Counterpart of windowScores for several window sizes at once: the transition log-odds are looked up and accumulated a single time,
+            and the unrounded scores of each window size in "wsizes" are sliced from the same prefix sums. Returns a dictionary from window size to scores.'''
+            order = (len(table).bit_length()-1)//2
+            if min(wsizes) <= order:
+                raise ValueError('ArgumentError: window size must exceed the order of the models')
+            prefix = GenomeInOutWindow.prefixSums(GenomeInOutWindow.transitionScores(codes, table))
+            return {wsize: GenomeInOutWindow.rangeSums(prefix, slice(0, max(len(prefix[0])-wsize+order, 0)), slice(wsize-order, None)) for wsize in wsizes}
+
+        @staticmethod
+        def evaluateMulti(genome: str, inmod: MarkovChain, outmod: MarkovChain, wsizes: list = None, log: bool = True) -> tuple:
+            '''Scans the genome with all the window sizes of the list "wsizes" (by default only the average source length of the inside model) from one
+            encoding and one cumulative pass, so that trying many window sizes costs little more than a single scan. Returns a tuple containing a
+            dictionary from each window size to its scores, the same as evaluate would return for it, and the sorted list of window sizes.'''
+            wsizes = GenomeInOutWindow._windowSizes(wsizes, inmod)
+            if wsizes[-1] > len(genome):
+                raise ValueError('GenomeLengthError: window size exceeds genome length')
+            with profiler.stage('scan'):
+                tracks = GenomeInOutWindow.windowScoresMulti(Encoder.encode(genome), GenomeInOutWindow.logOddsTable(inmod, outmod), wsizes)
+                tracks = {wsize: numpy.round(numpy.round(data, 2), 1) for wsize, data in tracks.items()}
+            profiler.count('windows scored', sum([len(data) for data in tracks.values()]))
+            if log:
+                for wsize in wsizes:
+                    GenomeInOutWindow._logPositives(tracks[wsize], wsize)
+            return tracks, wsizes
+
+        @staticmethod
+        def scanChunksMulti(chunks, inmod: MarkovChain, outmod: MarkovChain, wsizes: list = None, log: bool = True):
+            '''Streaming counterpart of evaluateMulti, as scanChunks is of evaluate: the chunks must overlap by the largest window size minus one, and
+            for each of them a tuple (record name, start position, dictionary from window size to scores) is yielded. Since the chunks are shared by
+            all the window sizes, one chunk is looked ahead to know whether the smaller windows at the end of a chunk are scored by the next one.'''
+            wsizes = GenomeInOutWindow._windowSizes(wsizes, inmod)
+            table = GenomeInOutWindow.logOddsTable(inmod, outmod)
+            chunks = iter(chunks)
+            following = next(chunks, None)
+            while following != None:
+                name, start, chunk = following
+                following = next(chunks, None)
+                last = following == None or following[0] != name
+                if len(chunk) < wsizes[0]:
+                    continue
+                with profiler.stage('scan'):
+                    tracks = GenomeInOutWindow.windowScoresMulti(Encoder.encode(chunk), table, wsizes)
+                    windows = None if last else max(len(chunk)-wsizes[-1]+1, 0)
+                    tracks = {wsize: numpy.round(numpy.round(data[:windows], 2), 1) for wsize, data in tracks.items()}
+                profiler.count('windows scored', sum([len(data) for data in tracks.values()]))
+                if log:
+                    for wsize in wsizes:
+                        GenomeInOutWindow._logPositives(tracks[wsize], wsize, start)
+                yield name, start, tracks
+
+        @staticmethod
+        def callPeaksMulti(tracks: dict, stringency: int = 20) -> tuple:
+            '''Calls the peaks of every score track of the dictionary returned by evaluateMulti, each with the thresholds of its own window size.
+            Returns a tuple containing the dictionary from window size to the result of callPeaks and the combined peaks of combinePeaks. The tracks
+            stay in memory, so other stringencies can be tried by calling this method again without rescanning.'''
+            peaks = {wsize: GenomeInOutWindow.callPeaks(data, wsize, stringency) for wsize, data in tracks.items()}
+            return peaks, GenomeInOutWindow.combinePeaks(peaks)
+
+        @staticmethod
+        def combinePeaks(peaks: dict) -> list:
+            '''Merges the peaks called with different window sizes, given as a dictionary from window size to the result of callPeaks, into a single
+            list sorted by position. Peaks closer than the smaller of their window sizes are taken as the same site, which is represented by the peak
+            rising the most above the threshold of its window size (log2 of it); each entry is [position, score, window size, number of window sizes calling the site].'''
+            calls = sorted([(calls[i], scores[i], wsize) for wsize, (calls, scores) in peaks.items() for i in range(len(calls))])
+            combined = []
+            sizes = []
+            for position, score, wsize in calls:
+                if len(combined) > 0 and position - combined[-1][0] < min(wsize, combined[-1][2]):
+                    best = combined[-1]
+                    sizes[-1].add(wsize)
+                    if score - numpy.log2(wsize) > best[1] - numpy.log2(best[2]):
+                        best[0], best[1], best[2] = position, score, wsize
+                    best[3] = len(sizes[-1])
+                else:
+                    combined.append([position, score, wsize, 1])
+                    sizes.append({wsize})
+            return combined
+
+        @staticmethod
+        def evaluateStreamMulti(path: str, inmod: MarkovChain, outmod: MarkovChain, wsizes: list = None, stringency: int = 20, savename: str = None, log: bool = True, record: str = None, chunksize: int = 1 << 22) -> tuple:
+            '''Multi window size counterpart of evaluateStream: a record of the FASTA file "path" is streamed once through scanChunksMulti, the scores
+            of each window size being passed on to their own PeakCaller and, if "savename" is provided, to their own binary score track (see multiTrackName).
+            Returns a tuple containing the dictionary from window size to the result of callPeaks, the combined peaks of combinePeaks and the
+            dictionary from window size to the number of scores.'''
+            wsizes = GenomeInOutWindow._windowSizes(wsizes, inmod)
+            callers = {wsize: PeakCaller(wsize, stringency) for wsize in wsizes}
+            writers = {wsize: None if savename == None else TrackWriter(GenomeInOutWindow.multiTrackName(savename, wsize), wsize, stringency) for wsize in wsizes}
+            found = {wsize: [] for wsize in wsizes}
+            nscores = {wsize: 0 for wsize in wsizes}
+            for name, start, tracks in GenomeInOutWindow.scanChunksMulti(GenomeInOutWindow._recordChunks(path, record, chunksize, wsizes[-1]-1), inmod, outmod, wsizes, log):
+                for wsize, data in tracks.items():
+                    found[wsize].extend(callers[wsize].feed(data))
+                    nscores[wsize] += len(data)
+                    if writers[wsize] != None:
+                        writers[wsize].write(data)
+            if nscores[wsizes[0]] == 0:
+                for wsize in wsizes:
+                    if writers[wsize] != None:
+                        writers[wsize].discard()
+                raise ValueError('GenomeLengthError: record not found or window size exceeds its length')
+            for wsize in wsizes:
+                if writers[wsize] != None:
+                    writers[wsize].close([i for i, score in found[wsize]])
+            peaks = {wsize: ([i for i, score in found[wsize]], [score for i, score in found[wsize]]) for wsize in wsizes}
+            return peaks, GenomeInOutWindow.combinePeaks(peaks), nscores
+
+        @staticmethod
+        def multiTrackName(savename: str, wsize: int) -> str:
+            '''Name of the binary score track of the window size "wsize" in a multi window size scan saved as "savename": the window size is
+            inserted before the extension, e.g. scan.trk becomes scan.w200.trk.'''
+            root, extension = os.path.splitext(savename)
+            return f'{root}.w{wsize}{extension}'
+
+        @staticmethod
+        def _windowSizes(wsizes, inmod: MarkovChain) -> list:
+            '''Normalises the window sizes of the multi window size methods to a sorted list without repetitions.'''
+            if wsizes == None:
+                wsizes = [inmod.average_source_length]
+            elif isinstance(wsizes, int):
+                wsizes = [wsizes]
+            if len(wsizes) == 0:
+                raise ValueError('ArgumentError: at least one window size is required')
+            return sorted(set(wsizes))
+
+        @staticmethod
+        def reverseTable(table: numpy.ndarray) -> numpy.ndarray:
+            '''Rearranges the transition log-odds "table" of logOddsTable so that it is indexed by the (k+1)-mers of the forward strand while
+            holding the log-odds of their reverse complements, i.e. of the transitions read at the same place on the reverse strand.
+            Looking the forward codes up in it scores the reverse strand without building its sequence.'''
+            k = (len(table).bit_length()+1)//2
+            kmers = numpy.arange(4**k)
+            reverse = numpy.zeros(4**k, dtype=numpy.int64)
+            for j in range(k):
+                reverse = (reverse << 2) | (3 - ((kmers >> 2*j) & 3))
+            return table.ravel()[reverse].reshape(table.shape)
+
+        @staticmethod
+        def strandScores(codes: numpy.ndarray, table: numpy.ndarray, wsize: int) -> tuple:
+            '''Counterpart of windowScores for both strands: the (k+1)-mer codes of the encoded sequence are computed once and looked up both in
+            "table" and in its reverseTable, returning the unrounded scores of the windows of the forward and of the reverse strand. The reverse
+            scores are indexed as the forward ones, by the leftmost position of the window on the forward strand.'''
+            order = (len(table).bit_length()-1)//2
+            if wsize <= order:
+                raise ValueError('ArgumentError: window size must exceed the order of the models')
+            kmers, valid = Encoder.kmerCodes(codes, order+1)
+            tracks = []
+            for strand in (table, GenomeInOutWindow.reverseTable(table)):
+                prefix = GenomeInOutWindow.prefixSums(numpy.where(valid, strand.ravel()[kmers], 0.0))
+                tracks.append(GenomeInOutWindow.rangeSums(prefix, slice(0, max(len(prefix[0])-wsize+order, 0)), slice(wsize-order, None)))
+            return tracks[0], tracks[1]
+
+        @staticmethod
+        def evaluateStrands(genome: str, inmod: MarkovChain, outmod: MarkovChain, wsize: int = None, log: bool = True) -> tuple:
+            '''Scans both strands of the genome in one pass over its encoding (see strandScores), returning a tuple containing the forward scores,
+            the reverse scores, the combined scores, which are the best of the two strands for each window, and the window size. The forward
+            scores are the ones of evaluate, and the reverse ones the scores evaluate would give to the reverse complement of the genome, reordered
+            so that the same index refers to the same window; logging reports the positive windows of the combined scores.'''
+            if wsize == None:
+                wsize = inmod.average_source_length
+            if wsize > len(genome):
+                raise ValueError('GenomeLengthError: window size exceeds genome length')
+            with profiler.stage('scan'):
+                forward, reverse = GenomeInOutWindow.strandScores(Encoder.encode(genome), GenomeInOutWindow.logOddsTable(inmod, outmod), wsize)
+                forward = numpy.round(numpy.round(forward, 2), 1)
+                reverse = numpy.round(numpy.round(reverse, 2), 1)
+                combined = numpy.maximum(forward, reverse)
+            profiler.count('windows scored', 2*len(forward))
+            if log:
+                GenomeInOutWindow._logPositives(combined, wsize)
+            return forward, reverse, combined, wsize
+
+        @staticmethod
+        def scanChunksStrands(chunks, inmod: MarkovChain, outmod: MarkovChain, wsize: int = None, log: bool = True):
+            '''Streaming counterpart of evaluateStrands, as scanChunks is of evaluate: consumes (record name, start position, sequence) chunks overlapping
+            by wsize-1, such as the ones of FastaReader.chunks, and yields for each of them a tuple (record name, start position, forward scores, reverse
+            scores, combined scores) for the windows starting in the chunk. Chunks shorter than the window are skipped.'''
+            if wsize == None:
+                wsize = inmod.average_source_length
+            table = GenomeInOutWindow.logOddsTable(inmod, outmod)
+            for name, start, chunk in chunks:
+                if len(chunk) < wsize:
+                    continue
+                with profiler.stage('scan'):
+                    forward, reverse = GenomeInOutWindow.strandScores(Encoder.encode(chunk), table, wsize)
+                    forward = numpy.round(numpy.round(forward, 2), 1)
+                    reverse = numpy.round(numpy.round(reverse, 2), 1)
+                    combined = numpy.maximum(forward, reverse)
+                profiler.count('windows scored', 2*len(forward))
+                if log:
+                    GenomeInOutWindow._logPositives(combined, wsize, start)
+                yield name, start, forward, reverse, combined
+
+        @staticmethod
+        def evaluateFileStrands(path: str, inmod: MarkovChain, outmod: MarkovChain, wsize: int = None, log: bool = True, record: str = None, chunksize: int = 1 << 22) -> tuple:
+            '''Scans both strands of a record of the FASTA file "path" (the first one, unless the name "record" is provided), streaming it in chunks of
+            "chunksize" bases through scanChunksStrands as evaluateFile does, so that the sequence is never loaded as a whole. Returns the same tuple as
+            evaluateStrands on the record string.'''
+            if wsize == None:
+                wsize = inmod.average_source_length
+            pieces = list(GenomeInOutWindow.scanChunksStrands(GenomeInOutWindow._recordChunks(path, record, chunksize, wsize-1), inmod, outmod, wsize, log))
+            if len(pieces) == 0:
+                raise ValueError('GenomeLengthError: record not found or window size exceeds its length')
+            return tuple([numpy.concatenate([piece[j] for piece in pieces]) for j in (2, 3, 4)]) + (wsize,)
+
+        @staticmethod
+        def evaluateStreamStrands(path: str, inmod: MarkovChain, outmod: MarkovChain, wsize: int = None, stringency: int = 20, savename: str = None, log: bool = True, record: str = None, chunksize: int = 1 << 22) -> tuple:
+            '''Both strands counterpart of evaluateStream: a record of the FASTA file "path" is streamed once through scanChunksStrands, the forward scores
+            being passed on to a PeakCaller and the combined ones, if "savename" is provided, to a binary score track. Since the reverse strand is read
+            from right to left, its scores are spilled to a temporary file and their peaks are called afterwards, reading the file backwards in chunks,
+            so that no track is ever held in memory. The track is saved with the peaks of the combined scores, as callPeaks would call them on the track,
+            since the strands of the peaks are not part of the format. Returns a tuple containing the result of callPeaksStrands, the window size and
+            the number of scores.'''
+            if wsize == None:
+                wsize = inmod.average_source_length
+            import tempfile
+            caller = PeakCaller(wsize, stringency)
+            writer = None if savename == None else TrackWriter(savename, wsize, stringency)
+            combinedCaller = PeakCaller(wsize, stringency)
+            spill = tempfile.TemporaryFile()
+            peaks, saved = [], []
+            nscores = 0
+            for name, start, forward, reverse, combined in GenomeInOutWindow.scanChunksStrands(GenomeInOutWindow._recordChunks(path, record, chunksize, wsize-1), inmod, outmod, wsize, log):
+                peaks.extend([(i, score, '+') for i, score in caller.feed(forward)])
+                reverse.astype(numpy.float64).tofile(spill)
+                nscores += len(forward)
+                if writer != None:
+                    writer.write(combined)
+                    saved.extend([i for i, score in combinedCaller.feed(combined)])
+            if nscores == 0:
+                spill.close()
+                if writer != None:
+                    writer.discard()
+                raise ValueError('GenomeLengthError: record not found or window size exceeds its length')
+            caller = PeakCaller(wsize, stringency)
+            for end in range(nscores, 0, -chunksize):
+                spill.seek(8*max(end-chunksize, 0))
+                reverse = numpy.fromfile(spill, dtype=numpy.float64, count=end-max(end-chunksize, 0))
+                peaks.extend([(nscores-1-i, score, '-') for i, score in caller.feed(reverse[::-1])])
+            spill.close()
+            peaks.sort()
+            if writer != None:
+                writer.close(saved)
+            return ([i for i, score, strand in peaks], [score for i, score, strand in peaks], [strand for i, score, strand in peaks]), wsize, nscores
+
+        @staticmethod
+        def _recordChunks(path: str, records, chunksize: int, overlap: int, first: bool = True):
+            '''Chunks of FastaReader.chunks of the records of the file "path" named in "records" (a name or a list of names, all the records if None),
+            stopping after the first of them if "first" is set, so that by default the chunks of a single record are returned: the first one of the
+            file, unless its name is provided.'''
+            if isinstance(records, str):
+                records = [records]
+            current = None
+            for chunk in FastaReader.chunks(path, chunksize, overlap):
+                if first and current != None and chunk[0] != current:
+                    return
+                if records == None or chunk[0] in records:
+                    current = chunk[0]
+                    yield chunk
+
+        @staticmethod
+        def callPeaksStrands(forward: numpy.ndarray, reverse: numpy.ndarray, ws: int, stringency: int = 20) -> tuple:
+            '''Strand-aware peak calling on the tracks of evaluateStrands: the forward track is read left to right and the reverse track right to
+            left, as the reverse strand is read, so that on both strands the peaks mark the windows where the scores start rising along the strand.
+            Returns a tuple containing the positions of the peaks, as indexes of the tracks, their scores and their strands ('+' or '-'), sorted by position.'''
+            calls, scores = GenomeInOutWindow.callPeaks(forward, ws, stringency)
+            reverseCalls, reverseScores = GenomeInOutWindow.callPeaks(numpy.asarray(reverse)[::-1], ws, stringency)
+            peaks = sorted([(calls[i], scores[i], '+') for i in range(len(calls))] + [(len(reverse)-1-reverseCalls[i], reverseScores[i], '-') for i in range(len(reverseCalls))])
+            return [i for i, score, strand in peaks], [score for i, score, strand in peaks], [strand for i, score, strand in peaks]
+
+        @staticmethod
+        def rescore(scores, reference, variants: list, inmod: MarkovChain, outmod: MarkovChain, wsize: int, stringency: int = 20, peaks: list = None, margin: int = None) -> tuple:
+            '''Updates the score track "scores" of the genome "reference" (a string, or a PackedGenome, whose slices are strings) scanned with window size
+            "wsize", as if the genome had been edited by "variants", a list of (position, reference allele, alternative allele) tuples with 0-based positions
+            on the reference, the alleles being possibly empty for insertions and deletions. Only the windows containing a changed transition are scored
+            again, from the edited sequence around them; the other scores are moved by the length change of the variants before them.
+            Returns a tuple containing the new scores and, if the peak positions "peaks" of the old track are provided (as the first list of callPeaks or
+            the positions returned by FileHandler.trackFromFile), the new peaks as callPeaks would return them (see _rescorePeaks).'''
+            scores = numpy.asarray(scores)
+            length = len(scores)+wsize-1
+            variants = sorted([(int(position), ref.upper(), alt.upper()) for position, ref, alt in variants])
+            for j in range(len(variants)):
+                position, ref, alt = variants[j]
+                if position < 0 or position+len(ref) > length or (j > 0 and position < variants[j-1][0]+len(variants[j-1][1])):
+                    raise ValueError(f'VariantError: variant at position {position} is out of the genome or overlaps the previous one')
+                if reference[position:position+len(ref)].upper() != ref:
+                    raise ValueError(f'VariantError: reference allele {ref} does not match the genome at position {position}')
+            table = GenomeInOutWindow.logOddsTable(inmod, outmod)
+            nscores = len(scores)+sum([len(alt)-len(ref) for position, ref, alt in variants])
+            if nscores <= 0:
+                raise ValueError('GenomeLengthError: window size exceeds the length of the edited genome')
+            # windows of the edited genome containing a changed transition, merged into regions: each is a list [first window, last window + 1,
+            # index of its first variant, index after its last one], the windows between regions being the old ones moved by the shift before them
+            regions = []
+            shift = 0
+            for j, (position, ref, alt) in enumerate(variants):
+                start, end = max(position+shift-wsize+1, 0), min(position+shift+len(alt), nscores)
+                if len(regions) > 0 and start <= regions[-1][1]:
+                    regions[-1][1], regions[-1][3] = max(regions[-1][1], end), j+1
+                else:
+                    regions.append([start, end, j, j+1])
+                shift += len(alt)-len(ref)
+            pieces = []
+            done = 0
+            shift = 0
+            with profiler.stage('rescore'):
+                for start, end, first, last in regions:
+                    pieces.append(scores[done-shift:start-shift])
+                    sequence = []
+                    cursor = start-shift
+                    for position, ref, alt in variants[first:last]:
+                        sequence.extend([reference[cursor:position], alt])
+                        cursor = position+len(ref)
+                        shift += len(alt)-len(ref)
+                    sequence.append(reference[cursor:end+wsize-1-shift])
+                    local = GenomeInOutWindow.windowScores(Encoder.encode(''.join(sequence)), table, wsize)
+                    pieces.append(numpy.round(numpy.round(local[:max(end-start, 0)], 2), 1).astype(scores.dtype))
+                    done = max(end, start)
+                pieces.append(scores[done-shift:])
+                data = numpy.concatenate(pieces)
+            profiler.count('windows rescored', sum([max(end-start, 0) for start, end, first, last in regions]))
+            if peaks == None:
+                return data, None
+            return data, GenomeInOutWindow._rescorePeaks(scores, data, peaks, variants, regions, wsize, stringency, margin)
+
+        @staticmethod
+        def _rescorePeaks(old: numpy.ndarray, new: numpy.ndarray, peaks: list, variants: list, regions: list, wsize: int, stringency: int, margin: int = None) -> tuple:
+            '''Local peak calling for rescore. Since peak calling carries its state along the whole track, the peaks are not recomputed from the start:
+            the state of a PeakCaller is only known exactly right after it confirms a peak p, at the first window scoring at least its sharpness below p,
+            where the caller drops both its candidates to that window. Before each edited region, two PeakCallers are resumed from the last such
+            checkpoint of the old peaks, one on the old and one on the new track (from the start of the tracks if there is none), and run in step, by
+            blocks of "margin" windows (by default 10 times the window size), until their states coincide again past the region; if no checkpoint
+            lies between them and the next region, they simply carry on. The peaks only one of them emits are removed from or added to the old peaks,
+            the rest being moved by the shift of the variants; the old windows of the edited regions have no counterpart on the new track, so their
+            peaks are dropped and only the ones the new caller finds there are kept. Both callers always hold the state of a caller run from the start,
+            so the result is the one of callPeaks on the new track, provided "peaks" are the ones callPeaks gives on the old track.'''
+            if margin == None:
+                margin = 10*wsize
+            starts = numpy.array([region[0] for region in regions])
+            stops = numpy.array([region[1] for region in regions])
+            after = numpy.cumsum([sum([len(alt)-len(ref) for position, ref, alt in variants[first:last]]) for start, end, first, last in regions])
+            before = numpy.concatenate(([0], after[:-1]))
+            oldStarts, oldStops = starts - before, stops - after
+            peaks = sorted(peaks)
+            def oldOf(x):
+                # position on the old track of the window at "x" on the new one, for windows outside the edited regions or at their end; at an empty
+                # region, left by a deletion, the old windows of the deleted bases are counted as before "x"
+                j = numpy.searchsorted(stops, x, 'right')
+                return x - (int(after[j-1]) if j > 0 else 0)
+            def newOf(y):
+                # position on the new track of the window at "y" on the old one, or None if it lies in an edited region, where it has no counterpart
+                j = numpy.searchsorted(oldStops, y, 'right')
+                if j < len(regions) and y >= oldStarts[j]:
+                    return None
+                return y + (int(after[j-1]) if j > 0 else 0)
+            def state(caller, convert):
+                # the last peak is left out: after a checkpoint the candidate maximum is always past it, so it no longer matters
+                return (convert(caller.maxIndex), caller.maxValue, convert(caller.minIndex), caller.minValue)
+            oldCaller, newCaller = PeakCaller(wsize, stringency), PeakCaller(wsize, stringency)
+            def checkpoint(peak):
+                # window confirming the old peak "peak", compared in double precision as PeakCaller does, or None if the track never drops enough
+                height, a, step = float(old[peak]), peak+1, margin
+                while a < len(old):
+                    hits = numpy.flatnonzero(numpy.asarray(old[a:a+step], dtype=numpy.float64) - height <= -oldCaller.sharpness)
+                    if len(hits) > 0:
+                        return a + int(hits[0])
+                    a, step = a+step, 2*step
+                return None
+            def resume(caller, index, value, peak):
+                caller.maxIndex, caller.maxValue, caller.minIndex, caller.minValue, caller.lastPeak = index, value, index, value, peak
+                caller.position = index+1
+            removed, added = set(), set()
+            position = oldPosition = 0
+            r = 0
+            while r < len(regions):
+                # the callers hold the exact states at "position", which is before region r and after the previous ones, so that the old track
+                # is shifted there by the variants before region r; they jump to the last checkpoint before the region if it lies further
+                shift, target = int(before[r]), r
+                j = numpy.searchsorted(peaks, oldStarts[r]) - 1
+                while j >= 0 and peaks[j] >= oldPosition:
+                    c = checkpoint(peaks[j])
+                    if c != None and c < oldStarts[r]:
+                        value = float(old[c])
+                        resume(oldCaller, c, value, peaks[j])
+                        resume(newCaller, c+shift, value, peaks[j]+shift)
+                        position, oldPosition = c+1+shift, c+1
+                        break
+                    j -= 1
+                oldFound, newFound = [], []
+                while True:
+                    while r < len(regions) and regions[r][1] <= position:
+                        r += 1
+                    if position == len(new) or (r > target and (r == len(regions) or regions[r][0] > position) and state(oldCaller, newOf) == state(newCaller, int)):
+                        break
+                    stop = min(position+margin, len(new))
+                    j = numpy.searchsorted(stops, stop, 'right')
+                    if j < len(regions) and starts[j] < stop:
+                        stop = int(stops[j])  # blocks never end inside an edited region, where the two tracks are not aligned
+                    oldFound.extend(oldCaller.feed(old[oldPosition:oldOf(stop)]))
+                    newFound.extend(newCaller.feed(new[position:stop]))
+                    position, oldPosition = stop, oldOf(stop)
+                oldFound = set([(newOf(i), score) for i, score in oldFound if newOf(i) != None])
+                newFound = set(newFound)
+                removed |= set([i for i, score in oldFound - newFound])
+                added |= set([i for i, score in newFound - oldFound])
+            calls = sorted((set([newOf(i) for i in peaks if newOf(i) != None]) - removed) | added)
+            return calls, [round(float(new[i]), 1) for i in calls]
+
+class PeakCaller:
+    '''Incremental implementation of the peak calling algorithm of GenomeInOutWindow.callPeaks, which consumes the scores in chunks of any
+    size, keeping only a constant amount of state between them: the current candidate maximum and minimum and the last peak emitted.
+    Feeding the whole score track, in one or many chunks, gives the same peaks as the batch method, each peak being returned as soon as it is confirmed.'''
+    def __init__(self, ws: int, stringency: int = 20) -> None:
+        self.sharpness = numpy.log(ws)*stringency
+        self.threshold = numpy.log2(ws)
+        self.position = 0
+        self.maxIndex = 0
+        self.maxValue = None
+        self.minIndex = 0
+        self.minValue = None
+        self.lastPeak = -1
+
+    def feed(self, scores) -> list:
+        '''Consumes the next chunk of scores, returning the list of the peaks confirmed by it as (position, score) pairs.'''
+        with profiler.stage('peak calling'):
+            peaks = self._feed(scores)
+        profiler.count('peaks emitted', len(peaks))
+        return peaks
+
+    def _feed(self, scores) -> list:
+        scores = scores.tolist() if isinstance(scores, numpy.ndarray) else list(scores)
+        if len(scores) == 0:
+            return []
+        if self.maxValue == None:
+            self.maxValue = self.minValue = scores[0]
+        sharpness, threshold = self.sharpness, self.threshold
+        maxIndex, maxValue, minIndex, minValue, lastPeak = self.maxIndex, self.maxValue, self.minIndex, self.minValue, self.lastPeak
+        peaks = []
+        i = self.position
+        for v in scores:
+            if v > maxValue:
+                maxIndex, maxValue = i, v
+                if v - minValue >= sharpness:
+                    minIndex, minValue = i, v
+            if v < minValue:
+                minIndex, minValue = i, v
+                if v - maxValue <= -sharpness and maxValue >= threshold:
+                    if maxIndex != lastPeak:
+                        peaks.append((maxIndex, round(maxValue, 1)))
+                        lastPeak = maxIndex
+                    maxIndex, maxValue = i, v
+            i += 1
+        self.position = i
+        self.maxIndex, self.maxValue, self.minIndex, self.minValue, self.lastPeak = maxIndex, maxValue, minIndex, minValue, lastPeak
+        return peaks
+
+
+class TrackPyramid:
+    '''Multi-resolution summary of a score track for plotting: level l stores, for consecutive bins of factor^(l+1) positions, the minimum and
+    maximum score, so that any range of the track can be drawn as an envelope of about one bin per pixel without touching the single scores.
+    The pyramid is built in one chunked pass, which also works on memory-mapped tracks, and only the ranges drawn at full resolution
+    are read again from the original scores. The pyramid of a binary score track is saved next to it (see fromTrack), from where its
+    levels are memory-mapped, so that large tracks can be zoomed into without reading them whole again.'''
+    suffix = '.pyr'
+    magic = b'CPGPYRMD'
+    header = struct.Struct('<8sQQQ')
+    entry = struct.Struct('<QQ')
+
+    def __init__(self, scores, factor: int = 8, block: int = 1 << 22, levels: list = None) -> None:
+        self.scores = scores
+        self.length = len(scores)
+        self.factor = factor
+        self.levels = []
+        if levels != None:
+            self.levels = levels
+        elif self.length > 0:
+            step = max(block - block % factor, factor)
+            minima, maxima = [], []
+            for b in range(0, self.length, step):
+                chunk = numpy.asarray(scores[b:b+step], dtype=float)
+                lower, upper = TrackPyramid._reduce(chunk, chunk, factor)
+                minima.append(lower)
+                maxima.append(upper)
+            lower, upper, binsize = numpy.concatenate(minima), numpy.concatenate(maxima), factor
+            self.levels.append((binsize, lower, upper))
+            while len(lower) > 1:
+                lower, upper = TrackPyramid._reduce(lower, upper, factor)
+                binsize *= factor
+                self.levels.append((binsize, lower, upper))
+
+    def save(self, path: str) -> None:
+        '''Writes the levels to the file "path": a header with the track length, the factor and the number of levels, the bin size and number of
+        bins of each level, and then the lower and upper envelopes of each level as float32 arrays, which hold the float32 scores of a track exactly.'''
+        file = open(path, 'wb')
+        file.write(TrackPyramid.header.pack(TrackPyramid.magic, self.length, self.factor, len(self.levels)))
+        for binsize, lower, upper in self.levels:
+            file.write(TrackPyramid.entry.pack(binsize, len(lower)))
+        for binsize, lower, upper in self.levels:
+            numpy.asarray(lower, dtype=numpy.float32).tofile(file)
+            numpy.asarray(upper, dtype=numpy.float32).tofile(file)
+        file.close()
+
+    @staticmethod
+    def load(path: str, scores) -> 'TrackPyramid':
+        '''Reopens the pyramid saved by save in the file "path" for the track "scores", memory-mapping its levels, or returns None if the file
+        does not hold the pyramid of a track of the same length.'''
+        file = open(path, 'rb')
+        header = file.read(TrackPyramid.header.size)
+        if len(header) < TrackPyramid.header.size or not header.startswith(TrackPyramid.magic):
+            file.close()
+            return None
+        magic, length, factor, nlevels = TrackPyramid.header.unpack(header)
+        entries = [TrackPyramid.entry.unpack(file.read(TrackPyramid.entry.size)) for i in range(nlevels)]
+        file.close()
+        if length != len(scores):
+            return None
+        levels = []
+        offset = TrackPyramid.header.size + TrackPyramid.entry.size*nlevels
+        for binsize, nbins in entries:
+            envelopes = numpy.memmap(path, dtype=numpy.float32, mode='r', offset=offset, shape=(2, nbins))
+            levels.append((binsize, envelopes[0], envelopes[1]))
+            offset += 8*nbins
+        return TrackPyramid(scores, factor, levels=levels)
+
+    @staticmethod
+    def fromTrack(scores) -> 'TrackPyramid':
+        '''Pyramid of the scores to plot. For the memory-mapped scores of a binary score track (see FileHandler.trackFromFile) the pyramid saved next
+        to the track file is reopened if it is up to date, and otherwise built and saved there for the next time; other scores are summarised in memory.'''
+        filename = getattr(scores, 'filename', None)
+        if filename == None or len(scores) == 0:
+            return TrackPyramid(scores)
+        path = filename+TrackPyramid.suffix
+        with profiler.stage('track pyramid'):
+            if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(filename):
+                pyramid = TrackPyramid.load(path, scores)
+                if pyramid != None:
+                    return pyramid
+            pyramid = TrackPyramid(scores)
+            try:
+                pyramid.save(path)
+            except OSError:
+                pass  # tracks in read-only places are still plotted, only without saving their pyramid
+        return pyramid
+
+    @staticmethod
+    def _reduce(lower: numpy.ndarray, upper: numpy.ndarray, factor: int) -> tuple:
+        '''Groups the bins by "factor", returning the minima of "lower" and the maxima of "upper" in each group.'''
+        pad = -len(lower) % factor
+        if pad > 0:
+            lower = numpy.concatenate((lower, numpy.repeat(lower[-1], pad)))
+            upper = numpy.concatenate((upper, numpy.repeat(upper[-1], pad)))
+        return lower.reshape(-1, factor).min(axis=1), upper.reshape(-1, factor).max(axis=1)
+
+    def envelope(self, start: int, end: int, width: int = 2000) -> tuple:
+        '''Returns the positions and the lower and upper envelopes of the scores from "start" to "end", at the coarsest resolution still giving at least
+        "width" bins. Ranges short enough are returned at full resolution, in which case the two envelopes are the same array.'''
+        start, end = max(start, 0), min(end, self.length)
+        if end - start <= 2*width or len(self.levels) == 0:
+            scores = numpy.asarray(self.scores[start:end], dtype=float)
+            return numpy.arange(start, start+len(scores)), scores, scores
+        binsize, lower, upper = self.levels[0]
+        for level in self.levels[1:]:
+            if (end - start) // level[0] < width:
+                break
+            binsize, lower, upper = level
+        first, last = start // binsize, -(-end // binsize)
+        return numpy.arange(first, last)*binsize, lower[first:last], upper[first:last]
+
+
+_scanBuffers = {}
+
+def _attachScanBuffers(codesName: str, capacity: int, scoresName: str, nscores: int, table: numpy.ndarray, wsize: int) -> None:
+    '''Initializer of the parallel scanning workers: attaches the shared genome encoding and score buffers, kept for the lifetime of the process.'''
+    from multiprocessing import shared_memory
+    codesMemory = shared_memory.SharedMemory(name=codesName)
+    scoresMemory = shared_memory.SharedMemory(name=scoresName)
+    _scanBuffers.update(memory=(codesMemory, scoresMemory), table=table, wsize=wsize,
+                        codes=numpy.ndarray((capacity,), dtype=numpy.uint8, buffer=codesMemory.buf),
+                        scores=numpy.ndarray((nscores,), dtype=numpy.float64, buffer=scoresMemory.buf))
+
+def _scanTask(task: tuple) -> int:
+    '''Scores "count" windows of the shared genome encoding starting at "codesStart", writing them in the shared scores from "scoresStart".'''
+    codesStart, scoresStart, count = task
+    wsize = _scanBuffers['wsize']
+    data = GenomeInOutWindow.windowScores(_scanBuffers['codes'][codesStart:codesStart+count+wsize-1], _scanBuffers['table'], wsize)
+    _scanBuffers['scores'][scoresStart:scoresStart+count] = numpy.round(numpy.round(data, 2), 1)
+    return count
 
 def logRatioEvaluate(s1: float, s2: float, log: bool = True) -> float:
     '''Computes the log ratio evaluation from the scores of a sequence tested on two alternative models.'''
     if not log:
         return numpy.log2(s1) - numpy.log2(s2)
     else:
-        return round(s1 - s2, 2)
\ No newline at end of file
+        return round(s1 - s2, 2)
+
+def logRatioBatch(sequences, inmod: MarkovChain, outmod: MarkovChain) -> numpy.ndarray:
+    '''Vectorized counterpart of scoring each sequence of the iterable "sequences" on both models and taking logRatioEvaluate of the scores:
+    all the sequences are encoded in one concatenated array, the transition log-odds are accumulated in a single pass and the score of each
+    sequence is the difference of the prefix sums at its offsets, so that transitions across two sequences are never counted. Transitions
+    impossible on one of the models only make the score of their own sequence infinite (see GenomeInOutWindow.prefixSums).
+    Returns the unrounded log ratios as a numpy array, in the order of the sequences.'''
+    with profiler.stage('batch scoring'):
+        codes, offsets = Encoder.encodeBatch(sequences)
+        prefix = GenomeInOutWindow.prefixSums(GenomeInOutWindow.transitionScores(codes, GenomeInOutWindow.logOddsTable(inmod, outmod)))
+        last = len(prefix[0])-1
+        starts = numpy.minimum(offsets[:-1], last)
+        ends = numpy.minimum(numpy.maximum(offsets[1:]-inmod.order, offsets[:-1]), last)
+        ratios = GenomeInOutWindow.rangeSums(prefix, starts, ends)
+    profiler.count('sequences scored', len(offsets)-1)
+    return ratios
+
+def logRatioStream(sequences, inmod: MarkovChain, outmod: MarkovChain, batchsize: int = 1 << 22):
+    '''Streaming version of logRatioBatch for arbitrarily many sequences: the iterable is consumed in batches of about "batchsize" bases,
+    each scored in one vectorized pass, and the arrays of the log ratios of the batches are yielded in order.'''
+    batch = []
+    bases = 0
+    for sequence in sequences:
+        batch.append(sequence)
+        bases += len(sequence)
+        if bases >= batchsize:
+            yield logRatioBatch(batch, inmod, outmod)
+            batch = []
+            bases = 0
+    if len(batch) > 0:
+        yield logRatioBatch(batch, inmod, outmod)
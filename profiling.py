@@ -0,0 +1,90 @@
+import sys
+import time
+import resource
+import contextlib
+
+class Profiler:
+    '''Lightweight instrumentation of the pipeline: per-stage wall time and number of calls, named counters (bases processed, windows scored,
+    peaks emitted...) and the largest rise of the memory high-water mark of the process during a call of each stage, optionally together
+    with a cProfile run. The rise is the memory a stage needed beyond the peak reached before it, so stages staying within it report 0.
+    The library code reports to the shared instance "profiler" below; while it is disabled, which is the default, a stage costs a single
+    attribute check and returns a shared no-op context, so that the instrumentation can stay in the hot paths.'''
+    def __init__(self) -> None:
+        self.enabled = False
+        self.stages = {}
+        self.counters = {}
+        self.started = None
+        self.profile = None
+        self.idle = contextlib.nullcontext()
+
+    def enable(self, cprofile: bool = False) -> None:
+        '''Starts collecting measurements, and a cProfile run as well if "cprofile" is set.'''
+        self.enabled = True
+        self.started = time.perf_counter()
+        if cprofile:
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def disable(self) -> None:
+        '''Stops collecting measurements, keeping the ones collected so far.'''
+        self.enabled = False
+        if self.profile != None:
+            self.profile.disable()
+
+    def stage(self, name: str):
+        '''Context manager timing the enclosed block as part of the stage "name".'''
+        if not self.enabled:
+            return self.idle
+        return self._stage(name)
+
+    @contextlib.contextmanager
+    def _stage(self, name: str):
+        start = time.perf_counter()
+        peak = Profiler.peakRss()
+        try:
+            yield
+        finally:
+            self.addTime(name, time.perf_counter() - start, rise = Profiler.peakRss() - peak)
+
+    def addTime(self, name: str, seconds: float, calls: int = 1, rise: float = None) -> None:
+        '''Adds "seconds" to the stage "name", for stages whose time cannot be measured by a single block, such as generators; "rise" is
+        the rise of the peak memory of the process during the calls, in megabytes, if measured.'''
+        if self.enabled:
+            stage = self.stages.setdefault(name, [0.0, 0, None])
+            stage[0] += seconds
+            stage[1] += calls
+            if rise != None:
+                stage[2] = max(stage[2] or 0.0, rise)
+
+    def count(self, name: str, n: int = 1) -> None:
+        '''Increases the counter "name" by "n".'''
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @staticmethod
+    def peakRss() -> float:
+        '''Peak resident memory of the process so far, in megabytes.'''
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss/(1 << 20) if sys.platform == 'darwin' else rss/(1 << 10)
+
+    def report(self) -> str:
+        '''Returns the stage breakdown and the counters as a printable table. Nested stages are included in the time of the enclosing ones.'''
+        total = time.perf_counter() - self.started if self.started != None else 0.0
+        lines = ['Stage breakdown:', f'{"stage":<24}{"seconds":>10}{"share":>8}{"calls":>8}{"peak rise MB":>14}']
+        for name, (seconds, calls, rise) in self.stages.items():
+            lines.append(f'{name:<24}{seconds:>10.3f}{100*seconds/total if total > 0 else 0:>7.1f}%{calls:>8}{"-" if rise == None else f"{rise:.1f}":>14}')
+        if len(self.counters) > 0:
+            lines.append('Counters:')
+            for name, value in self.counters.items():
+                lines.append(f'{name:<24}{value:>18,}')
+        lines.append(f'Total wall time: {total:.3f} s; process peak RSS: {Profiler.peakRss():.1f} MB')
+        return '\n'.join(lines)
+
+    def dump(self, path: str) -> None:
+        '''Writes the statistics of the cProfile run to "path", to be read with the pstats module.'''
+        if self.profile != None:
+            self.profile.dump_stats(path)
+
+
+profiler = Profiler()
@@ -0,0 +1,195 @@
+import sys
+import cli
+import json
+import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from markov import MarkovChain, GenomeInOutWindow, logRatioBatch
+
+'''
+Resident scoring service: loads the inside and outside models once and serves query scoring, genome scans and peak calling on a local
+TCP socket, so that a pipeline firing many small queries pays for the imports and the models only once. The protocol is one JSON object
+per line in both directions; each request can carry an "id", copied in its response, so that a client can send several requests before
+reading the responses, which are written as soon as they are ready and therefore possibly out of order. The requests are:
+
+{"op": "score", "sequence": <str>}: log ratio of the sequence on the inside and outside models, as computed by test.py with -q;
+{"op": "scan", "sequence": <str>, "wsize": <int>, "stringency": <int>, "scores": <bool>}: scans the sequence as GenomeInOutWindow.evaluate
+    and calls its peaks, returning the scores too if "scores" is set (window size and stringency default to the ones of test.py);
+{"op": "peaks", "scores": [<float>, ...], "wsize": <int>, "stringency": <int>}: calls the peaks of a score track;
+{"op": "stats"}: number of requests served, of score batches and of sequences in them, and the uptime.
+
+Concurrent score requests, from any number of connections, are coalesced into batches scored in one vectorized pass by logRatioBatch:
+a batch is closed when it reaches --max-batch sequences or --batch-delay milliseconds after its first request. Scans of sequences longer
+than --inline bases are sent to a pool of worker processes, the others being run on a thread next to the score batches. Errors are
+reported as {"id": ..., "error": <message>} without closing the connection, as are the requests longer than --max-request bytes, which are
+skipped without being buffered whole (their error has no id, since they are not read). See client.py for a client and loadtest.py for a load test.
+
+The flags, the ones of the serve subcommand of cli.py that this script runs, are:
+
+--host <str>: address to listen on (default 127.0.0.1);
+--port <int>: port to listen on (default 8765);
+-F , --fast: use the pre-computed models for CpG islands instead of the ones trained at runtime (default False);
+-o <int>: set the order of the Markov chains trained at runtime (default 1);
+--no-cache : always train the models at runtime, ignoring and not updating the model cache;
+-j <int>: number of worker processes for the large scans (default 1, 0 for one per core);
+--max-batch <int>: largest number of sequences scored in one batch (default 1024);
+--batch-delay <float>: longest wait, in milliseconds, for more sequences to join a batch (default 2);
+--inline <int>: longest sequence scanned without the worker processes (default 100000);
+--max-request <int>: longest request line, in bytes (default 67108864, 64 MiB).
+'''
+
+_workerModels = {}
+
+def _initWorker(inmod: MarkovChain, outmod: MarkovChain) -> None:
+    _workerModels['in'], _workerModels['out'] = inmod, outmod
+
+def _scanWorker(sequence: str, wsize: int, stringency: int, scores: bool) -> dict:
+    return ScoringService.scan(_workerModels['in'], _workerModels['out'], sequence, wsize, stringency, scores)
+
+class ScoringService:
+    '''Asyncio server of the scoring requests described above, holding the models "inmod" and "outmod" for its whole lifetime.'''
+    def __init__(self, inmod: MarkovChain, outmod: MarkovChain, workers: int = 1, maxBatch: int = 1024, batchDelay: float = 0.002, inline: int = 100000, maxRequest: int = 1 << 26) -> None:
+        self.inmod = inmod
+        self.outmod = outmod
+        self.maxBatch = maxBatch
+        self.batchDelay = batchDelay
+        self.inline = inline
+        self.maxRequest = maxRequest
+        self.pending = []
+        self.flush = None
+        self.threads = ThreadPoolExecutor(1)
+        # the workers are started on the first large scan, from the running event loop: forked then, they would inherit the threads of the
+        # executor and of the loop in whatever state they are, so they are started from a fresh process instead
+        methods = multiprocessing.get_all_start_methods()
+        self.processes = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn'),
+                                             initializer=_initWorker, initargs=(inmod, outmod))
+        self.started = time.time()
+        self.stats = {'requests': 0, 'batches': 0, 'batched': 0}
+
+    @staticmethod
+    def scan(inmod: MarkovChain, outmod: MarkovChain, sequence: str, wsize: int, stringency: int, scores: bool) -> dict:
+        '''Scans the sequence and calls its peaks, returning the response of a scan request.'''
+        data, wsize = GenomeInOutWindow.evaluate(sequence, inmod, outmod, wsize, False)
+        calls, heights = GenomeInOutWindow.callPeaks(data, wsize, stringency)
+        response = {'wsize': wsize, 'peaks': calls, 'heights': heights}
+        if scores:
+            response['scores'] = data.tolist()
+        return response
+
+    async def score(self, sequence: str) -> float:
+        '''Queues the sequence in the current batch and waits for its log ratio.'''
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((sequence, future))
+        if len(self.pending) >= self.maxBatch:
+            self._scoreBatch()
+        elif self.flush == None:
+            self.flush = asyncio.get_running_loop().call_later(self.batchDelay, self._scoreBatch)
+        return await future
+
+    def _scoreBatch(self) -> None:
+        if self.flush != None:
+            self.flush.cancel()
+            self.flush = None
+        batch, self.pending = self.pending, []
+        if len(batch) == 0:
+            return
+        self.stats['batches'] += 1
+        self.stats['batched'] += len(batch)
+        work = asyncio.get_running_loop().run_in_executor(self.threads, logRatioBatch, [sequence for sequence, future in batch], self.inmod, self.outmod)
+        def resolve(work):
+            error = work.exception()
+            for j, (sequence, future) in enumerate(batch):
+                if future.done():
+                    continue
+                if error != None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(round(float(work.result()[j]), 2))
+        work.add_done_callback(resolve)
+
+    async def handle(self, request: dict) -> dict:
+        '''Computes the response to a single request.'''
+        self.stats['requests'] += 1
+        op = request.get('op')
+        loop = asyncio.get_running_loop()
+        if op == 'score':
+            return {'ratio': await self.score(str(request['sequence']))}
+        elif op == 'scan':
+            sequence = str(request['sequence'])
+            args = (sequence, request.get('wsize'), int(request.get('stringency', 20)), bool(request.get('scores', False)))
+            if len(sequence) > self.inline:
+                return await loop.run_in_executor(self.processes, _scanWorker, *args)
+            return await loop.run_in_executor(self.threads, ScoringService.scan, self.inmod, self.outmod, *args)
+        elif op == 'peaks':
+            calls, heights = await loop.run_in_executor(self.threads, GenomeInOutWindow.callPeaks, request['scores'], int(request['wsize']), int(request.get('stringency', 20)))
+            return {'peaks': calls, 'heights': heights}
+        elif op == 'stats':
+            return dict(self.stats, uptime=round(time.time()-self.started, 3))
+        raise ValueError(f'RequestError: unknown operation {op}')
+
+    async def _respond(self, line: bytes, writer: asyncio.StreamWriter) -> None:
+        request = {}
+        try:
+            request = json.loads(line)
+            response = await self.handle(request)
+        except Exception as error:
+            response = {'error': str(error) or type(error).__name__}
+        if isinstance(request, dict) and 'id' in request:
+            response['id'] = request['id']
+        writer.write(json.dumps(response).encode()+b'\n')
+
+    async def connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''Serves the requests of a connection until it is closed, each in its own task.'''
+        tasks = set()
+        try:
+            while True:
+                try:
+                    line = await reader.readuntil(b'\n')
+                except asyncio.IncompleteReadError as error:
+                    line = error.partial  # last line without a line break, empty once the connection is closed
+                except asyncio.LimitOverrunError:
+                    await self._skipLine(reader)
+                    writer.write(json.dumps({'error': f'RequestError: request longer than {self.maxRequest} bytes'}).encode()+b'\n')
+                    continue
+                if len(line) == 0:
+                    break
+                if len(line.strip()) == 0:
+                    continue
+                task = asyncio.create_task(self._respond(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                if writer.transport.get_write_buffer_size() > 1 << 20:
+                    await writer.drain()
+            if len(tasks) > 0:
+                await asyncio.wait(tasks)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _skipLine(reader: asyncio.StreamReader) -> None:
+        # the overlong line is discarded as it comes, without being buffered beyond the limit
+        while True:
+            try:
+                await reader.readuntil(b'\n')
+                return
+            except asyncio.LimitOverrunError as error:
+                await reader.readexactly(error.consumed)
+            except asyncio.IncompleteReadError:
+                return
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8765) -> None:
+        '''Listens on "host" and "port" until cancelled.'''
+        server = await asyncio.start_server(self.connection, host, port, limit=self.maxRequest)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.threads.shutdown()
+            self.processes.shutdown()
+
+if __name__ == '__main__':
+    cli.main(['serve'] + sys.argv[1:])
@@ -1,7 +1,5 @@
-import numpy
-from markov import MarkovChain, GenomeInOutWindow, logRatioEvaluate
-from utils import Generator, CpGInModel, CpGOutModel, FileHandler
 import sys
+import cli
 
 '''
 Markov chains bioinformatics assignment:
@@ -12,8 +10,32 @@ for such genome-wide test.
 The file utils.py contains the code for some useful purposes, such as constants, the Generator for random sequences or for sequences from files and the Model
 system of the software, developed to be easily extended in custom features.
 
+The file profiling.py contains the instrumentation reported by the --profile flag, which costs nothing while disabled.
+
+The file hmm.py contains the hidden Markov model segmentation of a genome into CpG islands, decoding the inside and outside models
+over the whole sequence in one pass instead of scoring fixed windows, and reporting the islands as BED intervals.
+
+The file server.py contains a resident scoring service, which loads the models once and serves query scoring, scans and peak calling on a
+local socket, batching concurrent queries; client.py contains its client and loadtest.py a load test reporting latency percentiles.
+
+The file cache.py contains the persistent cache of the models trained at runtime, stored in the .model_cache directory and keyed by
+the content of the training files, so that only the first run after a change of the training data actually trains the models.
+
+The file fasta.py contains the streaming FASTA reader, used to scan whole chromosomes chunk by chunk with bounded memory, and the packed
+2 bits per base genome, saved next to the FASTA file (.packed.npz) and used to draw random fragments free of unassigned nucleotides.
+It also contains the faidx-style index (.fai) used by cpg_data_setup.py to fetch the annotated islands by seeking straight to them, so that
+the training sets of every chromosome of a genome can be built in one pass without loading any chromosome whole (buildTrainingSets).
+
+The file cli.py contains the entry point with one subcommand per operation (query, batch, scan, segment, read, convert, rescore, serve),
+which imports the modules of each operation only when it runs, so that a single query starts in a fraction of the time of this script;
+the startup time of its query mode is measured by benchmark.py against a target of 200 ms.
+
+The files test_markov.py and test_hmm.py contain the automated equivalence checks of the fast scanning, rescoring and decoding engines
+against the straightforward computations they replace, run with "python -m pytest".
+
 The test.py file contains the code for testing the Markov chain construction and performance in evaluating queries and scanning genomes. The CLI interface is sys
-based, so the user can easily provide the software the desired paramenters and instructions for the actions to be performed. The interface only tests with
+based, so the user can easily provide the software the desired paramenters and instructions for the actions to be performed: the flags are translated into
+the equivalent subcommand of cli.py, which loads the models and runs the operation. The interface only tests with
 the human chromosome 22 CpG islands in/out models In detail, the user can declare
 the following flags:
 
@@ -23,18 +45,38 @@ the following flags:
 -l <int>: set the length of the random query to generate (default 1000);
 -L , --log : use sum of log probabilities to evaluate a query (default True, non-changeable in scan mode, disabling it might run into Errors for very low scores);
 -s : set the mode to genome scanning;
+--hmm <str>: set the mode to island segmentation of all the records of the file declared with -f by a hidden Markov model built on the
+          inside and outside models (Viterbi decoding), writing the islands in the BED file whose path has to be provided;
+--posterior : in segmentation mode, use posterior decoding instead, the islands being the bases with posterior probability above 0.5;
+-b <str>: set the mode to batch evaluation of all the sequences of a file (one per row, or the records of a FASTA file), printing for each
+          of them its index, its length and its log ratio as soon as its batch is scored;
+--strands : in scan mode, scan both strands of the genome at once, calling the peaks of each strand in its own reading direction and
+          plotting or saving the best score of the two strands for each window, saved with its own peaks (with a single window size only);
 -P , --plot : enable data plotting when in scan mode (default False);
--w <int>: set the window size in scan mode;
+-w <int>[,<int>,...]: set the window size in scan mode; a comma separated list of sizes scans the genome once for all of them, calling the
+          peaks of each size with its own thresholds and combining the sites found by several sizes (saved tracks get the size before the extension);
+-o <int>: set the order of the Markov chains trained at runtime (default 1, not available with the pre-computed models; orders above 1 add a pseudo-count of 1);
 -F , --fast: use pre-computed models for CpG islands instead of runtime train them (default False);
+--no-cache : always train the models at runtime, ignoring and not updating the model cache;
 -S <int>: set the stringency for peak calling when plotting scan mode data (default 20);
 -M , --mute : turns off unnecessary logging, which does not include the outcome of the requested operation (default True);
 -k , --peak : enables peak calling on the positional scores in scan mode, including graphical representation;
---save <str>: when in scan mode, writes the scores and some parameters from the scannning in a file whose path has to be provided.
+--region <int>:<int>: restricts the initial view of the plot to the given range of positions (zooming and panning are redrawn at the right resolution);
+-j <int>: set the number of worker processes used in scan mode (default 1, 0 for one per core);
+--save <str>: when in scan mode, writes the scores and some parameters from the scannning in a binary score track file whose path has to be provided,
+          next to which the envelopes used for plotting are saved as well (.pyr), so that --read can zoom into large tracks without reading them whole;
+--read <str>: plots the scan saved in a file, either a binary score track or a text file from previous versions;
+--rescore <str> <str> <str>: updates a scan saved in a file (first path) of the genome declared with -f after the variants of a VCF file (second path),
+          rescoring only the windows they change and saving the new scan and its peaks as a binary score track (third path);
+--convert <str> <str>: converts a scan saved in the old text format (first path) into a binary score track (second path);
+--profile [<str>]: prints the time spent in each stage (reading, training, scanning, peak calling, writing), the number of bases, windows and peaks
+          processed, how much each stage raised the peak memory and the peak memory of the run, before any plot is shown; if a path is given,
+          a cProfile run is also saved there for pstats.
 
 Mind that declaring scan mode overrides query declaration, however can be combined with the randomness flag to generate a completely random genome
 or with the path flag to provide the file the user wants to extract the genome from. Furthermore, only declaring the path will result in
-reading the whole file and using it as the genome, whereas declaring also the randomness flag will result in only extracting
-a string from such genome.
+scanning the first record of the file as the genome, streamed in chunks so that it is never loaded whole, whereas declaring also the randomness
+flag will result in only extracting a string from such genome.
 
 The files used to pre-compute the Markov models are also made available, with chr22.fa containing the fasta sequence of hg19 chromosome 22, 
 chr22_annot.txt containing the annotation of all the CpG islands found in hg19 chromosome 22, CpG.txt containing row by row the sequence of
@@ -53,126 +95,119 @@ Whereas for the scan mode:
 x. Any declared query sequence here is ignored
 '''
 
-args = sys.argv[1:]
-query = None
-path = None
-log_prob = True
-scan = False
-random = False
-plot = False
-l = 1000
-wsize = None
-fast = False
-stringency = 20
-logging = True
-callPeaks = False
-save = False
-savename = None
-read = False
-readpath = None
-
-for i in range(len(args)):
-    if args[i] == '-q':
-        query = args[i+1]
-    elif args[i] == '-f':
-        path = args[i+1]
-    elif args[i] == '-r':
-        random = True
-    elif args[i] == '-l':
-        l = int(args[i+1])
-    elif args[i] == '-L' or args[i] == '--log':
-        log_prob = False
-    elif args[i] == '-s':
-        scan = True
-        read = False
-    elif args[i] == '-P' or args[i] == '--plot':
-        plot = True
-    elif args[i] == '-w':
-        wsize = int(args[i+1])
-    elif args[i] == '-F' or args[i] == '--fast':
-        fast = True
-    elif args[i] == '-S':
-        stringency = int(args[i+1])
-    elif args[i] == '-M' or args[i] == '--mute':
-        logging = False
-    elif args[i] == '-k' or args[i] == '--peak':
-        callPeaks = True
-    elif args[i] == '--save':
-        save = True
-        savename = args[i+1]
-    elif args[i] == '--read':
-        read = True
-        scan = False
-        readpath = args[i+1]
-
-if read:
-    scores, l, wsize, stringency, *peaks = FileHandler.evaluationFromFile(readpath)
-elif scan:
-    if path != None and random:
-        query = Generator.randomGenomeFromFile(path, l)
-    elif path != None:
-        query = Generator.genomeFromFile(path)
-    elif random:
-        query = Generator.randomGenome(l)
-    else:
-        raise ValueError('FlagError: scan mode declared, either random generation of filepath must be declared as well')
-elif path != None:
-    query = Generator.randomSequenceFromFile(path)
-elif query != None:
-    pass
-elif random:
-    query = Generator.randomSequence(l)
-else:
-    if query == None:
-        raise ValueError('ArgumentError: no query sequence provided')
-
-if not read:
-    if fast:
-        insidemod = MarkovChain(model = CpGInModel)
-        outsidemod = MarkovChain(model = CpGOutModel)
-    else:
-        insidemod = MarkovChain(path = 'CpG.txt')
-        outsidemod = MarkovChain(path = 'outside.txt')
-
-    if not scan:
-        if logging:
-            print(f'Parameters set: scan: {scan}; filepath: {path}; random: {random}; length: {l}; fast: {fast}')
-            print(f'Evaluating query sequence: "{query}"')
-            print(f'Reference inside/outside model derived from hg19 chromosome 22 CpG islands sequences and other random chromosome 22 sequences')
-        if log_prob:
-            if logging:
-                print('Using sum of the logarithms to evaluate query score')
-
-        if not log_prob:
-            insidescore = insidemod.scoreQuery(query, log_prob)
-            outsidescore = outsidemod.scoreQuery(query, log_prob)
-            print(f'Inside score:', insidescore)
-            print(f'Outside score:', outsidescore)
-            logratio = logRatioEvaluate(insidescore, outsidescore, log_prob)
-        else:
-            insidescore = insidemod.scoreQuery(query, log_prob)
-            outsidescore = outsidemod.scoreQuery(query, log_prob)
-            print(f'Inside score:', insidescore)
-            print(f'Outside score:', outsidescore)
-            logratio = logRatioEvaluate(insidescore, outsidescore, log_prob)
-
-        print(f'Final log ratio evaluation: {logratio}')
-
+def arguments(args: list) -> list:
+    '''Command line of cli.py equivalent to the flags of this script, the mode being chosen with the precedence described above.'''
+    query = None
+    path = None
+    log_prob = True
+    scan = False
+    random = False
+    plot = False
+    l = 1000
+    wsizes = None
+    fast = False
+    stringency = 20
+    logging = True
+    callPeaks = False
+    savename = None
+    readpath = None
+    convert = None
+    rescore = None
+    batchpath = None
+    hmmpath = None
+    posterior = False
+    strands = False
+    region = None
+    workers = 1
+    order = 1
+    usecache = True
+    profiling = False
+    profilepath = None
+
+    for i in range(len(args)):
+        if args[i] == '-q':
+            query = args[i+1]
+        elif args[i] == '-f':
+            path = args[i+1]
+        elif args[i] == '-r':
+            random = True
+        elif args[i] == '-l':
+            l = int(args[i+1])
+        elif args[i] == '-L' or args[i] == '--log':
+            log_prob = False
+        elif args[i] == '-b':
+            batchpath = args[i+1]
+        elif args[i] == '--hmm':
+            hmmpath = args[i+1]
+        elif args[i] == '--posterior':
+            posterior = True
+        elif args[i] == '--strands':
+            strands = True
+        elif args[i] == '-s':
+            scan = True
+            readpath = None
+        elif args[i] == '-P' or args[i] == '--plot':
+            plot = True
+        elif args[i] == '-w':
+            wsizes = args[i+1]
+        elif args[i] == '-o':
+            order = int(args[i+1])
+        elif args[i] == '-F' or args[i] == '--fast':
+            fast = True
+        elif args[i] == '--no-cache':
+            usecache = False
+        elif args[i] == '-S':
+            stringency = int(args[i+1])
+        elif args[i] == '-M' or args[i] == '--mute':
+            logging = False
+        elif args[i] == '-k' or args[i] == '--peak':
+            callPeaks = True
+        elif args[i] == '--save':
+            savename = args[i+1]
+        elif args[i] == '-j':
+            workers = int(args[i+1])
+        elif args[i] == '--read':
+            scan = False
+            readpath = args[i+1]
+        elif args[i] == '--region':
+            region = args[i+1]
+        elif args[i] == '--convert':
+            convert = (args[i+1], args[i+2])
+        elif args[i] == '--rescore':
+            rescore = (args[i+1], args[i+2], args[i+3])
+        elif args[i] == '--profile':
+            profiling = True
+            if i+1 < len(args) and not args[i+1].startswith('-'):
+                profilepath = args[i+1]
+
+    if convert != None:
+        command = ['convert', *convert]
+    elif rescore != None:
+        if path == None:
+            raise ValueError('FlagError: rescoring declared, the filepath of the scanned genome must be declared as well')
+        command = ['rescore', *rescore, '-f', path]
+    elif readpath != None:
+        command = ['read', readpath]
+    elif batchpath != None:
+        command = ['batch', batchpath]
+    elif hmmpath != None:
+        if path == None:
+            raise ValueError('FlagError: segmentation mode declared, the filepath must be declared as well')
+        command = ['segment', path, hmmpath] + (['--posterior'] if posterior else [])
+    elif scan:
+        command = ['scan', '-l', str(l), '-S', str(stringency), '-j', str(workers)]
+        command += (['-f', path] if path != None else []) + (['-r'] if random else []) + (['-w', wsizes] if wsizes != None else [])
+        command += (['--strands'] if strands else []) + (['-P'] if plot else []) + (['-k'] if callPeaks else []) + (['--save', savename] if savename != None else [])
     else:
-        if wsize == None:
-            if logging:
-                print(f'Parameters set: scan: {scan}; filepath: {path}; random: {random}; length: {l}; fast: {fast}; plot: {plot}; peak call: {callPeaks}; stringency: {stringency}; window size: {insidemod.average_source_length}')
-                print(f'Scanning {l} bases long genome, window size: {insidemod.average_source_length}, peak sharpness: {round(numpy.log(insidemod.average_source_length)*stringency)}, peak calling threshold: {round(numpy.log2(insidemod.average_source_length), 1)}', '\n')
-        else:
-            if logging:
-                print(f'Parameters set: scan: {scan}; filepath: {path}; random: {random}; length: {l}; fast: {fast}; plot: {plot}; peak call: {callPeaks}; stringency: {stringency}; window size: {wsize}')
-                print(f'Scanning {l} bases long genome, window size: {wsize}, peak sharpness: {round(numpy.log(wsize)*stringency)}, peak calling threshold: {round(numpy.log2(wsize), 1)}', '\n')
-        data, wsize = GenomeInOutWindow.evaluate(query, insidemod, outsidemod, wsize, logging)
-        call, scores = GenomeInOutWindow.callPeaks(data, wsize, stringency)
-        print(f'Potential start sites identified [position, score]: {[[call[i], scores[i]] for i in range(len(call))]}')
-        if save:
-            FileHandler.writeEvaluation(savename, data, wsize, stringency, GenomeInOutWindow.callPeaks(data, wsize, stringency))
-        if plot:
-            GenomeInOutWindow.plotScore(data, wsize, stringency, callPeaks)
-else:
-    GenomeInOutWindow.quickPlot(scores, wsize, stringency, peaks)
+        command = ['query'] + ([query] if query != None else []) + ['-l', str(l)]
+        command += (['-f', path] if path != None else []) + (['-r'] if random else []) + ([] if log_prob else ['--no-log'])
+    if region != None and command[0] in ('scan', 'read'):
+        command += ['--region', region]
+    command += ['-o', str(order)] + (['-F'] if fast else []) + ([] if usecache else ['--no-cache']) + ([] if logging else ['-M'])
+    # last, since the optional path of --profile would take the positional argument following it
+    if profiling:
+        command += ['--profile'] + ([profilepath] if profilepath != None else [])
+    return command
+
+if __name__ == '__main__':
+    cli.main(arguments(sys.argv[1:]))
@@ -0,0 +1,102 @@
+import os
+import random
+import numpy
+import pytest
+from markov import MarkovChain
+from hmm import IslandHMM
+from utils import CpGInModel, CpGOutModel, Encoder
+
+'''
+Checks of the blocked Viterbi and posterior decoding of hmm.py against naive per-base recurrences of the same two-state model, run with pytest.
+'''
+
+inmod = MarkovChain(model = CpGInModel)
+outmod = MarkovChain(model = CpGOutModel)
+
+def impossible(outside: str) -> tuple:
+    '''Models trained without pseudo-counts on sequences lacking some bases, whose missing transitions are impossible: the inside model never
+    sees T, and the outside model never sees the bases missing from "outside", the transitions impossible on both being neutral.'''
+    rng = random.Random(len(outside))
+    return MarkovChain(s = ''.join(rng.choices('ACGCG', k=2000)), pseudocount = 0), MarkovChain(s = ''.join(rng.choices(outside, k=2000)), pseudocount = 0)
+
+models = {'pre-computed': (inmod, outmod), 'impossible inside': impossible('ACGT'), 'impossible on both': impossible('CGT')}
+
+def genome(rng: random.Random, length: int) -> str:
+    sequence = []
+    while len(sequence) < length:
+        sequence.extend(rng.choices('N' if rng.random() < 0.03 else 'CG' if rng.random() < 0.3 else 'ACGT', k=rng.randint(5, 120)))
+    return ''.join(sequence[:length])
+
+def split(hmm: IslandHMM, sequence: str) -> tuple:
+    '''Log emissions of the bases by each state, up to a common term per base: the log-odds goes to the inside state, unless it is infinite,
+    in which case the state it rules out gets -inf and the other one 0.'''
+    emissions = hmm.emissions(Encoder.encode(sequence))
+    return numpy.where(emissions == numpy.inf, 0.0, emissions), numpy.where(emissions == numpy.inf, -numpy.inf, 0.0)
+
+def naiveViterbi(hmm: IslandHMM, sequence: str) -> numpy.ndarray:
+    '''Most probable state of each base, True inside an island, by the textbook recurrence on the scores of both states.'''
+    emissions, others = split(hmm, sequence)
+    inside, outside = numpy.zeros(len(emissions)), numpy.zeros(len(emissions))
+    fromInside, fromOutside = numpy.zeros(len(emissions), dtype=bool), numpy.zeros(len(emissions), dtype=bool)
+    inside[0], outside[0] = hmm.prior + emissions[0], others[0]
+    for i in range(1, len(emissions)):
+        fromInside[i] = inside[i-1]+hmm.stay >= outside[i-1]+hmm.enter
+        fromOutside[i] = inside[i-1]+hmm.leave > outside[i-1]+hmm.away
+        inside[i] = max(inside[i-1]+hmm.stay, outside[i-1]+hmm.enter) + emissions[i]
+        outside[i] = max(inside[i-1]+hmm.leave, outside[i-1]+hmm.away) + others[i]
+    states = numpy.zeros(len(emissions), dtype=bool)
+    states[-1] = inside[-1] >= outside[-1]
+    for i in range(len(emissions)-1, 0, -1):
+        states[i-1] = fromInside[i] if states[i] else fromOutside[i]
+    return states
+
+def naivePosterior(hmm: IslandHMM, sequence: str) -> numpy.ndarray:
+    '''Posterior probability of each base of lying inside an island, by the forward-backward recurrences in log space.'''
+    emissions, others = split(hmm, sequence)
+    n = len(emissions)
+    forward, backward = numpy.zeros((n, 2)), numpy.zeros((n, 2))
+    forward[0] = hmm.prior + emissions[0], others[0]
+    for i in range(1, n):
+        forward[i, 0] = numpy.logaddexp(forward[i-1, 0]+hmm.stay, forward[i-1, 1]+hmm.enter) + emissions[i]
+        forward[i, 1] = numpy.logaddexp(forward[i-1, 0]+hmm.leave, forward[i-1, 1]+hmm.away) + others[i]
+    for i in range(n-2, -1, -1):
+        backward[i, 0] = numpy.logaddexp(hmm.stay+emissions[i+1]+backward[i+1, 0], hmm.leave+others[i+1]+backward[i+1, 1])
+        backward[i, 1] = numpy.logaddexp(hmm.enter+emissions[i+1]+backward[i+1, 0], hmm.away+others[i+1]+backward[i+1, 1])
+    odds = forward[:, 0]+backward[:, 0] - forward[:, 1]-backward[:, 1]
+    return 1/(1+numpy.exp(-odds))
+
+def intervals(name: str, states: numpy.ndarray) -> list:
+    edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], states.astype(int), [0]))))
+    return [(name, int(start), int(end)) for start, end in zip(edges[::2], edges[1::2])]
+
+@pytest.mark.parametrize('pair', models)
+def test_viterbi_matches_naive(tmp_path, pair):
+    rng = random.Random(0)
+    hmm = IslandHMM(*models[pair], 60, 300)
+    records = [genome(rng, rng.randint(1, 4000)) for i in range(4)]
+    path = os.path.join(tmp_path, 'genome.fa')
+    file = open(path, 'w')
+    for j, sequence in enumerate(records):
+        file.write(f'>r{j}\n{sequence}\n')
+    file.close()
+    expected = [island for j, sequence in enumerate(records) for island in intervals(f'r{j}', naiveViterbi(hmm, sequence))]
+    for j, sequence in enumerate(records):
+        assert hmm.viterbi(sequence, f'r{j}') == intervals(f'r{j}', naiveViterbi(hmm, sequence))
+    for chunksize in (2, 97, 1000):
+        assert list(hmm.segmentFile(path, chunksize = chunksize)) == expected
+
+@pytest.mark.parametrize('pair', models)
+def test_posterior_matches_naive(tmp_path, pair):
+    rng = random.Random(1)
+    hmm = IslandHMM(*models[pair], 60, 300)
+    records = [genome(rng, rng.randint(1, 3000)) for i in range(3)]
+    path = os.path.join(tmp_path, 'genome.fa')
+    file = open(path, 'w')
+    for j, sequence in enumerate(records):
+        file.write(f'>r{j}\n{sequence}\n')
+    file.close()
+    for sequence in records:
+        assert numpy.allclose(hmm.posterior(sequence), naivePosterior(hmm, sequence), rtol = 0, atol = 1e-9)
+    expected = [island for j, sequence in enumerate(records) for island in intervals(f'r{j}', naivePosterior(hmm, sequence) > 0.5)]
+    for chunksize in (2, 97, 1000):
+        assert list(hmm.segmentFile(path, posterior = True, chunksize = chunksize)) == expected
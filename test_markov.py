@@ -0,0 +1,502 @@
+import os
+import cli
+import random
+import asyncio
+import threading
+import contextlib
+import numpy
+import pytest
+from markov import MarkovChain, GenomeInOutWindow, PeakCaller, TrackPyramid, logRatioEvaluate, logRatioBatch, logRatioStream
+from cache import ModelCache
+from fasta import PackedGenome, FastaIndex, sampleSegments
+from utils import CpGInModel, CpGOutModel, FileHandler, TrackWriter, Encoder, Constants
+from server import ScoringService
+from client import ScoringClient
+
+'''
+Equivalence checks of the fast paths of markov.py against the straightforward computations they replace, run with pytest.
+The genomes are short synthetic sequences alternating CpG-rich and uniform stretches, so that the tracks have peaks to call.
+'''
+
+inmod = MarkovChain(model = CpGInModel)
+outmod = MarkovChain(model = CpGOutModel)
+
+def genome(rng: random.Random, length: int, unassigned: bool = False) -> str:
+    sequence = []
+    while len(sequence) < length:
+        sequence.extend(rng.choices('N' if unassigned and rng.random() < 0.05 else 'CG' if rng.random() < 0.3 else 'ACGT', k=rng.randint(5, 40)))
+    return ''.join(sequence[:length])
+
+def ordered(order: int) -> tuple:
+    '''Inside and outside models of the given order, trained on synthetic CpG-rich and uniform sequences.'''
+    rng = random.Random(order)
+    return MarkovChain(s = ''.join(rng.choices('ACGCGT', k=20000)), order = order), MarkovChain(s = ''.join(rng.choices('ACGT', k=20000)), order = order)
+
+def test_evaluate_matches_reference():
+    rng = random.Random(2)
+    for order in (1, 2, 3):
+        models = (inmod, outmod) if order == 1 else ordered(order)
+        for trial in range(5):
+            sequence = genome(rng, rng.randint(100, 600), True)
+            wsize = rng.randint(order+1, 60)
+            data, wsize = GenomeInOutWindow.evaluate(sequence, *models, wsize, False)
+            reference, wsize = GenomeInOutWindow.evaluateReference(sequence, *models, wsize, False)
+            assert data.tolist() == reference
+
+def test_evaluate_matches_reference_with_impossible_transitions():
+    # models trained without pseudo-counts on sequences lacking T (inside) or A (outside), so that some transitions have probability 0 in
+    # one model or in both, giving windows of -inf, +inf and nan scores next to finite ones
+    rng = random.Random(5)
+    for order in (1, 2, 3):
+        models = MarkovChain(s = ''.join(rng.choices('ACGCG', k=2000)), order = order, pseudocount = 0), MarkovChain(s = ''.join(rng.choices('CGT', k=2000)), order = order, pseudocount = 0)
+        for trial in range(5):
+            sequence = genome(rng, rng.randint(100, 600), True)
+            wsize = rng.randint(order+1, 20)
+            data, wsize = GenomeInOutWindow.evaluate(sequence, *models, wsize, False)
+            reference, wsize = GenomeInOutWindow.evaluateReference(sequence, *models, wsize, False)
+            assert numpy.array_equal(data, reference, equal_nan = True)
+            assert numpy.isfinite(data).any() and numpy.isnan(data).any()
+
+def writeFasta(tmp_path, records: dict) -> str:
+    path = os.path.join(tmp_path, 'genome.fa')
+    file = open(path, 'w')
+    for name, sequence in records.items():
+        file.write(f'>{name}\n'+'\n'.join([sequence[i:i+60] for i in range(0, len(sequence), 60)])+'\n')
+    file.close()
+    return path
+
+def test_chunked_file_matches_evaluate(tmp_path):
+    rng = random.Random(3)
+    records = {'first': genome(rng, 20000, True), 'second': genome(rng, 3000, True)}
+    path = writeFasta(tmp_path, records)
+    for chunksize in (250, 1500, 1 << 22):
+        for name, sequence in records.items():
+            data, wsize = GenomeInOutWindow.evaluate(sequence, inmod, outmod, 200, False)
+            assert numpy.array_equal(data, GenomeInOutWindow.evaluateFile(path, inmod, outmod, 200, False, name, chunksize)[0])
+
+def test_parallel_matches_serial(tmp_path):
+    rng = random.Random(4)
+    records = {'first': genome(rng, 20000, True), 'short': 'ACGT', 'second': genome(rng, 5000, True)}
+    path = writeFasta(tmp_path, records)
+    data, wsize = GenomeInOutWindow.evaluate(records['first'], inmod, outmod, 200, False)
+    assert numpy.array_equal(data, GenomeInOutWindow.evaluateParallel(records['first'], inmod, outmod, 200, False, workers=2, chunksize=1500)[0])
+    assert numpy.array_equal(data, GenomeInOutWindow.evaluateFile(path, inmod, outmod, 200, False, workers=2)[0])
+    tracks, wsize = GenomeInOutWindow.evaluateRecordsParallel(path, inmod, outmod, 200, False, workers=2, chunksize=1500)
+    assert [name for name, scores in tracks] == ['first', 'second']
+    for name, scores in tracks:
+        assert numpy.array_equal(scores, GenomeInOutWindow.evaluate(records[name], inmod, outmod, 200, False)[0])
+
+def test_track_round_trip(tmp_path):
+    rng = random.Random(5)
+    data, wsize = GenomeInOutWindow.evaluate(genome(rng, 5000, True), inmod, outmod, 100, False)
+    calls = GenomeInOutWindow.callPeaks(data, wsize, 2)
+    trackfile = os.path.join(tmp_path, 'scan.trk')
+    writer = TrackWriter(trackfile, wsize, 2)
+    for i in range(0, len(data), 700):
+        writer.write(data[i:i+700])
+    writer.close(calls[0])
+    scores, length, w, stringency, *peaks = FileHandler.loadEvaluation(trackfile)
+    assert isinstance(scores, numpy.memmap) and numpy.array_equal(scores, data.astype(numpy.float32))
+    assert (length, w, stringency, peaks) == (5000, wsize, 2, calls[0])
+    # a scan saved in the old text format converts into the same track
+    textfile, converted = os.path.join(tmp_path, 'scan.txt'), os.path.join(tmp_path, 'converted.trk')
+    FileHandler.writeEvaluation(textfile, data, wsize, 2, calls)
+    FileHandler.convertEvaluation(textfile, converted)
+    text, converted = FileHandler.loadEvaluation(textfile), FileHandler.loadEvaluation(converted)
+    assert text[1:] == converted[1:] == [5000, wsize, 2] + calls[0]
+    assert numpy.array_equal(numpy.asarray(text[0], dtype=numpy.float32), converted[0])
+
+def test_higher_orders_default_to_a_pseudocount():
+    sequence = ''.join(random.Random(6).choices('ACGT', k=300))
+    assert MarkovChain(s = sequence).pseudocount == 0
+    chain = MarkovChain(s = sequence, order = 3)
+    assert chain.pseudocount == 1 and (chain.matrix > 0).all()
+    assert (MarkovChain(s = sequence, order = 3, pseudocount = 0).matrix == 0).any()
+
+def naiveChain(sequence: str, order: int, pseudocount: float) -> numpy.ndarray:
+    '''Transition probabilities counted k-mer by k-mer, with the rows in the order of Constants.kmers, skipping the unassigned nucleotides.'''
+    sequence = sequence.upper()
+    rows = {kmer: j for j, kmer in enumerate(Constants.kmers(order))}
+    counts = numpy.zeros((4**order, 4))
+    for i in range(len(sequence)-order):
+        kmer, following = sequence[i:i+order], sequence[i+order]
+        if kmer in rows and following in Constants.nucleotides:
+            counts[rows[kmer], Constants.nucleotides.index(following)] += 1
+    counts += pseudocount
+    totals = counts.sum(axis=1, keepdims=True)
+    return numpy.divide(counts, totals, out=numpy.zeros(counts.shape), where=totals > 0)
+
+def naiveScore(matrix: numpy.ndarray, order: int, query: str, log: bool) -> float:
+    '''Score of scoreQuery, looking up the transitions of the query one at a time.'''
+    query = query.upper()
+    rows = {kmer: j for j, kmer in enumerate(Constants.kmers(order))}
+    probabilities = [matrix[rows[query[i:i+order]], Constants.nucleotides.index(query[i+order])] for i in range(len(query)-order)
+                     if query[i:i+order] in rows and query[i+order] in Constants.nucleotides]
+    if not log:
+        return 0.25**order*numpy.prod(probabilities)
+    with numpy.errstate(divide='ignore'):
+        return order*numpy.log(0.25) + numpy.sum(numpy.log(probabilities))
+
+def test_training_and_scoring_match_naive_counts(tmp_path):
+    rng = random.Random(16)
+    for order in (1, 2, 3):
+        for pseudocount in (None, 0, 0.5):
+            sequence = ''.join([c.lower() if rng.random() < 0.1 else c for c in genome(rng, rng.randint(order+1, 3000), True)])
+            chain = MarkovChain(s = sequence, order = order, pseudocount = pseudocount)
+            expected = naiveChain(sequence, order, MarkovChain.defaultPseudocount(order) if pseudocount == None else pseudocount)
+            assert numpy.allclose(chain.matrix, expected, rtol = 0, atol = 1e-12)
+            codes = Encoder.encode(sequence)
+            assert numpy.array_equal(MarkovChain.countTransitions(codes, order, block = 7), MarkovChain.countTransitions(codes, order))
+            for query in [genome(rng, rng.randint(0, 80), True) for i in range(20)]:
+                for log in (True, False):
+                    with numpy.errstate(divide='ignore'):
+                        assert numpy.isclose(chain.scoreQuery(query, log), naiveScore(expected, order, query, log), rtol = 1e-9, atol = 0)
+    # training from a file joins its rows, whose average length is kept as the source length
+    rows = [genome(rng, rng.randint(50, 200)) for i in range(10)]
+    path = os.path.join(tmp_path, 'training.txt')
+    file = open(path, 'w')
+    file.write('\n'.join(rows)+'\n')
+    file.close()
+    chain = MarkovChain(path = path, order = 2)
+    assert numpy.allclose(chain.matrix, naiveChain(''.join(rows), 2, 1), rtol = 0, atol = 1e-12)
+    assert chain.average_source_length == round(sum([len(row) for row in rows])/len(rows))
+
+def test_model_cache_invalidation(tmp_path):
+    rng = random.Random(7)
+    cache = ModelCache(os.path.join(tmp_path, 'cache'))
+    training = os.path.join(tmp_path, 'training.txt')
+    file = open(training, 'w')
+    file.write('\n'.join([genome(rng, 200) for i in range(20)])+'\n')
+    file.close()
+    chain = cache.load(training)
+    cached = cache.get(cache.key(training))
+    assert numpy.array_equal(cached.matrix, chain.matrix) and cached.average_source_length == chain.average_source_length
+    assert len(set([cache.key(training), cache.key(training, 2), cache.key(training, 1, 0.5)])) == 3
+    assert cache.load(training, 2).order == 2
+    file = open(training, 'a')
+    file.write('CGCGCGCGCGCGCG\n')
+    file.close()
+    assert cache.get(cache.key(training)) == None
+    assert numpy.array_equal(cache.load(training).matrix, MarkovChain(path = training).matrix)
+    assert len(os.listdir(cache.directory)) == 3
+
+def test_model_cache_eviction(tmp_path):
+    cache = ModelCache(os.path.join(tmp_path, 'cache'), maxEntries = 3)
+    entry = lambda key: os.path.join(cache.directory, key+'.model')
+    for key, mtime in zip('abc', (1000, 2000, 3000)):
+        cache.put(key, inmod)
+        os.utime(entry(key), (mtime, mtime))
+    assert cache.get('a') != None  # marks a as the most recently used
+    cache.put('d', inmod)
+    assert sorted(os.listdir(cache.directory)) == ['a.model', 'c.model', 'd.model']
+    os.utime(entry('c'), (1000, 1000))
+    cache.maxBytes = 2*os.path.getsize(entry('a'))
+    cache.evict()
+    assert sorted(os.listdir(cache.directory)) == ['a.model', 'd.model']
+
+def test_batch_matches_score_query():
+    # the second pair of models has transitions impossible on one model or both, which must only affect the sequences holding them
+    rng = random.Random(8)
+    impossible = MarkovChain(s = ''.join(rng.choices('ACGCG', k=2000)), pseudocount = 0), MarkovChain(s = ''.join(rng.choices('CGT', k=2000)), pseudocount = 0)
+    for models in ((inmod, outmod), ordered(2), impossible):
+        sequences = [genome(rng, rng.randint(0, 60), True) for i in range(200)] + ['', 'C', 'CGCGGC', 'CGGCAT', 'TTCG']
+        rng.shuffle(sequences)
+        expected = [logRatioEvaluate(models[0].scoreQuery(sequence), models[1].scoreQuery(sequence)) for sequence in sequences]
+        assert numpy.array_equal(numpy.round(logRatioBatch(sequences, *models), 2), expected, equal_nan = True)
+        assert numpy.array_equal(numpy.round(numpy.concatenate(list(logRatioStream(sequences, *models, batchsize = 500))), 2), expected, equal_nan = True)
+
+@contextlib.contextmanager
+def serving(service: ScoringService):
+    '''Runs the service on a free port, yielded, from an event loop in a thread.'''
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(service.connection, '127.0.0.1', 0, limit = service.maxRequest))
+    thread = threading.Thread(target = loop.run_forever)
+    thread.start()
+    try:
+        yield server.sockets[0].getsockname()[1]
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+        service.threads.shutdown()
+        service.processes.shutdown()
+
+def test_service_batches_across_clients():
+    # concurrent clients share the score batches, and the sequences with impossible transitions only affect their own ratios
+    rng = random.Random(9)
+    models = MarkovChain(s = ''.join(rng.choices('ACGCG', k=2000)), pseudocount = 0), MarkovChain(s = ''.join(rng.choices('CGT', k=2000)), pseudocount = 0)
+    requests = [[''.join(rng.choices('CG', k=rng.randint(0, 40))) for i in range(5)] for j in range(8)]
+    requests[0].append('TTCG')
+    requests[1].append('CGGCAT')
+    service = ScoringService(*models, batchDelay = 0.2)
+    ratios = [None]*len(requests)
+    barrier = threading.Barrier(len(requests))
+    def run(j):
+        client = ScoringClient('127.0.0.1', port)
+        barrier.wait()
+        ratios[j] = client.scoreMany(requests[j])
+        client.close()
+    clients = [threading.Thread(target = run, args = (j,)) for j in range(len(requests))]
+    with serving(service) as port:
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+    for sequences, received in zip(requests, ratios):
+        expected = [logRatioEvaluate(models[0].scoreQuery(sequence), models[1].scoreQuery(sequence)) for sequence in sequences]
+        assert numpy.array_equal(received, expected, equal_nan = True)
+    assert numpy.isneginf(ratios[0][-1]) and numpy.isnan(ratios[1][-1])
+    assert service.stats['batched'] == sum([len(sequences) for sequences in requests]) and service.stats['batches'] < len(requests)
+
+def test_service_rejects_long_requests_and_scans_in_workers():
+    # overlong lines are answered by an error and skipped, whether their line break arrives with them or much later, and the connection goes on
+    rng = random.Random(10)
+    service = ScoringService(inmod, outmod, inline = 100, maxRequest = 4096)
+    with serving(service) as port:
+        client = ScoringClient('127.0.0.1', port)
+        for length in (5000, 1 << 20):
+            with pytest.raises(ValueError, match = 'longer than 4096 bytes'):
+                client.score('CG'*length)
+            assert client.score('CGCGTA') == logRatioEvaluate(inmod.scoreQuery('CGCGTA'), outmod.scoreQuery('CGCGTA'))
+        sequence = genome(rng, 2000)
+        assert client.scan(sequence, 50, 5, True) == ScoringService.scan(inmod, outmod, sequence, 50, 5, True)
+        client.close()
+
+def naivePeaks(data, ws: int, stringency: int) -> tuple:
+    '''Peak calling of the original GenomeInOutWindow.callPeaks, indexing the whole score track.'''
+    lastMax, putativeStartSites, potentialMax, potentialMin = 0, [], 0, 0
+    for i in range(len(data)):
+        if data[i] > data[potentialMax]:
+            potentialMax = i
+            if data[i] - data[potentialMin] >= numpy.log(ws)*stringency:
+                potentialMin = i
+        if data[i] < data[potentialMin]:
+            potentialMin = i
+            if data[i] - data[potentialMax] <= -numpy.log(ws)*stringency and data[potentialMax] >= numpy.log2(ws):
+                lastMax, potentialMax = potentialMax, i
+                if lastMax not in putativeStartSites:
+                    putativeStartSites.append(lastMax)
+    return putativeStartSites, [round(data[i], 1) for i in putativeStartSites]
+
+def test_streamed_peaks_match_naive(tmp_path):
+    rng = random.Random(9)
+    for trial in range(10):
+        sequence = genome(rng, rng.randint(2000, 8000), True)
+        wsize, stringency = rng.randint(20, 200), rng.choice([1, 2, 5])
+        data, wsize = GenomeInOutWindow.evaluate(sequence, inmod, outmod, wsize, False)
+        expected = naivePeaks(data.tolist(), wsize, stringency)
+        assert GenomeInOutWindow.callPeaks(data, wsize, stringency) == expected
+        caller, found, i = PeakCaller(wsize, stringency), [], 0
+        while i < len(data):
+            step = rng.randint(1, 500)
+            found.extend(caller.feed(data[i:i+step]))
+            i += step
+        assert ([i for i, score in found], [score for i, score in found]) == expected
+        path, trackfile = writeFasta(tmp_path, {'first': sequence}), os.path.join(tmp_path, 'scan.trk')
+        peaks, wsize, nscores = GenomeInOutWindow.evaluateStream(path, inmod, outmod, wsize, stringency, trackfile, False, chunksize = rng.randint(wsize, 3000))
+        assert peaks == expected and nscores == len(data)
+        scores, length, w, s, *saved = FileHandler.trackFromFile(trackfile)
+        assert numpy.array_equal(scores, data.astype(numpy.float32)) and saved == expected[0]
+
+def test_pyramid_envelopes(tmp_path):
+    rng = numpy.random.default_rng(10)
+    data = numpy.round(numpy.cumsum(rng.normal(0, 1, 300001)), 1).astype(numpy.float32)
+    trackfile = os.path.join(tmp_path, 'scan.trk')
+    FileHandler.writeTrack(trackfile, data, 200, 20)
+    scores = FileHandler.trackFromFile(trackfile)[0]
+    mapped = TrackPyramid.fromTrack(scores)
+    assert os.path.exists(trackfile+TrackPyramid.suffix) and isinstance(mapped.levels[0][1], numpy.memmap)
+    memory = TrackPyramid(data, block = 1000)
+    assert len(mapped.levels) == len(memory.levels)
+    for (binsize, lower, upper), level in zip(mapped.levels, memory.levels):
+        assert binsize == level[0] and numpy.array_equal(lower, level[1]) and numpy.array_equal(upper, level[2])
+        bins = len(data) // binsize
+        assert numpy.array_equal(lower[:bins], data[:bins*binsize].reshape(bins, binsize).min(axis=1))
+        assert numpy.array_equal(upper[:bins], data[:bins*binsize].reshape(bins, binsize).max(axis=1))
+    for start, end, width in ((0, len(data), 2000), (12345, 98765, 500), (1000, 1500, 2000), (290000, 400000, 100)):
+        x, lower, upper = mapped.envelope(start, end, width)
+        expected = memory.envelope(start, end, width)
+        assert all([numpy.array_equal(a, b) for a, b in zip((x, lower, upper), expected)])
+        if lower is not upper:
+            assert len(x) >= width and x[0] <= start and x[-1] < end
+            binsize = x[1]-x[0]
+            assert numpy.array_equal(lower, [data[i:i+binsize].min() for i in x]) and numpy.array_equal(upper, [data[i:i+binsize].max() for i in x])
+        else:
+            assert numpy.array_equal(lower, data[start:end])
+
+def test_packed_genome_fetch(tmp_path):
+    rng = random.Random(11)
+    records = {}
+    for name in ('chr1', 'chr2', 'chrM'):
+        sequence = genome(rng, rng.randint(1, 3000), True)
+        records[name] = ''.join([base.lower() if rng.random() < 0.2 else base for base in sequence]) + 'N'*rng.randint(0, 7)
+    path = writeFasta(tmp_path, records)
+    whole = ''.join(records.values())
+    for packed in (PackedGenome.fromFasta(path, 37), PackedGenome.load(path), PackedGenome.load(path)):
+        assert packed.names == list(records) and len(packed) == len(whole)
+        assert packed.fetch(0, len(whole), soft = True) == whole and packed[:] == whole.upper()
+        for trial in range(200):
+            start = rng.randint(-5, len(whole))
+            end = rng.randint(start, len(whole)+5)
+            assert packed.fetch(start, end) == whole[max(start, 0):end].upper()
+            assert numpy.array_equal(packed.fetchCodes(start, end), Encoder.encode(whole[max(start, 0):end]))
+        for name, sequence in records.items():
+            start = rng.randint(0, len(sequence))
+            assert packed.fetch(start, start+50, name, True) == sequence[start:start+50]
+        for trial in range(50):
+            fragment = packed.randomFragment(40)
+            assert len(fragment) == 40 and 'N' not in fragment and any([fragment in sequence.upper() for sequence in records.values()])
+
+def test_sample_segments():
+    starts, ends = numpy.array([0, 10, 13, 30]), numpy.array([5, 12, 25, 31])
+    fragments = {}
+    valid = set([start for a, b in zip(starts, ends) for start in range(a, b-3+1)])
+    random.seed(12)
+    drawn = [sampleSegments(starts, ends, fragments, 3) for i in range(3000)]
+    assert set(drawn) == valid
+    assert max([drawn.count(start) for start in valid]) < 2*min([drawn.count(start) for start in valid])
+    with pytest.raises(ValueError):
+        sampleSegments(starts, ends, fragments, 13)
+
+def test_fetch_many_keeps_annotation_order(tmp_path):
+    rng = random.Random(13)
+    records = {name: genome(rng, rng.randint(500, 5000), True) for name in ('chr2', 'chr1', 'chrX')}
+    index = FastaIndex(writeFasta(tmp_path, records))
+    intervals = []
+    for i in range(300):
+        name = rng.choice(list(records))
+        start = rng.randint(0, len(records[name]))
+        intervals.append((name, start, start+rng.randint(0, 400), f'island{i}'))
+    for annotation in (sorted(intervals, key=lambda interval: (interval[0], interval[1])), intervals):
+        for buffer in (0, 1000, 1 << 26):
+            fetched = list(index.fetchMany(annotation, buffer))
+            assert [interval for interval, sequence in fetched] == annotation
+            assert [sequence for interval, sequence in fetched] == [records[name][start:end] for name, start, end, label in annotation]
+
+def test_multi_window_matches_single(tmp_path):
+    rng = random.Random(14)
+    impossible = MarkovChain(s = ''.join(rng.choices('ACGCG', k=2000)), pseudocount = 0), MarkovChain(s = ''.join(rng.choices('CGT', k=2000)), pseudocount = 0)
+    for models in ((inmod, outmod), ordered(2), impossible):
+        for trial in range(4):
+            sequence = genome(rng, rng.randint(300, 4000), True)
+            wsizes = [rng.randint(3, 250) for i in range(rng.randint(1, 4))]
+            tracks, sizes = GenomeInOutWindow.evaluateMulti(sequence, *models, wsizes, False)
+            assert sizes == sorted(set(wsizes))
+            single = {wsize: GenomeInOutWindow.evaluate(sequence, *models, wsize, False)[0] for wsize in sizes}
+            for wsize in sizes:
+                assert numpy.array_equal(tracks[wsize], single[wsize], equal_nan = True)
+            peaks, combined = GenomeInOutWindow.callPeaksMulti(tracks, 2)
+            assert peaks == {wsize: GenomeInOutWindow.callPeaks(single[wsize], wsize, 2) for wsize in sizes}
+            assert [entry[0] for entry in combined] == sorted([entry[0] for entry in combined])
+            for position, score, wsize, support in combined:
+                assert position in peaks[wsize][0] and score == peaks[wsize][1][peaks[wsize][0].index(position)] and 1 <= support <= len(sizes)
+            assert len(combined) <= sum([len(calls) for calls, scores in peaks.values()])
+            path = writeFasta(tmp_path, {'first': sequence, 'second': 'ACGT'})
+            savename = os.path.join(tmp_path, 'scan.trk')
+            streamed, streamedCombined, nscores = GenomeInOutWindow.evaluateStreamMulti(path, *models, wsizes, 2, savename, False, chunksize = rng.randint(1, 700))
+            assert streamed == peaks and streamedCombined == combined
+            for wsize in sizes:
+                assert nscores[wsize] == len(single[wsize])
+                assert numpy.array_equal(FileHandler.trackFromFile(GenomeInOutWindow.multiTrackName(savename, wsize))[0], single[wsize].astype(numpy.float32), equal_nan = True)
+
+def test_strands_reject_several_window_sizes():
+    with pytest.raises(ValueError):
+        cli.main(['scan', '-F', '-r', '-l', '500', '-w', '50,100', '--strands', '-M'])
+
+def reverseComplement(sequence: str) -> str:
+    return sequence[::-1].translate(str.maketrans('ACGTN', 'TGCAN'))
+
+def test_strands_match_reverse_complement(tmp_path):
+    rng = random.Random(15)
+    impossible = MarkovChain(s = ''.join(rng.choices('ACGCG', k=2000)), pseudocount = 0), MarkovChain(s = ''.join(rng.choices('CGT', k=2000)), pseudocount = 0)
+    for models in ((inmod, outmod), ordered(2), impossible):
+        for trial in range(5):
+            sequence = genome(rng, rng.randint(100, 3000), True)
+            wsize = rng.randint(models[0].order+1, 80)
+            forward, reverse, combined, wsize = GenomeInOutWindow.evaluateStrands(sequence, *models, wsize, False)
+            assert numpy.array_equal(forward, GenomeInOutWindow.evaluate(sequence, *models, wsize, False)[0], equal_nan = True)
+            assert numpy.array_equal(reverse, GenomeInOutWindow.evaluate(reverseComplement(sequence), *models, wsize, False)[0][::-1], equal_nan = True)
+            assert numpy.array_equal(combined, numpy.maximum(forward, reverse), equal_nan = True)
+            path = writeFasta(tmp_path, {'first': sequence, 'second': 'ACGT'})
+            chunksize = rng.randint(wsize, 500)
+            streamed = GenomeInOutWindow.evaluateFileStrands(path, *models, wsize, False, chunksize=chunksize)
+            assert all([numpy.array_equal(a, b, equal_nan = True) for a, b in zip(streamed[:3], (forward, reverse, combined))])
+            peaks = GenomeInOutWindow.callPeaksStrands(forward, reverse, wsize, 1)
+            savename = os.path.join(tmp_path, 'strands.trk')
+            assert GenomeInOutWindow.evaluateStreamStrands(path, *models, wsize, 1, savename, False, chunksize=chunksize)[0] == peaks
+            # the saved track holds the combined scores and the peaks they give, which rescore and trackFromFile rely on
+            scores, length, w, s, *saved = FileHandler.trackFromFile(savename)
+            assert numpy.array_equal(scores, combined.astype(numpy.float32), equal_nan = True)
+            assert saved == GenomeInOutWindow.callPeaks(combined, wsize, 1)[0]
+
+def test_failed_streams_leave_no_track(tmp_path):
+    path = writeFasta(tmp_path, {'first': 'ACGT'*100, 'second': 'ACGT'})
+    savename = os.path.join(tmp_path, 'scan.trk')
+    for scan in (GenomeInOutWindow.evaluateStream, GenomeInOutWindow.evaluateStreamStrands, GenomeInOutWindow.evaluateStreamMulti):
+        for record, wsize in (('missing', 50), ('second', 50), (None, 500)):
+            with pytest.raises(ValueError):
+                scan(path, inmod, outmod, wsize, 20, savename, False, record)
+            assert os.listdir(tmp_path) == ['genome.fa']
+
+def test_model_view_is_cached():
+    pytest.importorskip('pandas')
+    chain = MarkovChain(s = 'ACGCGTTACG'*20)
+    frame = chain.model
+    assert chain.model is frame
+    assert frame.loc['C', 'G'] == chain.matrix[1, 2]
+    chain.matrix = numpy.full((4, 4), 0.25)
+    assert chain.model is not frame and chain.model.loc['C', 'G'] == 0.25
+
+def edited(reference: str, variants: list) -> str:
+    pieces = []
+    cursor = 0
+    for position, ref, alt in sorted(variants):
+        pieces.extend([reference[cursor:position], alt])
+        cursor = position+len(ref)
+    return ''.join(pieces + [reference[cursor:]])
+
+def assertRescored(reference: str, variants: list, wsize: int, stringency: int, margin: int = None) -> None:
+    '''Rescores the track of "reference" after "variants" and checks scores and peaks against a full scan of the edited genome.'''
+    old, wsize = GenomeInOutWindow.evaluate(reference, inmod, outmod, wsize, False)
+    peaks = GenomeInOutWindow.callPeaks(old, wsize, stringency)[0]
+    scores, (calls, heights) = GenomeInOutWindow.rescore(old, reference, variants, inmod, outmod, wsize, stringency, peaks, margin)
+    full, wsize = GenomeInOutWindow.evaluate(edited(reference, variants), inmod, outmod, wsize, False)
+    assert numpy.array_equal(scores, full)
+    assert (calls, heights) == GenomeInOutWindow.callPeaks(full, wsize, stringency)
+
+def test_rescore_random_edits():
+    # the default margin, as well as blocks of a single window, must give exactly the peaks of a full call, however far apart the variants are
+    rng = random.Random(0)
+    for trial in range(300):
+        reference = genome(rng, rng.randint(60, 3000))
+        variants = []
+        position = rng.randint(0, len(reference)//3)
+        spacing = rng.choice([3, 10, 40])
+        while position < len(reference):
+            kind = rng.random()
+            if kind < 0.3:
+                variants.append((position, reference[position], rng.choice('ACGT')))
+            elif kind < 0.65:
+                variants.append((position, reference[position:position+rng.randint(1, 12)], ''))
+            else:
+                variants.append((position, '', ''.join(rng.choices('CG', k=rng.randint(1, 12)))))
+            position += len(variants[-1][1]) + 1 + rng.randint(0, len(reference)//spacing)
+        if len(edited(reference, variants)) >= 20:
+            assertRescored(reference, variants, rng.randint(3, 15), rng.choice([1, 2, 5, 20]), rng.choice([None, None, 1]))
+
+def test_rescore_deletions():
+    # deletions at the start, across each peak and at the end, where the old windows of the deleted bases have no counterpart
+    rng = random.Random(1)
+    for trial in range(40):
+        reference = genome(rng, rng.randint(100, 400))
+        wsize, stringency = rng.randint(3, 9), rng.choice([1, 2])
+        old, wsize = GenomeInOutWindow.evaluate(reference, inmod, outmod, wsize, False)
+        deletions = [(0, reference[:d], '') for d in (1, 5, 10)] + [(len(reference)-d, reference[-d:], '') for d in (1, 5, 10)]
+        for peak in GenomeInOutWindow.callPeaks(old, wsize, stringency)[0]:
+            for position in (peak-3, peak, peak+2):
+                if 0 <= position < len(reference)-12:
+                    deletions.append((position, reference[position:position+10], ''))
+        for deletion in deletions:
+            assertRescored(reference, [deletion], wsize, stringency)
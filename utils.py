@@ -1,10 +1,54 @@
+import os
 import random
-import pandas as pd
+import struct
+import itertools
+import numpy
+from fasta import FastaReader, PackedGenome
+from profiling import profiler
 
 class Constants:
     nucleotides = ['A', 'C', 'G', 'T']
     amino_acids = ['F', 'L', 'S',  'Y', 'C', 'W', 'P', 'H', 'Q', 'R', 'I', 'M', 'T', 'N', 'K', 'V', 'A', 'D', 'E', 'G']
 
+    @staticmethod
+    def kmers(k: int) -> list:
+        '''All the k-mers of nucleotides, sorted as their 2-bit codes (see Encoder.kmerCodes).'''
+        return [''.join(i) for i in itertools.product(Constants.nucleotides, repeat=k)]
+
+class Encoder:
+    '''Utility class for converting nucleotide strings into compact integer arrays, the representation used by the vectorized
+    scoring and scanning routines. A, C, G and T (in either case) are mapped to 0, 1, 2 and 3, any other symbol to 4.'''
+    table = numpy.full(256, 4, dtype=numpy.uint8)
+    table[numpy.frombuffer(b'ACGTacgt', dtype=numpy.uint8)] = [0, 1, 2, 3, 0, 1, 2, 3]
+
+    @staticmethod
+    def encode(s: str) -> numpy.ndarray:
+        '''Returns the uint8 array of the nucleotide codes of the string "s".'''
+        return Encoder.table[numpy.frombuffer(s.encode('ascii', 'replace'), dtype=numpy.uint8)]
+
+    @staticmethod
+    def encodeBatch(sequences) -> tuple:
+        '''Encodes an iterable of sequences as a single concatenated array, returning it together with the array of the offsets of the
+        sequences in it, one more than the number of sequences, so that sequence i spans the codes from offsets[i] to offsets[i+1].'''
+        sequences = list(sequences)
+        offsets = numpy.zeros(len(sequences)+1, dtype=numpy.int64)
+        numpy.cumsum(numpy.fromiter(map(len, sequences), dtype=numpy.int64, count=len(sequences)), out=offsets[1:])
+        return Encoder.encode(''.join(sequences)), offsets
+
+    @staticmethod
+    def kmerCodes(codes: numpy.ndarray, k: int) -> tuple:
+        '''Computes the rolling 2-bit codes of all the k-mers of the encoded sequence "codes", the first nucleotide being the most significant.
+        Returns the array of the codes, one for each starting position, and a boolean array marking the k-mers free of unassigned nucleotides.'''
+        n = max(len(codes)-k+1, 0)
+        kmers = numpy.zeros(n, dtype=numpy.int64)
+        valid = numpy.ones(n, dtype=bool)
+        for j in range(k):
+            part = codes[j:j+n]
+            kmers <<= 2
+            kmers |= part & 3
+            valid &= part < 4
+        return kmers, valid
+
 class Generator:
     '''Utility class that contains useful methods for generating random sequences or retrieving entire ones from files.'''
     @staticmethod
@@ -20,6 +64,29 @@ class Generator:
         file.close()
         return random.choice(lines)
     
+    @staticmethod
+    def sequencesFromFile(path: str):
+        '''Generator yielding one at a time the sequences stored by rows in the file "path", skipping empty rows, or its records if the file is in FASTA format.'''
+        file = open(path, 'r')
+        fasta = file.read(1) == '>'
+        file.close()
+        if fasta:
+            record = []
+            for name, start, chunk in FastaReader.chunks(path):
+                if start == 0 and len(record) > 0:
+                    yield ''.join(record)
+                    record = []
+                record.append(chunk)
+            if len(record) > 0:
+                yield ''.join(record)
+        else:
+            file = open(path, 'r')
+            for line in file:
+                line = line.strip()
+                if len(line) > 0:
+                    yield line
+            file.close()
+
     @staticmethod
     def randomGenome(l: int = 1000) -> str:
         '''Random generation of a genome, useful in scanning since the length parameter is by default set to 1000.'''
@@ -28,25 +95,22 @@ class Generator:
     @staticmethod
     def randomGenomeFromFile(path: str, l: int = 1000) -> str:
         '''Generates a genome from the whole concatenated sequence content of the file "path", starting at a random position
-        and with length "l", by default set to 1000. Takes care not to have any unassigned nucleotides in the chosen sequence.'''
-        sf = open(path, 'r')
-        sequence = ''.join([i.strip('\n') for i in sf.readlines()]).upper()
-        sf.close()
-        rsp = random.randint(0, len(sequence)-l-1)
-        while 'N' in sequence[rsp:rsp+l]:
-            rsp = random.randint(0, len(sequence)-l-1)
-        return sequence[rsp:rsp+l]
+        and with length "l", by default set to 1000. Takes care not to have any unassigned nucleotides in the chosen sequence, which is drawn
+        uniformly among the valid ones from the packed representation of the file (see PackedGenome), built on the first use.'''
+        return PackedGenome.load(path).randomFragment(l)
     
     @staticmethod
     def genomeFromFile(path: str) -> str:
-        '''Generates a genome from the whole sequence content of the file "path", concatenated. Mind the size of the èarsed file!'''
-        sf = open(path, 'r')
-        return ''.join([i.strip('\n') for i in sf.readlines()]).upper()
+        '''Generates a genome from the whole sequence content of the file "path", concatenated, skipping FASTA headers. Mind the size of the parsed file!
+        For scanning large files without loading them, see FastaReader.chunks and GenomeInOutWindow.evaluateFile.'''
+        with profiler.stage('read genome'):
+            return ''.join([chunk for name, start, chunk in FastaReader.chunks(path)]).upper()
 
 class Model:
     '''Base class for creation of more specific models; contains the attribute isModel, used for compatibility with the MarkovModel class
-    if provided as a model. The model system can easily be extended as shown below by the custom classes present.'''
+    if provided as a model, and the order of the chain, 1 unless overridden. The model system can easily be extended as shown below by the custom classes present.'''
     isModel = True
+    order = 1
 
 class NoModel:
     '''Counterpart of the Model class, used as default in MarkovModel, but can be replaced by parsing a Model.'''
@@ -55,23 +119,84 @@ class NoModel:
 class StandardModel(Model):
     '''Subclass of Model, inherits the isModel attribute, and can be used to create a custom model by the user,
     which can use this class as interface to host data representing the computed model, ensuring compatibility
-    with the MarkovModel class when loading such model on an active spot for query evaluation or scanning.'''
-    def __init__(self, mod: pd.DataFrame = None, avl: int = None) -> None:
-        self.model = None
-        self.average_source_length = None
+    with the MarkovModel class when loading such model on an active spot for query evaluation or scanning.
+    Models of order k can be provided either as a DataFrame indexed by the k-mers (see Constants.kmers) with the nucleotides
+    on the columns, or as the equivalent 4^k x 4 array, as stored by MarkovChain.matrix.'''
+    def __init__(self, mod: 'pd.DataFrame' = None, avl: int = None, order: int = 1) -> None:
+        self.model = mod
+        self.average_source_length = avl
+        self.order = order
+
+
+class FrameView:
+    '''Descriptor giving the pre-computed models the DataFrame attribute "model" of the Model system as a view of their "matrix" array, indexed
+    by the k-mers (see Constants.kmers) with the nucleotides on the columns. The DataFrame, and pandas with it, is only built on the first access,
+    so that scoring with the pre-computed models never imports pandas; later accesses return the same DataFrame.'''
+    def __init__(self) -> None:
+        self.frames = {}
+
+    def __get__(self, instance, owner) -> 'pd.DataFrame':
+        if owner not in self.frames:
+            import pandas as pd
+            self.frames[owner] = pd.DataFrame(owner.matrix, columns=Constants.nucleotides, index=Constants.kmers(owner.order))
+        return self.frames[owner]
 
 
 class CpGInModel(Model):
     '''Inside model for CpG island, pre-computed and stored in a StandardModel-like object. Fast access for repetitive executions.'''
-    model = pd.DataFrame([[0.19, 0.28, 0.40, 0.14],[0.19, 0.36, 0.25, 0.20],[0.17, 0.33, 0.36, 0.14],[0.09, 0.34, 0.38, 0.19]], columns=Constants.nucleotides, index=Constants.nucleotides)
+    matrix = numpy.array([[0.19, 0.28, 0.40, 0.14],[0.19, 0.36, 0.25, 0.20],[0.17, 0.33, 0.36, 0.14],[0.09, 0.34, 0.38, 0.19]])
+    model = FrameView()
     average_source_length = 566
 
 
 class CpGOutModel(Model):
     '''Inside model for CpG island, pre-computed and stored in a StandardModel-like object. Fast access for repetitive executions.'''
-    model = pd.DataFrame([[0.29, 0.20, 0.29, 0.23],[0.32, 0.29, 0.07, 0.31],[0.26, 0.23, 0.29, 0.21],[0.18, 0.23, 0.29, 0.29]], columns=Constants.nucleotides, index=Constants.nucleotides)
+    matrix = numpy.array([[0.29, 0.20, 0.29, 0.23],[0.32, 0.29, 0.07, 0.31],[0.26, 0.23, 0.29, 0.21],[0.18, 0.23, 0.29, 0.29]])
+    model = FrameView()
     average_source_length = 566
 
+class TrackWriter:
+    '''Incremental writer of the binary score track format, which stores a scan as a fixed 64 bytes header (magic string, genome length,
+    window size, stringency, number of scores, number of peaks and their byte offset), followed by the scores as a float32 array and by the
+    peak positions as an int64 array. Scores can be appended in chunks as they are produced, and the header is completed when closing,
+    so that the whole score track never needs to be held in memory. When closing, the plotting pyramid of the track (see markov.TrackPyramid)
+    is built from the written scores and saved next to the file.'''
+    magic = b'CPGTRACK'
+    header = struct.Struct('<8sQiiQQQ')
+    offset = 64
+
+    def __init__(self, filename: str, wsize: int, stringency: int) -> None:
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.wsize = wsize
+        self.stringency = stringency
+        self.nscores = 0
+        self.file.write(bytes(TrackWriter.offset))
+
+    def write(self, scores) -> None:
+        '''Appends a chunk of scores to the track.'''
+        with profiler.stage('write track'):
+            scores = numpy.asarray(scores, dtype=numpy.float32)
+            scores.tofile(self.file)
+        self.nscores += len(scores)
+
+    def close(self, peaks = ()) -> None:
+        '''Writes the peak positions after the scores and completes the header.'''
+        peaks = numpy.asarray(peaks, dtype=numpy.int64)
+        peaksOffset = TrackWriter.offset + 4*self.nscores
+        peaks.tofile(self.file)
+        self.file.seek(0)
+        self.file.write(TrackWriter.header.pack(TrackWriter.magic, self.nscores+self.wsize-1, self.wsize, self.stringency, self.nscores, len(peaks), peaksOffset))
+        self.file.close()
+        if self.nscores > 0:
+            from markov import TrackPyramid
+            TrackPyramid.fromTrack(numpy.memmap(self.filename, dtype=numpy.float32, mode='r', offset=TrackWriter.offset, shape=(self.nscores,)))
+
+    def discard(self) -> None:
+        '''Closes and removes the track, for scans failing before it is complete, which would otherwise leave a truncated file behind.'''
+        self.file.close()
+        os.remove(self.filename)
+
 class FileHandler:
     @staticmethod
     def writeEvaluation(filename: str, scores: list, wsize: int, stringency: int, peaks = None) -> None:
@@ -79,37 +204,105 @@ class FileHandler:
         In the first line are written the parameters of the operation, in the second line, if present, are written
         the locations of the peaks, and in line 3 the positional scores; if no peaks are present, the scores are
         directly written in the second line.'''
-        peaks = [i for i in peaks[0]]
-        file = open(filename, 'w')
-        file.write(f'@length:{len(scores)+wsize-1};window_size:{wsize};stringency:{str(stringency)}')
-        file.write('\n')
-        if len(peaks) > 0:
-            for i in range(len(peaks)):
-                if i < len(peaks) - 1:
-                    file.write(str(peaks[i])+',')
-                else:
-                    file.write(str(peaks[i]))
+        peaks = [] if peaks == None else peaks[0]
+        with profiler.stage('write evaluation'):
+            file = open(filename, 'w')
+            file.write(f'@length:{len(scores)+wsize-1};window_size:{wsize};stringency:{str(stringency)}')
             file.write('\n')
-        for i in range(len(scores)):
-            if i == len(scores)-1:
-                file.write(f'{scores[i]}')
-            else:
-                file.write(f'{scores[i]},')
+            if len(peaks) > 0:
+                file.write(','.join([str(i) for i in peaks]))
+                file.write('\n')
+            file.write(','.join([str(i) for i in numpy.asarray(scores).tolist()]))
+            file.close()
+
+    @staticmethod
+    def writeTrack(filename: str, scores: list, wsize: int, stringency: int, peaks = None) -> None:
+        '''Binary counterpart of writeEvaluation, taking the same arguments: the scores are written in bulk as a float32 array in the
+        format of TrackWriter, which can be reopened instantly through trackFromFile.'''
+        writer = TrackWriter(filename, wsize, stringency)
+        writer.write(scores)
+        writer.close([] if peaks == None else peaks[0])
+
+    @staticmethod
+    def writeBed(filename: str, intervals) -> int:
+        '''Writes the (record name, start, end) intervals of the islands found by IslandHMM in the BED format, with 0-based starts and
+        excluded ends, returning the number of intervals written. Intervals can be provided by any iterable, written as they are produced.'''
+        file = open(filename, 'w')
+        count = 0
+        for name, start, end in intervals:
+            file.write(f'{name}\t{start}\t{end}\n')
+            count += 1
+        file.close()
+        return count
+
+    @staticmethod
+    def variantsFromFile(filename: str) -> list:
+        '''Reads the variants of a VCF file as the (position, reference allele, alternative allele) tuples of GenomeInOutWindow.rescore, with 0-based
+        positions; only the first alternative allele of each row is kept, and rows with symbolic alleles (such as <DEL>) are rejected.'''
+        variants = []
+        file = open(filename, 'r')
+        for line in file:
+            if line.startswith('#') or len(line.strip()) == 0:
+                continue
+            fields = line.rstrip('\n').split('\t')
+            alt = fields[4].split(',')[0]
+            if alt.startswith('<') or fields[3].startswith('<'):
+                file.close()
+                raise ValueError(f'FormatError: symbolic allele at position {fields[1]} is not supported')
+            variants.append((int(fields[1])-1, fields[3], '' if alt in ('.', '*') else alt))
         file.close()
+        return variants
+
+    @staticmethod
+    def trackFromFile(filename: str) -> list:
+        '''Opens a binary score track and returns the same list as evaluationFromFile, except that the scores are a read-only numpy.memmap,
+        so that opening even a genome-wide track is immediate and regions are only read from disk when sliced.'''
+        file = open(filename, 'rb')
+        magic, length, wsize, stringency, nscores, npeaks, peaksOffset = TrackWriter.header.unpack(file.read(TrackWriter.header.size))
+        if magic != TrackWriter.magic:
+            file.close()
+            raise ValueError(f'FormatError: {filename} is not a binary score track')
+        with profiler.stage('read track'):
+            file.seek(peaksOffset)
+            peaks = numpy.fromfile(file, dtype=numpy.int64, count=npeaks).tolist()
+            file.close()
+        if nscores > 0:
+            scores = numpy.memmap(filename, dtype=numpy.float32, mode='r', offset=TrackWriter.offset, shape=(nscores,))
+        else:
+            scores = numpy.zeros(0, dtype=numpy.float32)
+        return [scores, length, wsize, stringency]+peaks
+
+    @staticmethod
+    def loadEvaluation(filename: str) -> list:
+        '''Reads a scan saved either as a binary score track or in the text format of writeEvaluation, recognised by the magic string.'''
+        file = open(filename, 'rb')
+        magic = file.read(len(TrackWriter.magic))
+        file.close()
+        if magic == TrackWriter.magic:
+            return FileHandler.trackFromFile(filename)
+        return FileHandler.evaluationFromFile(filename)
+
+    @staticmethod
+    def convertEvaluation(textfile: str, trackfile: str) -> None:
+        '''Converts a scan saved in the text format of writeEvaluation into a binary score track.'''
+        scores, length, wsize, stringency, *peaks = FileHandler.evaluationFromFile(textfile)
+        FileHandler.writeTrack(trackfile, scores, wsize, stringency, (peaks,))
     
     @staticmethod
     def evaluationFromFile(filename: str) -> list:
         '''By providing the file path of the evaluation file, the method retrieves from there the saved data about the
         scanning performed. Can distinguish between 2 lines files (no peaks) and 3 lines ones (with peaks).'''
-        file = open(filename, 'r')
-        rows = file.readlines()
-        header = rows[0][1:-1].split(';')
-        header = [int(i.split(':')[1]) for i in header]
-        if len(rows) == 3:
-            peaks = rows[1][:-1].split(',')
-            peaks = [int(i) for i in peaks]
-            scores = [float(i) for i in rows[2].split(',')]
-        else:
-            peaks = []
-            scores = [float(i) for i in rows[1].split(',')]
+        with profiler.stage('read evaluation'):
+            file = open(filename, 'r')
+            rows = file.readlines()
+            file.close()
+            header = rows[0][1:-1].split(';')
+            header = [int(i.split(':')[1]) for i in header]
+            if len(rows) == 3:
+                peaks = rows[1][:-1].split(',')
+                peaks = [int(i) for i in peaks]
+                scores = [float(i) for i in rows[2].split(',')]
+            else:
+                peaks = []
+                scores = [float(i) for i in rows[1].split(',')]
         return [scores]+header+peaks